@@ -0,0 +1,362 @@
+'''
+Latency and throughput benchmark for the auth, blog and post routes.
+
+Seeds a throwaway SQLite database at the requested scale, then drives every
+route twice: in-process through the Flask test client (app cost only) and
+through a real threaded WSGI server with concurrent keep-alive clients.
+post.events is left out, its response is a stream that doesn't end, and so
+are the api, search, debug and metrics blueprints and static files.
+Results are written as JSON so runs can be compared between commits:
+
+    python -m benchmarks.http_bench --users 1000 --posts-per-user 20 \
+        --comments-per-post 10 --out before.json
+    python -m benchmarks.http_bench ... --out after.json --baseline before.json
+
+With --baseline the exit status is 1 if any endpoint's p95 latency got worse
+by more than --max-regression (a fraction, default 0.2).
+'''
+import argparse
+import http.client
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from sqlalchemy import select
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from flaskr import create_app
+from flaskr.data_model import Comment, Post, User
+from flaskr.db_alchemy import db_session
+from flaskr.db_seed import seed_bulk, seed_db
+from flaskr.ids import uuid7
+
+# name, method, path, form data, logged in. Paths and data are formatted
+# with the ids picked after seeding, plus for each request {n}, a number not
+# used before, and {doomed}, a row made for it beforehand (see DOOMED). Write
+# routes add rows as they run, like real traffic.
+ENDPOINTS = [
+    ('hello', 'GET', '/hello', None, False),
+    ('auth.register_form', 'GET', '/auth/register', None, False),
+    ('auth.login_form', 'GET', '/auth/login', None, False),
+    ('blog.index', 'GET', '/', None, False),
+    ('blog.index_logged_in', 'GET', '/', None, True),
+    ('blog.index_page_2', 'GET', '/?before={cursor}', None, False),
+    ('blog.create_form', 'GET', '/create', None, True),
+    ('blog.create', 'POST', '/create', {'title': 'Bench post', 'body': 'Bench body'}, True),
+    ('blog.update_form', 'GET', '/{own_post}/update', None, True),
+    ('blog.update', 'POST', '/{own_post}/update', {'title': 'Test Post', 'body': 'Benchmarked'}, True),
+    ('blog.delete', 'POST', '/{doomed}/delete', None, True),
+    ('post.view', 'GET', '/{post}', None, False),
+    ('post.view_logged_in', 'GET', '/{post}', None, True),
+    ('post.comment_page', 'GET', '/{own_post}/comments?after=', None, False),
+    ('post.all_comments', 'GET', '/{own_post}/comments/all', None, False),
+    ('post.thread', 'GET', '/comment/{comment}', None, True),
+    ('post.add_comment', 'POST', '/{post}/comment', {'text': 'Bench comment'}, True),
+    ('post.reply', 'POST', '/reply/{comment}', {'text': 'Bench reply'}, True),
+    ('post.edit_comment', 'POST', '/edit-comment/{comment}', {'text': 'Benchmarked'}, True),
+    ('post.delete_comment', 'POST', '/delete-comment/{doomed}', None, True),
+    # After the other logged in endpoints, as it logs their clients out
+    ('auth.logout', 'GET', '/auth/logout', None, True),
+    ('auth.register', 'POST', '/auth/register', {'username': 'bench{n}', 'password': 'password'}, False),
+    # Last, as it leaves the anonymous clients logged in
+    ('auth.login', 'POST', '/auth/login', {'username': 'admin', 'password': 'password'}, False),
+]
+
+def _doomed_post(admin_id, ids):
+    return Post(id=uuid7(), author_id=admin_id, title='Doomed post', body='To be deleted')
+
+def _doomed_comment(admin_id, ids):
+    return Comment(id=uuid7(), parent_post_id=ids['own_post'], author_id=admin_id,
+                   body='To be deleted')
+
+# Endpoints that delete a row of admin's per request, and how to make one
+DOOMED = {
+    'blog.delete': _doomed_post,
+    'post.delete_comment': _doomed_comment,
+}
+
+_numbers = itertools.count()
+
+def prepare_requests(app, ids, name, path, data, requests):
+    '''
+    The (path, form data) of each of an endpoint's requests, making the rows
+    they delete first so that isn't timed
+    '''
+    values = [dict(ids, n=next(_numbers)) for _ in range(requests)]
+    if name in DOOMED:
+        with app.app_context():
+            admin_id = db_session.scalar(select(User.id).where(User.name == 'admin'))
+            rows = [DOOMED[name](admin_id, ids) for _ in values]
+            db_session.add_all(rows)
+            db_session.commit()
+            for value, row in zip(values, rows):
+                value['doomed'] = row.id
+            db_session.remove()
+    return [(path.format(**value),
+             None if data is None else {key: field.format(**value) for key, field in data.items()})
+            for value in values]
+
+def summarize(latencies, elapsed, errors):
+    '''
+    Throughput and latency percentiles (ms) for one endpoint
+    '''
+    if len(latencies) >= 2:
+        cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+    else:
+        # quantiles needs two samples; a single one is every percentile
+        cuts = [latencies[0] if latencies else 0.0] * 99
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': cuts[49] * 1000,
+        'p95_ms': cuts[94] * 1000,
+        'p99_ms': cuts[98] * 1000,
+    }
+
+def build_app(db_path, scale, hash_method):
+    '''
+    App on a fresh SQLite file seeded at scale (users, posts per user,
+    comments per post). Returns the app and the ids the endpoints need.
+    '''
+    config = {'SQLALCHEMY_URI': 'sqlite:///' + db_path}
+    if hash_method:
+        config['PASSWORD_HASH_METHOD'] = hash_method
+    app = create_app(config)
+
+    with app.app_context():
+        seed_db(db_session)
+        seed_bulk(db_session, *scale)
+        newest = db_session.scalars(select(Post.id).order_by(Post.created.desc(), Post.id.desc())).first()
+        own_post = db_session.scalar(select(Post.id).where(Post.title == 'Test Post'))
+        admin_id = db_session.scalar(select(User.id).where(User.name == 'admin'))
+        # admin's own, to reply to, view the thread of and edit
+        comment = Comment(id=uuid7(), parent_post_id=own_post, author_id=admin_id, body='Bench thread')
+        db_session.add(comment)
+        db_session.commit()
+        ids = {
+            'own_post': own_post,
+            'post': newest,
+            'cursor': newest,
+            'comment': comment.id,
+        }
+        db_session.remove()
+    return app, ids
+
+def bench_test_client(app, ids, requests):
+    '''
+    Runs each endpoint `requests` times in-process, one at a time
+    '''
+    anonymous = app.test_client()
+    logged_in = app.test_client()
+    logged_in.post('/auth/login', data={'username': 'admin', 'password': 'password'})
+
+    results = {}
+    for name, method, path, data, needs_login in ENDPOINTS:
+        client = logged_in if needs_login else anonymous
+        calls = prepare_requests(app, ids, name, path, data, requests)
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for path, data in calls:
+            t0 = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            # Streamed pages are only rendered as they're read
+            response.get_data()
+            latencies.append(time.perf_counter() - t0)
+            errors += response.status_code >= 400
+        results[name] = summarize(latencies, time.perf_counter() - started, errors)
+    return results
+
+class HTTPClient:
+    '''
+    One keep-alive connection with its own session cookie
+    '''
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port)
+        self.cookie = None
+
+    def request(self, method, path, data=None):
+        headers = {}
+        body = None
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        response.read()
+        set_cookie = response.getheader('Set-Cookie')
+        if set_cookie:
+            self.cookie = set_cookie.split(';', 1)[0]
+        return response.status
+
+class QuietHandler(WSGIRequestHandler):
+    '''
+    Keep-alive request handler without the per-request access log
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+def bench_server(app, ids, requests, concurrency):
+    '''
+    Runs each endpoint `requests` times through a threaded WSGI server,
+    spread over `concurrency` concurrent clients
+    '''
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        anonymous = [HTTPClient(server.server_port) for _ in range(concurrency)]
+        logged_in = [HTTPClient(server.server_port) for _ in range(concurrency)]
+        for client in logged_in:
+            client.request('POST', '/auth/login', {'username': 'admin', 'password': 'password'})
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for name, method, path, data, needs_login in ENDPOINTS:
+                clients = logged_in if needs_login else anonymous
+                calls = prepare_requests(app, ids, name, path, data, requests)
+
+                def worker(client, calls):
+                    latencies, errors = [], 0
+                    for path, data in calls:
+                        t0 = time.perf_counter()
+                        status = client.request(method, path, data)
+                        latencies.append(time.perf_counter() - t0)
+                        errors += status >= 400
+                    return latencies, errors
+
+                shares = [calls[i::concurrency] for i in range(concurrency)]
+                started = time.perf_counter()
+                outcomes = list(pool.map(worker, clients, shares))
+                elapsed = time.perf_counter() - started
+                results[name] = summarize([l for lat, _ in outcomes for l in lat], elapsed,
+                                          sum(errors for _, errors in outcomes))
+    finally:
+        server.shutdown()
+        thread.join()
+    return results
+
+def run_benchmark(users, posts_per_user, comments_per_post, requests=200, concurrency=8,
+                  hash_method=None, modes=('test_client', 'server')):
+    '''
+    Seeds a temporary database and benchmarks every endpoint in each mode
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        app, ids = build_app(os.path.join(tmp, 'bench.sqlite'),
+                             (users, posts_per_user, comments_per_post), hash_method)
+        results = {}
+        if 'test_client' in modes:
+            results['test_client'] = bench_test_client(app, ids, requests)
+        if 'server' in modes:
+            results['server'] = bench_server(app, ids, requests, concurrency)
+        app.extensions['password_hasher'].close()
+        engine = db_session.bind
+        db_session.remove()
+        engine.dispose()
+
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'users': users,
+            'posts_per_user': posts_per_user,
+            'comments_per_post': comments_per_post,
+            'requests': requests,
+            'concurrency': concurrency,
+            'hash_method': app.config['PASSWORD_HASH_METHOD'],
+        },
+        'results': results,
+    }
+
+def compare(baseline, current, max_regression):
+    '''
+    Prints p95/throughput changes against a baseline run. Returns the
+    (mode, endpoint) pairs whose p95 regressed by more than max_regression.
+    '''
+    regressions = []
+    for mode, endpoints in current['results'].items():
+        for name, stats in endpoints.items():
+            before = baseline['results'].get(mode, {}).get(name)
+            if before is None:
+                continue
+            change = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms']
+            print(f"{mode:12} {name:24} p95 {before['p95_ms']:8.2f} -> {stats['p95_ms']:8.2f} ms "
+                  f"({change:+.0%})  rps {before['throughput_rps']:8.1f} -> {stats['throughput_rps']:8.1f}")
+            if change > max_regression:
+                regressions.append((mode, name))
+    return regressions
+
+def print_report(report):
+    for mode, endpoints in report['results'].items():
+        print(f'\n{mode}')
+        print(f"{'endpoint':24} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+        for name, stats in endpoints.items():
+            print(f"{name:24} {stats['throughput_rps']:9.1f} {stats['p50_ms']:9.2f} "
+                  f"{stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f} {stats['errors']:7}")
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _positive(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {value}')
+    return number
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts-per-user', type=int, default=10)
+    parser.add_argument('--comments-per-post', type=int, default=5)
+    parser.add_argument('--requests', type=_positive, default=200, help='requests per endpoint and mode')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients against the server')
+    parser.add_argument('--hash-method', help='override PASSWORD_HASH_METHOD')
+    parser.add_argument('--mode', choices=('test_client', 'server'), action='append',
+                        help='run only this mode (repeatable)')
+    parser.add_argument('--out', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare with')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.users, args.posts_per_user, args.comments_per_post,
+                           requests=args.requests, concurrency=args.concurrency,
+                           hash_method=args.hash_method,
+                           modes=args.mode or ('test_client', 'server'))
+    print_report(report)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(baseline, report, args.max_regression)
+        if regressions:
+            print('\np95 regressions: ' + ', '.join(f'{mode}:{name}' for mode, name in regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
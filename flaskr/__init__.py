@@ -14,10 +14,89 @@ def create_app(test_config=None):
         SECRET_KEY = 'DEV',
         DATABASE = os.path.join(app.instance_path, 'flaskr.sqlite'),
         SQLALCHEMY_URI = 'sqlite:///' + os.path.join(app.instance_path, 'flaskr.sqlite'),
+        POSTS_PER_PAGE = 20,
+        # Characters of each body shown on the feed, the rest only on the post page
+        FEED_PREVIEW_CHARS = 300,
+        # Applied to every new SQLite connection. WAL lets readers run alongside
+        # the writer and busy_timeout (ms) waits on the lock instead of erroring.
+        SQLITE_PRAGMAS = {
+            'journal_mode': 'WAL',
+            'busy_timeout': 5000,
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64000, # negative is KiB, so ~64MB
+        },
+        # Pool tuning for server backends; None keeps SQLAlchemy's default
+        SQLALCHEMY_POOL_SIZE = None,
+        SQLALCHEMY_MAX_OVERFLOW = None,
+        SQLALCHEMY_POOL_PRE_PING = None,
+        SQLALCHEMY_POOL_RECYCLE = None,
+        SQLALCHEMY_POOL_TIMEOUT = None,
+        # Read replicas for read_only views; empty sends everything to the primary
+        SQLALCHEMY_REPLICA_URIS = [],
+        DB_REPLICA_PIN_SECONDS = 5,
+        # Shared cache client (e.g. redis.Redis()); None uses in-process LRU caches
+        CACHE_CLIENT = None,
+        USER_CACHE_SIZE = 10000,
+        USER_CACHE_TTL = 300,
+        FRAGMENT_CACHE_SIZE = 5000,
+        FRAGMENT_CACHE_TTL = 3600,
+        # Posts by id. Commits drop the entries they change; entries cached
+        # in other workers' processes (no CACHE_CLIENT) can lag up to the TTL.
+        POST_CACHE_SIZE = 10000,
+        POST_CACHE_TTL = 10,
+        # Werkzeug hash method with its cost, e.g. 'scrypt:32768:8:1' or
+        # 'pbkdf2:sha256:600000'. Old hashes are upgraded on login.
+        PASSWORD_HASH_METHOD = 'scrypt',
+        PASSWORD_HASH_WORKERS = 2,
+        PASSWORD_HASH_QUEUE = 16,
+        PASSWORD_HASH_TIMEOUT = 10,
+        # Per request SQL/template timing, Server-Timing headers and /debug
+        DEBUG_INSTRUMENTATION = False,
+        DEBUG_SLOW_QUERIES = 20,
+        # Prometheus metrics at /metrics, off unless asked for. With a token
+        # scrapes must send it as 'Authorization: Bearer <token>'.
+        METRICS_ENABLED = False,
+        METRICS_TOKEN = None,
+        SEARCH_RESULTS_PER_PAGE = 20,
+        # Deepest reply allowed, top level comments are depth 0
+        COMMENT_MAX_DEPTH = 8,
+        # Comments on the post page before "Load more", and rows the full
+        # thread view holds in memory at a time
+        COMMENT_PAGE_SIZE = 200,
+        COMMENT_STREAM_BATCH = 500,
+        # Write-behind for comments: a background thread writes them in
+        # batches. See write_behind.DURABILITY for 'queued' vs 'committed'.
+        # Authors see their queued comments only on the worker that took them.
+        COMMENT_WRITE_BEHIND = False,
+        COMMENT_DURABILITY = 'queued',
+        COMMENT_QUEUE_SIZE = 1000,
+        COMMENT_BATCH_SIZE = 100,
+        COMMENT_BATCH_LINGER = 0.01, # seconds to wait for more comments to batch
+        COMMENT_QUEUE_TIMEOUT = 2,
+        # Live comment streams. EVENTS_CLIENT (e.g. redis.Redis()) shares them
+        # between workers; None keeps them within the process.
+        EVENTS_CLIENT = None,
+        EVENTS_BACKLOG = 100, # messages kept for a subscriber that falls behind
+        EVENTS_KEEPALIVE = 15,
+        # Where pages open live comment streams, an event_server.EventServer
+        # (e.g. 'http://localhost:8001'). None streams from the post.events
+        # view, which holds a server thread for each open stream, so caps them
+        # per process at EVENTS_MAX_SUBSCRIBERS, well under a worker's threads.
+        EVENTS_URL = None,
+        EVENTS_MAX_SUBSCRIBERS = 8,
+        EVENTS_SERVER_MAX_CLIENTS = 10000,
+        # Serving from several workers needs EVENTS_CLIENT and CACHE_CLIENT,
+        # True serves without them anyway, see prefork.check_workers
+        PREFORK_ALLOW_LOCAL_STATE = False,
+        # Most ids or comments a JSON API batch request may carry
+        API_BATCH_LIMIT = 100,
     )
 
     if test_config is None:
         app.config.from_pyfile('config.py', silent=True)
+        # Then FLASK_<KEY> environment variables, e.g. FLASK_SQLALCHEMY_URI
+        app.config.from_prefixed_env()
     else:
         app.config.from_mapping(test_config)
     
@@ -34,22 +113,61 @@ def create_app(test_config=None):
     from . import db_alchemy
     db_alchemy.init_app(app)
 
+    from . import passwords
+    passwords.init_app(app)
+
+    from . import events
+    events.init_app(app)
+
+    from . import event_server
+    event_server.init_app(app)
+
+    from . import post_cache
+    post_cache.init_app(app)
+
+    from . import write_behind
+    write_behind.init_app(app)
+
+    from . import fragments
+    fragments.init_app(app)
+
+    from . import markdown
+    markdown.init_app(app)
+
     from . import db_seed
     db_seed.init_seed_command(app)
 
     from . import auth
     app.register_blueprint(auth.bp)
+    auth.init_user_cache(app)
 
     from . import blog
     app.register_blueprint(blog.bp)
     app.add_url_rule('/', endpoint='index')
+    blog.init_blog_commands(app)
 
     from . import debug
     app.register_blueprint(debug.bp)
+    debug.init_app(app)
     app.add_url_rule('/debug', endpoint='debug')
 
     from . import post
     app.register_blueprint(post.bp)
+    post.init_post_commands(app)
+
+    from . import api
+    app.register_blueprint(api.bp)
+
+    from . import search
+    app.register_blueprint(search.bp)
+    search.init_search_command(app)
+
+    from . import metrics
+    app.register_blueprint(metrics.bp)
+    metrics.init_app(app)
+
+    from . import prefork
+    prefork.init_app(app)
 
     from flaskr.db_alchemy import db_session
     @app.teardown_appcontext
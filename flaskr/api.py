@@ -0,0 +1,308 @@
+import functools
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import (
+    Blueprint, current_app, g, jsonify, request, url_for
+)
+from sqlalchemy import select
+from werkzeug.exceptions import HTTPException, abort
+
+from .blog import FEED_SORTS, _parse_cursor, delete_post, feed_page, set_post_body, touch_post
+from .db_alchemy import db_session, read_only
+from .data_model import User, Post, Comment, comment_path
+from .events import publish_comment
+from .ids import uuid7
+from .markdown import render_markdown
+from .post import COMMENT_CURSOR
+from .read_models import comment_depth
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Columns the API exposes. Rows are selected column by column rather than as
+# ORM objects, so nothing else (User.password included) is ever loaded.
+POST_FIELDS = (
+    Post.id, Post.title, Post.body, Post.body_html, Post.created, Post.modified, Post.version,
+    Post.comment_count, Post.last_activity_at, Post.author_id,
+    User.name.label('author_name'),
+)
+COMMENT_FIELDS = (
+    Comment.id, Comment.parent_post_id.label('post_id'), Comment.parent_id,
+    comment_depth.label('depth'), Comment.body, Comment.body_html, Comment.created,
+    Comment.author_id, User.name.label('author_name'),
+)
+
+def select_posts():
+    return select(*POST_FIELDS).join(User, Post.author_id == User.id)
+
+def select_comments():
+    return select(*COMMENT_FIELDS).join(User, Comment.author_id == User.id)
+
+def to_dict(row):
+    '''
+    A selected row as a JSON ready dict. Datetimes become ISO 8601, uuids are
+    handled by the JSON provider.
+    '''
+    return {key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in row._mapping.items()}
+
+@bp.errorhandler(HTTPException)
+def json_error(error):
+    '''
+    Errors from API views as JSON rather than HTML pages
+    '''
+    return jsonify(error=error.description), error.code
+
+def api_login_required(view):
+    '''
+    Like auth.login_required, but answers 401 instead of redirecting to the
+    log in page. Clients log in through /auth/login and send the cookie.
+    '''
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        if g.user is None:
+            abort(401, 'Log in required.')
+        return view(**kwargs)
+
+    return wrapped_view
+
+def _parse_id(value, status=404):
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        abort(status, f"Invalid id {value}.")
+
+def _json_body():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, 'Expected a JSON object.')
+    return data
+
+def _text(data, key, required=True):
+    value = data.get(key, '')
+    if not isinstance(value, str) or (required and not value):
+        abort(400, f'{key} is required.')
+    return value
+
+def _optional_id(data, key):
+    value = data.get(key)
+    return None if value is None else _parse_id(value, 400)
+
+def _assign_paths(comments):
+    '''
+    Sets the materialized path of new comments, looking up all their parents
+    in one query. A parent must be on the same post and within
+    COMMENT_MAX_DEPTH, else 400.
+    '''
+    parent_ids = {comment.parent_id for comment in comments if comment.parent_id is not None}
+    parents = {}
+    if parent_ids:
+        stmt = select(Comment.id, Comment.parent_post_id, Comment.path, comment_depth.label('depth'))\
+                   .where(Comment.id.in_(parent_ids))
+        parents = {row.id: row for row in db_session.execute(stmt)}
+
+    for comment in comments:
+        if comment.parent_id is None:
+            comment.path = comment_path(comment.id)
+            continue
+        parent = parents.get(comment.parent_id)
+        if parent is None or parent.parent_post_id != comment.parent_post_id or parent.path is None:
+            abort(400, f"Can't reply to comment {comment.parent_id} on post {comment.parent_post_id}.")
+        if parent.depth + 1 > current_app.config['COMMENT_MAX_DEPTH']:
+            abort(400, f"Comment {comment.parent_id} is too deeply nested to reply to.")
+        comment.path = comment_path(comment.id, parent.path)
+
+def _load_post(post_id):
+    row = db_session.execute(select_posts().where(Post.id == post_id)).first()
+    if row is None:
+        abort(404, f"Post id {post_id} doesn't exist.")
+    return row
+
+def _own_post(id):
+    '''
+    The ORM post for a write, 404 if missing and 403 if not the user's
+    '''
+    post = db_session.get(Post, _parse_id(id))
+    if post is None:
+        abort(404, f"Post id {id} doesn't exist.")
+    if post.author_id != g.user.id:
+        abort(403)
+    return post
+
+@bp.route('/posts')
+@read_only
+def feed():
+    '''
+    One page of the feed, same ordering and cursors as blog.index:
+    ?sort=new|active, ?before=<post id>, ?after=<post id>
+    '''
+    sort = request.args.get('sort', 'new')
+    if sort not in FEED_SORTS:
+        abort(400, f"Unknown sort {sort}.")
+    page, has_newer, has_older = feed_page(
+        select_posts(), sort,
+        _parse_cursor(request.args.get('before')), _parse_cursor(request.args.get('after')),
+        current_app.config['POSTS_PER_PAGE'])
+
+    return jsonify(
+        posts=[to_dict(row) for row in page],
+        newer=page[0].id if has_newer and page else None,
+        older=page[-1].id if has_older and page else None,
+    )
+
+@bp.route('/posts/batch')
+@read_only
+def posts_batch():
+    '''
+    Many posts by id in one query: ?id=<post id>&id=... Posts come back in
+    the order asked for; ids that don't exist are listed under missing.
+    '''
+    ids = [_parse_id(value, 400) for value in request.args.getlist('id')]
+    if len(ids) > current_app.config['API_BATCH_LIMIT']:
+        abort(400, f"At most {current_app.config['API_BATCH_LIMIT']} ids per request.")
+
+    rows = db_session.execute(select_posts().where(Post.id.in_(ids))).all() if ids else []
+    by_id = {row.id: row for row in rows}
+    return jsonify(posts=[to_dict(by_id[post_id]) for post_id in ids if post_id in by_id],
+                   missing=[post_id for post_id in ids if post_id not in by_id])
+
+@bp.route('/posts/<string:id>')
+@read_only
+def view(id):
+    '''
+    A post with a page of COMMENT_PAGE_SIZE comments in thread order, two
+    queries however long the thread is. Pages follow on like the post
+    page's: next is the cursor to pass as ?after= for the following page,
+    null on the last.
+    '''
+    after = request.args.get('after')
+    if after is not None and not COMMENT_CURSOR.fullmatch(after):
+        abort(400, 'after must be a comment path.')
+    page_size = current_app.config['COMMENT_PAGE_SIZE']
+
+    post = to_dict(_load_post(_parse_id(id)))
+    stmt = select_comments().add_columns(Comment.path).where(Comment.parent_post_id == post['id'])
+    if after is not None:
+        stmt = stmt.where(Comment.path > after)
+    stmt = stmt.order_by(Comment.path, Comment.created, Comment.id).limit(page_size + 1)
+    rows = db_session.execute(stmt).all()
+
+    post['comments'] = [to_dict(row) for row in rows[:page_size]]
+    for comment in post['comments']:
+        del comment['path']
+    # Comments without a path sort first, so carry on from the start
+    post['next'] = rows[page_size - 1].path or '' if len(rows) > page_size else None
+    return jsonify(post)
+
+@bp.route('/posts', methods=('POST',))
+@api_login_required
+def create():
+    '''
+    Creates a post from {"title": ..., "body": ...}
+    '''
+    data = _json_body()
+    post = Post(id=uuid7(), author_id=g.user.id, title=_text(data, 'title'))
+    set_post_body(post, _text(data, 'body', required=False))
+    db_session.add(post)
+    db_session.commit()
+
+    response = jsonify(to_dict(_load_post(post.id)))
+    response.status_code = 201
+    response.headers['Location'] = url_for('api.view', id=post.id)
+    return response
+
+@bp.route('/posts/<string:id>', methods=('PATCH',))
+@api_login_required
+def update(id):
+    '''
+    Changes the title and/or body of one of the user's posts
+    '''
+    post = _own_post(id)
+    data = _json_body()
+    if 'title' in data:
+        post.title = _text(data, 'title')
+    if 'body' in data:
+        set_post_body(post, _text(data, 'body', required=False))
+    touch_post(post.id)
+    db_session.commit()
+    return jsonify(to_dict(_load_post(post.id)))
+
+@bp.route('/posts/<string:id>', methods=('DELETE',))
+@api_login_required
+def delete(id):
+    '''
+    Deletes one of the user's posts
+    '''
+    delete_post(_own_post(id))
+    db_session.commit()
+    return '', 204
+
+@bp.route('/posts/<string:id>/comments', methods=('POST',))
+@api_login_required
+def add_comment(id):
+    '''
+    Adds a comment from {"body": ...} to a post, or a reply to one of its
+    comments with "parent_id" as well
+    '''
+    post_id = _parse_id(id)
+    if db_session.scalar(select(Post.id).where(Post.id == post_id)) is None:
+        abort(404, f"Post id {id} doesn't exist.")
+
+    data = _json_body()
+    body = _text(data, 'body')
+    comment = Comment(id=uuid7(), parent_post_id=post_id, author_id=g.user.id, body=body,
+                      body_html=render_markdown(body), parent_id=_optional_id(data, 'parent_id'))
+    _assign_paths([comment])
+    db_session.add(comment)
+    touch_post(post_id, comment_delta=1)
+    db_session.commit()
+
+    row = db_session.execute(select_comments().where(Comment.id == comment.id)).one()
+    publish_comment(current_app.extensions['events'], post_id, row)
+    return jsonify(to_dict(row)), 201
+
+@bp.route('/comments/batch', methods=('POST',))
+@api_login_required
+def comments_batch():
+    '''
+    Adds many comments in one transaction from
+    {"comments": [{"post_id": ..., "body": ..., "parent_id": optional}, ...]}.
+    Either all of them are written or, if any is invalid or its post or
+    parent is missing, none are.
+    '''
+    items = _json_body().get('comments')
+    if not isinstance(items, list) or not items:
+        abort(400, 'comments must be a non-empty list.')
+    if len(items) > current_app.config['API_BATCH_LIMIT']:
+        abort(400, f"At most {current_app.config['API_BATCH_LIMIT']} comments per request.")
+
+    comments = []
+    for item in items:
+        if not isinstance(item, dict):
+            abort(400, 'Each comment must be a JSON object.')
+        body = _text(item, 'body')
+        comments.append(Comment(id=uuid7(), parent_post_id=_parse_id(item.get('post_id'), 400),
+                                author_id=g.user.id, body=body, body_html=render_markdown(body),
+                                parent_id=_optional_id(item, 'parent_id')))
+
+    per_post = Counter(comment.parent_post_id for comment in comments)
+    found = set(db_session.scalars(select(Post.id).where(Post.id.in_(per_post))))
+    missing = [post_id for post_id in per_post if post_id not in found]
+    if missing:
+        abort(400, f"Posts don't exist: {', '.join(str(post_id) for post_id in missing)}")
+    _assign_paths(comments)
+
+    db_session.add_all(comments)
+    for post_id, count in per_post.items():
+        touch_post(post_id, comment_delta=count)
+    db_session.commit()
+
+    # Announced like comments made on the post page, in the order sent
+    ids = [comment.id for comment in comments]
+    rows = {row.id: row for row in db_session.execute(select_comments().where(Comment.id.in_(ids)))}
+    events = current_app.extensions['events']
+    for comment_id in ids:
+        publish_comment(events, rows[comment_id].post_id, rows[comment_id])
+
+    return jsonify(comments=ids), 201
@@ -1,17 +1,57 @@
 import functools
+from collections import namedtuple
+from itertools import chain
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, has_app_context, redirect,
+    render_template, request, session, url_for
 )
-from werkzeug.security import check_password_hash, generate_password_hash
-
-from flaskr.db_alchemy import db_session
+from flaskr.cache import make_cache
+from flaskr.db_alchemy import db_session, replica_reads
 from flaskr.data_model import User
-from sqlalchemy import select
+from flaskr.passwords import hash_password
+from sqlalchemy import event, select
 from sqlalchemy.exc import IntegrityError
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+# What g.user holds: just enough to identify the user, never the password hash
+CurrentUser = namedtuple('CurrentUser', ['id', 'name'])
+
+def init_user_cache(app):
+    '''
+    Sets up the cache of logged in users, keyed by user id
+    '''
+    app.extensions['user_cache'] = make_cache(app.config, 'user',
+                                              maxsize=app.config['USER_CACHE_SIZE'],
+                                              ttl=app.config['USER_CACHE_TTL'])
+
+# session.info key for the users to drop from the cache on commit
+CHANGED_USERS = 'user_cache_pending'
+
+@event.listens_for(db_session, 'after_flush')
+def _note_flushed_users(session, flush_context):
+    changed = [obj.id for obj in chain(session.dirty, session.deleted) if isinstance(obj, User)]
+    if changed:
+        session.info.setdefault(CHANGED_USERS, set()).update(changed)
+
+@event.listens_for(db_session, 'after_commit')
+def invalidate_cached_users(session):
+    '''
+    Drops users from the cache once changes to their rows are committed.
+    Dropping them at flush would let a concurrent request cache the old row
+    again before the commit lands.
+    '''
+    changed = session.info.pop(CHANGED_USERS, None)
+    if changed and has_app_context() and 'user_cache' in current_app.extensions:
+        for user_id in changed:
+            current_app.extensions['user_cache'].delete(str(user_id))
+
+@event.listens_for(db_session, 'after_transaction_end')
+def _forget_rolled_back_users(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(CHANGED_USERS, None)
+
 @bp.route('/register', methods=('GET', 'POST'))
 def register():
     '''
@@ -31,7 +71,7 @@ def register():
 
         if error is None:
             try:
-                new_user = User(name=username, password=generate_password_hash(password))
+                new_user = User(name=username, password=hash_password(password))
                 db_session.add(new_user)
                 db_session.commit()
             except IntegrityError:
@@ -61,12 +101,18 @@ def login():
         stmt = select(User).where(User.name == username)
         user = db_session.scalars(stmt).first()
 
+        hasher = current_app.extensions['password_hasher']
         if user is None:
             error = 'Incorrect username.'
-        elif not check_password_hash(user.password, password):
+        elif not hasher.check(user.password, password):
             error = 'Incorrect password.'
 
         if error is None:
+            # Upgrade hashes made with older settings while we have the password
+            if hasher.needs_rehash(user.password):
+                user.password = hasher.hash(password)
+                db_session.commit()
+
             session.clear()
             session['user_id'] = user.id # Session will persist data in cookie
             return redirect(url_for('index'))
@@ -79,15 +125,26 @@ def login():
 @bp.before_app_request
 def load_logged_in_user():
     '''
-    Fetches user details from db before loading a request
+    Fetches user details before loading a request, from the user cache when
+    possible. Static files don't need a user so skip them entirely.
     '''
-    user_id = session.get('user_id')
+    g.user = None
+    if request.endpoint is not None and request.endpoint.rsplit('.', 1)[-1] == 'static':
+        return
 
+    user_id = session.get('user_id')
     if user_id is None:
-        g.user = None
-    else:
-        stmt = select(User).where(User.id == user_id)
-        g.user = db_session.scalars(stmt).first() # g is good only for the request? Ok not to strip password? TODO double check.
+        return
+
+    user_cache = current_app.extensions['user_cache']
+    g.user = user_cache.get(str(user_id))
+    if g.user is None:
+        stmt = select(User.id, User.name).where(User.id == user_id)
+        with replica_reads():
+            row = db_session.execute(stmt).first()
+        if row is not None:
+            g.user = CurrentUser(*row)
+            user_cache.set(str(user_id), g.user)
 
 @bp.route('/logout')
 def logout():
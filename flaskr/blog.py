@@ -1,28 +1,113 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, url_for
 )
 import uuid
+import click
 from werkzeug.exceptions import abort
 from flaskr.auth import login_required
-from .db_alchemy import db_session
-from .data_model import User, Post
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
+from .conditional import add_validators, make_etag, not_modified
+from .db_alchemy import db_session, read_only
+from .data_model import User, Post, Comment
+from .markdown import render_post
+from .post_cache import cached_post
+from .read_models import feed_posts
+from sqlalchemy import delete as sql_delete, func, literal, select, tuple_, update as sql_update
 
 bp = Blueprint("blog", __name__)
 
+# Feed orderings, ?sort= picks one. Each has an index on (column, id).
+FEED_SORTS = {
+    'new': Post.created,
+    'active': Post.last_activity_at,
+}
+
 @bp.route('/')
+@read_only
 def index():
     '''
-    Homepage to display posts
+    Homepage to display posts, newest first or with ?sort=active most recently
+    commented first. Paged with a keyset cursor on (sort column, id):
+    ?before=<post id> gives the next page of older posts and ?after=<post id>
+    the previous page of newer ones, so every page costs the same no matter
+    how deep the reader scrolls.
+    The page's ids and versions come from the index first, which is enough to
+    answer a conditional GET with 304 before loading any posts.
+    '''
+    page_size = current_app.config['POSTS_PER_PAGE']
+    sort = request.args.get('sort', 'new')
+    if sort not in FEED_SORTS:
+        abort(400, f"Unknown sort {sort}.")
+    before = _parse_cursor(request.args.get('before'))
+    after = _parse_cursor(request.args.get('after'))
+
+    page, has_newer, has_older = feed_page(select(Post.id, Post.version), sort,
+                                           before, after, page_size)
+
+    # Ids and versions cover edits, comments and deletes on this page
+    etag = make_etag('feed', sort, tuple(page), has_newer, has_older)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    # Only the columns the feed shows, with a preview rather than the body
+    post_list = feed_posts([row.id for row in page], current_app.config['FEED_PREVIEW_CHARS'])
+
+    response = render_template('blog/index.html', posts=post_list, sort=sort,
+                               newer=post_list[0].id if has_newer and post_list else None,
+                               older=post_list[-1].id if has_older and post_list else None)
+    return add_validators(response, etag)
+
+def feed_page(stmt, sort, before, after, page_size):
+    '''
+    Runs a select of post columns (must include Post.id) as one feed page:
+    ordered by sort, starting at the before/after cursor. Returns the rows
+    newest first with whether newer and older pages exist. A cursor naming
+    a post that's since been deleted gives the first page.
     '''
+    column = FEED_SORTS[sort]
+    first_page = stmt
+    if after is not None:
+        stmt = stmt.where(tuple_(column, Post.id) > _cursor_key(column, after))\
+                   .order_by(column.asc(), Post.id.asc())
+    else:
+        if before is not None:
+            stmt = stmt.where(tuple_(column, Post.id) < _cursor_key(column, before))
+        stmt = stmt.order_by(column.desc(), Post.id.desc())
 
-    # Use select() with joinedload to eagerly load the related User objects,
-    # reducing queries downstream
-    stmt = select(Post).options(joinedload(Post.author)).order_by(Post.created.desc())
-    post_list = db_session.scalars(stmt).all()
+    # Fetch one extra row to know whether another page exists
+    page = db_session.execute(stmt.limit(page_size + 1)).all()
+    cursor = after if after is not None else before
+    if not page and cursor is not None \
+            and db_session.scalar(select(Post.id).where(Post.id == cursor)) is None:
+        # Its sort value would compare as NULL and match nothing
+        return feed_page(first_page, sort, None, None, page_size)
+    has_more = len(page) > page_size
+    page = page[:page_size]
 
-    return render_template('blog/index.html', posts=post_list)
+    if after is not None:
+        page.reverse()
+        return page, has_more, True
+    return page, before is not None, has_more
+
+def _parse_cursor(value):
+    '''
+    Turns a cursor query arg into a post id. Returns 400 if it isn't a uuid.
+    '''
+    if value is None:
+        return None
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        abort(400, f"Invalid page cursor {value}.")
+
+def _cursor_key(column, post_id):
+    '''
+    Row value for the cursor post. The sort value is read back from the db
+    rather than round-tripped through the url so it compares exactly against
+    the stored value, and the lookup is a single primary key hit.
+    '''
+    value = select(column).where(Post.id == post_id).scalar_subquery()
+    return tuple_(value, literal(post_id, Post.id.type))
 
 @bp.route('/create', methods=("GET", "POST"))
 @login_required
@@ -40,7 +125,8 @@ def create():
         if error is not None:
             flash(error)
         else:
-            new_post = Post(title=title, body=body, author_id=g.user.id)
+            new_post = Post(title=title, author_id=g.user.id)
+            set_post_body(new_post, body)
             db_session.add(new_post)
             db_session.commit()
 
@@ -48,15 +134,86 @@ def create():
         
     return render_template('blog/create.html')
 
-def get_post(id, check_author=True):
+def set_post_body(post, body):
     '''
-    Fetches a post from the db by id. Returns 404 if not found. 
-    Defaults to verifying that the requester is also the creator. Returns 403
-    if the requester is not the creator.
+    Sets a post's body along with its HTML and feed preview, rendered here
+    once rather than on every view
     '''
+    post.body = body
+    post.body_html, post.preview_html = render_post(body, current_app.config['FEED_PREVIEW_CHARS'])
 
-    stmt = select(Post).where(Post.id == uuid.UUID(id))
-    post = db_session.scalars(stmt).first()
+def touch_post(post_id, comment_delta=0):
+    '''
+    Bumps a post's version and modified time so cached renders of it, ours
+    and clients', are no longer used. Call in the same transaction as any
+    write to the post or its comments; comment_delta (+1/-1) also keeps
+    comment_count and last_activity_at current.
+    '''
+    values = {'version': Post.version + 1, 'modified': func.now()}
+    if comment_delta > 0:
+        values['comment_count'] = Post.comment_count + comment_delta
+        values['last_activity_at'] = func.now()
+    elif comment_delta < 0:
+        values['comment_count'] = Post.comment_count + comment_delta
+        values['last_activity_at'] = _last_activity(Post)
+    stmt = sql_update(Post).where(Post.id == post_id).values(**values)
+    db_session.execute(stmt, execution_options={'post_ids': [post_id]})
+
+def _last_activity(post):
+    '''
+    SQL for a post's newest activity: its latest comment, else its creation.
+    Served by the (parent_post_id, created) comment index.
+    '''
+    newest_comment = select(func.max(Comment.created))\
+                         .where(Comment.parent_post_id == post.id).scalar_subquery()
+    return func.coalesce(newest_comment, post.created)
+
+def repair_post_counters(session):
+    '''
+    Recomputes comment_count and last_activity_at for every post in one
+    statement, e.g. after bulk loads or an upgrade-db that added the columns.
+    Versions are bumped too, so cached renders pick up the new numbers.
+    '''
+    comment_count = select(func.count(Comment.id))\
+                        .where(Comment.parent_post_id == Post.id).scalar_subquery()
+    stmt = sql_update(Post).values(comment_count=comment_count,
+                                   last_activity_at=_last_activity(Post),
+                                   version=Post.version + 1)
+    result = session.execute(stmt, execution_options={'synchronize_session': False})
+    session.commit()
+    return result.rowcount
+
+@click.command('repair-counters')
+def repair_counters_command():
+    '''
+    Define cmdline arg to recompute the denormalized post counters.
+    '''
+    count = repair_post_counters(db_session)
+    click.echo(f'Repaired counters on {count} posts.')
+
+def init_blog_commands(app):
+    app.cli.add_command(repair_counters_command)
+
+def delete_post(post):
+    '''
+    Deletes a post along with its comments. The comments go in one statement
+    first; left to the ORM they'd be loaded and orphaned one by one, which
+    fails as parent_post_id can't be null.
+    '''
+    db_session.execute(sql_delete(Comment).where(Comment.parent_post_id == post.id),
+                       execution_options={'synchronize_session': False})
+    db_session.delete(post)
+
+def get_post(id, check_author=True, load=True):
+    '''
+    Fetches a post by id. Returns 404 if not found. 
+    Defaults to verifying that the requester is also the creator. Returns 403
+    if the requester is not the creator. Both are checked against the post
+    cache, so refusals cost no query. With load the post is then read from
+    the db as an ORM Post to change, else the cached post is returned.
+    '''
+    post_id = uuid.UUID(id)
+    post = cached_post(current_app.extensions['post_cache'], post_id)
 
     if post is None:
         abort(404, f"Post id {id} doesn't exist.")
@@ -64,15 +221,20 @@ def get_post(id, check_author=True):
     if check_author and post.author_id != g.user.id:
         abort(403)
 
+    if load:
+        post = db_session.get(Post, post_id)
+        if post is None: # Deleted since it was cached
+            abort(404, f"Post id {id} doesn't exist.")
+
     return post
 
 @bp.route('/<string:id>/update', methods=('GET', 'POST'))
 @login_required
 def update(id):
     '''
-    Updates a post for a user
+    Updates a post for a user. The form is filled from the post cache.
     '''
-    post = get_post(id)
+    post = get_post(id, load=request.method == 'POST')
 
     # 
     if request.method == 'POST':
@@ -88,7 +250,8 @@ def update(id):
         else:
             # Modify the existing Post object
             post.title = title
-            post.body = body
+            set_post_body(post, body)
+            touch_post(post.id)
 
             # Commit the session to persist changes
             db_session.commit()
@@ -111,7 +274,8 @@ def delete(id):
     # if post.author_id != g.user.id:
     #     abort(403)
 
-    # Delete the post from the database
-    db_session.delete(post)
+    # Delete the post from the database. No version bump needed, its cached
+    # renders are never looked up again and age out of the cache.
+    delete_post(post)
     db_session.commit()
     return redirect(url_for('blog.index'))
\ No newline at end of file
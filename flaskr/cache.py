@@ -0,0 +1,109 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+class CacheBackend:
+    '''
+    Interface for the app's caches. Values must be picklable so any backend
+    can be swapped in. ttl is in seconds, None meaning the backend default.
+    '''
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+class LRUCache(CacheBackend):
+    '''
+    In-process cache bounded to maxsize entries, evicting the least recently
+    used. Expired entries are dropped lazily when read. Only shared between
+    threads of one worker, so invalidations don't reach other processes;
+    the ttl bounds how stale those can get.
+    '''
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SharedCache(CacheBackend):
+    '''
+    Adapter for a cache shared between workers. client is anything with
+    redis-py style get(key), set(key, value, ex=seconds) and delete(key),
+    e.g. redis.Redis(); values are pickled. Keys are namespaced with prefix.
+    '''
+    def __init__(self, client, prefix='flaskr:', ttl=300):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value),
+                        ex=self.ttl if ttl is None else ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        # Shared stores are cleared by their owners, not per worker
+        pass
+
+def make_cache(config, prefix, maxsize, ttl):
+    '''
+    Builds a cache for one use. Shared when config has a CACHE_CLIENT,
+    otherwise in-process LRU.
+    '''
+    client = config.get('CACHE_CLIENT')
+    if client is not None:
+        return SharedCache(client, prefix=f'flaskr:{prefix}:', ttl=ttl)
+    return LRUCache(maxsize=maxsize, ttl=ttl)
@@ -0,0 +1,50 @@
+import hashlib
+
+from flask import g, make_response, request, session
+
+def make_etag(*parts):
+    '''
+    Builds an ETag from whatever identifies a version of a page. The current
+    user is always mixed in as pages differ per user (nav, Edit links).
+    '''
+    user_id = g.user.id if g.get('user') else None
+    return hashlib.blake2b(repr((user_id,) + parts).encode(), digest_size=16).hexdigest()
+
+def _anonymous(last_modified):
+    # A date can't tell one user's copy from another's, unlike the ETag, so
+    # it's only offered and honoured for anonymous requests
+    return None if g.get('user') else last_modified
+
+def not_modified(etag, last_modified=None):
+    '''
+    Returns a 304 response if the client's copy is current, else None. Call
+    before loading or rendering the page. Never answers 304 while flashed
+    messages are waiting, as the client's copy wouldn't show them.
+    '''
+    if '_flashes' in session:
+        return None
+
+    last_modified = _anonymous(last_modified)
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified is not None:
+        fresh = last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+    return add_validators(make_response('', 304), etag, last_modified)
+
+def add_validators(response, etag, last_modified=None):
+    '''
+    Sets the validators on a response and asks clients to revalidate each time
+    '''
+    response = make_response(response)
+    response.set_etag(etag)
+    last_modified = _anonymous(last_modified)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
@@ -1,14 +1,15 @@
 from typing import List, Optional
 import uuid
-from datetime import datetime
-from sqlalchemy import ForeignKey, String, func, Uuid
+from datetime import datetime, timezone
+from sqlalchemy import ForeignKey, Index, String, event, func, select
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from flaskr.db_alchemy import Base
+from flaskr.ids import BinaryUUID, uuid7
 
 class User(Base):
     '''
     Define a User table for the ORM with name and password. 
-    id:         uuid assigned by orm
+    id:         time-ordered uuid (v7) assigned by orm, stored as 16 bytes
     name:       user name, must be unique
     password:   hashed SHA256, cannot be null
 
@@ -16,7 +17,7 @@ class User(Base):
     '''
     __tablename__ = 'user'
 
-    id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(BinaryUUID, primary_key=True, default=uuid7)
     name: Mapped[str] = mapped_column(String(30), unique=True)
     password: Mapped[str] = mapped_column(String, nullable=False)
 
@@ -28,22 +29,42 @@ class User(Base):
 class Post(Base):
     '''
     Define a Post table for the ORM with author_id, created(datetime), title, and body.
-    id:         uuid assigned by orm
+    id:         time-ordered uuid (v7) assigned by orm, stored as 16 bytes
     author_id:  user id of author
     created:    datetime, defaults to now()
     title:      title string, cannot be null
     body:       body string, cannot be null
+    body_html:  body rendered from Markdown by markdown.render_post when written
+    preview_html: the same for the feed's preview of the body
+    version:    bumped on every edit to the post or its comments, keys cached renders
+    modified:   datetime of the last such edit, drives Last-Modified
+    comment_count:    number of comments, kept up to date by the comment routes
+    last_activity_at: newest of created and the comments' created, for "active" sorting
 
     author:     orm back-populated author user object
     comments:   orm back-populated list of comments associated with posts
+
+    ix_post_created_id: composite index backing the keyset paged feed, also
+                        serves any lookup/sort on created alone
+    ix_post_last_activity_id: same for the feed sorted by activity
     '''
     __tablename__ = 'post'
+    __table_args__ = (
+        Index('ix_post_created_id', 'created', 'id'),
+        Index('ix_post_last_activity_id', 'last_activity_at', 'id'),
+    )
 
-    id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, default=uuid.uuid4)
-    author_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+    id: Mapped[uuid.UUID] = mapped_column(BinaryUUID, primary_key=True, default=uuid7)
+    author_id: Mapped[int] = mapped_column(ForeignKey('user.id'), index=True)
     created: Mapped[datetime] = mapped_column(insert_default=func.now())
     title: Mapped[str] = mapped_column(String, nullable=False)
     body: Mapped[str] = mapped_column(String, nullable=False)
+    body_html: Mapped[Optional[str]] = mapped_column(String)
+    preview_html: Mapped[Optional[str]] = mapped_column(String)
+    version: Mapped[int] = mapped_column(default=1, server_default='1')
+    modified: Mapped[Optional[datetime]] = mapped_column(insert_default=func.now())
+    comment_count: Mapped[int] = mapped_column(default=0, server_default='0')
+    last_activity_at: Mapped[Optional[datetime]] = mapped_column(insert_default=func.now())
 
     author = relationship('User', back_populates='posts')
     comments: Mapped[List["Comment"]] = relationship()
@@ -51,24 +72,70 @@ class Post(Base):
     def __repr__(self) -> str:
         return f"Post(id={self.id}, author_id={self.author_id}, created={self.created})"
     
+# Width of one materialized path segment: creation time in microseconds as
+# 14 hex digits, then the 32 hex digit id
+PATH_SEGMENT_WIDTH = 46
+
+def comment_path(comment_id, parent_path='', created=None):
+    '''
+    Materialized path for a new comment: its parent's path plus its own
+    segment. Sorting by path lists a thread depth first with siblings oldest
+    first, and a subtree is every path starting with its root's.
+    '''
+    created = created or datetime.now(timezone.utc)
+    if created.tzinfo is None: # naive datetimes are UTC, as func.now() stores
+        created = created.replace(tzinfo=timezone.utc)
+    micros = int(created.timestamp() * 1_000_000)
+    return f'{parent_path or ""}{micros:014x}{comment_id.hex}'
+
 class Comment(Base):
     '''
     Define a Comment for the ORM with parent Post, test, author, and date
-    id:             uuid assigned by orm
+    id:             time-ordered uuid (v7) assigned by orm, stored as 16 bytes
     parent_post_id: post id of parent post
     author_id:      user id of author
     created:        datetime, defaults to now()
     body:           the comment itself, string, cannot be null
+    body_html:      body rendered from Markdown when written
+    parent_id:      comment this replies to, None for top level comments
+    path:           materialized path from comment_path(), filled in on ORM
+                    inserts, Core inserts must pass it; null only on rows from
+                    before replies until repair-comment-paths runs
 
     author:         orm back-populated user from author
+
+    ix_comment_post_created_id: fetches a post's comments in time order
+    ix_comment_created:         site-wide newest/recent comment lookups
+    ix_comment_post_path:       a post's thread, or any subtree, in tree order
     '''
 
     __tablename__ = 'comment'
+    __table_args__ = (
+        Index('ix_comment_post_created_id', 'parent_post_id', 'created', 'id'),
+        Index('ix_comment_created', 'created'),
+        Index('ix_comment_post_path', 'parent_post_id', 'path'),
+    )
 
-    id: Mapped[uuid.UUID] = mapped_column(Uuid, primary_key=True, default=uuid.uuid4)
+    id: Mapped[uuid.UUID] = mapped_column(BinaryUUID, primary_key=True, default=uuid7)
     parent_post_id: Mapped[int] = mapped_column(ForeignKey('post.id'))
-    author_id: Mapped[int] = mapped_column(ForeignKey('user.id'))
+    author_id: Mapped[int] = mapped_column(ForeignKey('user.id'), index=True)
     created: Mapped[datetime] = mapped_column(insert_default=func.now())
     body: Mapped[str] = mapped_column(String, nullable=False)
+    body_html: Mapped[Optional[str]] = mapped_column(String)
+    parent_id: Mapped[Optional[uuid.UUID]] = mapped_column(ForeignKey('comment.id'))
+    path: Mapped[Optional[str]] = mapped_column(String)
 
     author: Mapped[User] = relationship()
+
+@event.listens_for(Comment, 'before_insert')
+def assign_comment_path(mapper, connection, target):
+    '''
+    Fills in the path of comments added through the ORM
+    '''
+    if target.path is None:
+        if target.id is None:
+            target.id = uuid7()
+        parent_path = ''
+        if target.parent_id is not None:
+            parent_path = connection.scalar(select(Comment.path).where(Comment.id == target.parent_id))
+        target.path = comment_path(target.id, parent_path)
@@ -1,8 +1,46 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker, declarative_base
+from sqlalchemy import create_engine, event, exc, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.orm import Session, scoped_session, sessionmaker, declarative_base
+from contextlib import contextmanager
+import functools
+import os
+import random
+import time
 import click
+import uuid
+from flask import session as cookie_session
+from .ids import BinaryUUID
 
-db_session = scoped_session(sessionmaker(autocommit=False,
+class RoutingSession(Session):
+    '''
+    Session which can send plain SELECTs to a read replica. Reads only go to a
+    replica inside replica_reads() and only until the session writes; after
+    that (or when pinned) everything goes to the primary bind so a request
+    always reads its own writes. An explicit bind (bind_arguments={'bind':
+    ...}) is always used as given. With no replicas configured it behaves
+    like a normal Session.
+    info['wrote'] records that the session wrote, info['pinned'] that it
+    reads from the primary, for having written or for replica pinning.
+    '''
+    def __init__(self, *args, replicas=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        # Stick to one replica per session for consistent reads
+        self.replica = random.choice(replicas) if replicas else None
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if kw.get('bind') is not None:
+            return kw['bind']
+        if self._flushing or (clause is not None and not getattr(clause, 'is_select', False)):
+            # Wrote, or is about to
+            self.info['wrote'] = self.info['pinned'] = True
+        elif clause is not None and self.replica is not None \
+                and self.info.get('replica_reads') and not self.info.get('pinned'):
+            return self.replica
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+db_session = scoped_session(sessionmaker(class_=RoutingSession,
+                                         autocommit=False,
                                          autoflush=False))
 Base = declarative_base()
 Base.query = db_session.query_property()
@@ -10,9 +48,88 @@ Base.query = db_session.query_property()
 def init_db(engine):
     # import all modules here that might define models so that
     # they will be registered properly in the metadata.
-    from . import data_model
+    from . import data_model, search
     Base.metadata.create_all(bind=engine)
 
+def upgrade_db(engine):
+    '''
+    Brings an existing database up to the ORM model without dropping data.
+    create_all() skips tables that already exist, so this also adds any
+    columns and indexes those tables are missing, and the search index if
+    there isn't one. New columns must be nullable or carry a server default
+    for existing rows.
+    Returns a list of the changes applied.
+    '''
+    from . import data_model
+    changes = []
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(conn)
+                changes.append(f'created table {table.name}')
+                continue
+
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column_ddl}'))
+                    changes.append(f'added column {table.name}.{column.name}')
+
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    changes.append(f'created index {index.name}')
+
+    for table, count in migrate_ids(engine).items():
+        changes.append(f'converted {count} {table} rows to binary ids')
+
+    # The search tables and triggers come with metadata.create_all(), not
+    # table by table, so a database from before search has neither
+    if engine.dialect.name == 'sqlite' and not {'post_fts', 'comment_fts'} <= existing_tables:
+        from .search import rebuild_search_index
+        rebuild_search_index(engine)
+        changes.append('created and filled the search index')
+
+    return changes
+
+def _uuid_blob(value):
+    return uuid.UUID(value).bytes if isinstance(value, str) else value
+
+def migrate_ids(engine):
+    '''
+    Rewrites uuid keys and foreign keys that SQLite holds as 32 character
+    hex text (how the Uuid type stored them) as the 16 bytes BinaryUUID
+    reads, in place and in one transaction. The values don't change, so
+    existing urls and comment paths stay valid; only new rows get time
+    ordered (v7) ids. Other backends store uuids natively and are left
+    alone. Returns {table name: rows converted} for tables that had any.
+    '''
+    if engine.dialect.name != 'sqlite':
+        return {}
+
+    from . import data_model
+    counts = {}
+    with engine.begin() as conn:
+        conn.connection.driver_connection.create_function('uuid_blob', 1, _uuid_blob,
+                                                          deterministic=True)
+        # Parents and children are converted by separate statements
+        conn.exec_driver_sql('PRAGMA defer_foreign_keys=ON')
+        for table in Base.metadata.sorted_tables:
+            columns = [c.name for c in table.columns if isinstance(c.type, BinaryUUID)]
+            if not columns:
+                continue
+            assignments = ', '.join(f'"{name}" = uuid_blob("{name}")' for name in columns)
+            converted = ' OR '.join(f'typeof("{name}") = \'text\'' for name in columns)
+            result = conn.exec_driver_sql(f'UPDATE "{table.name}" SET {assignments} WHERE {converted}')
+            if result.rowcount:
+                counts[table.name] = result.rowcount
+    return counts
+
 @click.command('init-db')
 def init_db_command():
     '''
@@ -21,10 +138,129 @@ def init_db_command():
     init_db(db_session.bind)
     click.echo('Initialized the database with SQLalchemy.')
 
+@click.command('upgrade-db')
+def upgrade_db_command():
+    '''
+    Define cmdline arg to migrate an existing database to the ORM model.
+    '''
+    changes = upgrade_db(db_session.bind)
+    for change in changes:
+        click.echo(change)
+    click.echo(f'Upgraded the database ({len(changes)} changes).')
+
+@click.command('migrate-ids')
+def migrate_ids_command():
+    '''
+    Define cmdline arg to convert text uuid keys to binary in place.
+    '''
+    counts = migrate_ids(db_session.bind)
+    for table, count in counts.items():
+        click.echo(f'{table}: {count} rows')
+    click.echo(f'Converted {sum(counts.values())} rows to binary ids.')
+
+# Pool settings passed through to create_engine when configured
+POOL_OPTIONS = {
+    'SQLALCHEMY_POOL_SIZE': 'pool_size',
+    'SQLALCHEMY_MAX_OVERFLOW': 'max_overflow',
+    'SQLALCHEMY_POOL_PRE_PING': 'pool_pre_ping',
+    'SQLALCHEMY_POOL_RECYCLE': 'pool_recycle',
+    'SQLALCHEMY_POOL_TIMEOUT': 'pool_timeout',
+}
+
+def make_engine(config, uri=None):
+    '''
+    Builds an engine from app config. Pool options are only passed when set,
+    leaving SQLAlchemy's per-dialect defaults otherwise. SQLite connections
+    get SQLITE_PRAGMAS applied as they are opened (WAL, busy_timeout, ...) so
+    concurrent workers wait on the lock instead of failing with
+    "database is locked".
+    Pooled connections are tied to the process that opened them: one
+    inherited through a fork is dropped, without closing it under the
+    parent, and replaced when checked out (see prefork for the full set
+    of after fork steps).
+    '''
+    uri = uri or config['SQLALCHEMY_URI']
+    options = {arg: config[key] for key, arg in POOL_OPTIONS.items()
+               if config.get(key) is not None}
+    engine = create_engine(uri, **options)
+
+    @event.listens_for(engine, 'connect')
+    def remember_pid(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def refuse_inherited(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            # The parent still owns it, so it mustn't be closed here either
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError(
+                f"Connection opened by process {connection_record.info['pid']}, "
+                f"checked out in process {pid}")
+
+    if make_url(uri).get_backend_name() == 'sqlite':
+        pragmas = config.get('SQLITE_PRAGMAS') or {}
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+
+    return engine
+
+@contextmanager
+def replica_reads():
+    '''
+    Lets SELECTs in this block go to a read replica, if any are configured.
+    '''
+    session = db_session()
+    previous = session.info.get('replica_reads', False)
+    session.info['replica_reads'] = True
+    try:
+        yield session
+    finally:
+        session.info['replica_reads'] = previous
+
+def read_only(view):
+    '''
+    Decorator for views that only read, routing their queries to a replica
+    '''
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        with replica_reads():
+            return view(**kwargs)
+
+    return wrapped_view
+
+def init_replica_pinning(app):
+    '''
+    Pins a client to the primary for DB_REPLICA_PIN_SECONDS after any request
+    of theirs writes, so e.g. the redirect after a POST doesn't read a replica
+    that hasn't caught up yet.
+    '''
+    @app.before_request
+    def pin_recent_writers():
+        if cookie_session.get('db_primary_until', 0) > time.time():
+            db_session().info['pinned'] = True
+
+    @app.after_request
+    def remember_writes(response):
+        # Only writes extend the pin, reads while pinned let it run out
+        if db_session().info.get('wrote'):
+            cookie_session['db_primary_until'] = time.time() + app.config['DB_REPLICA_PIN_SECONDS']
+        return response
+
 def init_app(app):
     # Setup
-    engine = create_engine(app.config['SQLALCHEMY_URI'])
-    db_session.configure(bind=engine)
+    engine = make_engine(app.config)
+    replicas = [make_engine(app.config, uri) for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
+    db_session.configure(bind=engine, replicas=replicas)
+    if replicas:
+        init_replica_pinning(app)
 
     # app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(migrate_ids_command)
\ No newline at end of file
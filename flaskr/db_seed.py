@@ -1,49 +1,144 @@
-from flaskr.data_model import User, Post, Comment
+from flaskr.data_model import User, Post, Comment, comment_path
 from flaskr.db_alchemy import Base, init_db, db_session
-from sqlalchemy import select
+from flaskr.ids import uuid7
+from flaskr.markdown import render_markdown, render_post
+from flaskr.passwords import hash_password
+from datetime import datetime, timedelta
+from itertools import islice
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import insert
 import click
-import uuid
-from werkzeug.security import generate_password_hash
+import random
 
-def seed_db(session):
+def seed_db(session, preview_chars=300):
     '''
     Creates dummy data to test app with. Wipes any pre-existing data
     '''
     Base.metadata.drop_all(bind=session.bind)
     init_db(session.bind)
 
-    user1 = User(name='admin', password=generate_password_hash('password'))
-    user2 = User(name='beta_tester', password=generate_password_hash('other_password'))
-    session.add(user1)
-    session.add(user2)
+    # Ids are assigned here rather than at flush so rows can reference each
+    # other without reading them back
+    user1 = User(id=uuid7(), name='admin', password=hash_password('password'))
+    user2 = User(id=uuid7(), name='beta_tester', password=hash_password('other_password'))
+    post1 = Post(id=uuid7(), author_id=user1.id, title='Test Post', body='A full body of text to test',
+                 comment_count=2)
+    post2 = Post(id=uuid7(), author_id=user2.id, title='Automation is good', body='Hello fellow humans.')
+    comment1 = Comment(parent_post_id=post1.id, author_id=user1.id, body='Ooo, I do love more content.')
+    comment2 = Comment(parent_post_id=post1.id, author_id=user2.id, body='Content or riot!')
+    for post in (post1, post2):
+        post.body_html, post.preview_html = render_post(post.body, preview_chars)
+    for comment in (comment1, comment2):
+        comment.body_html = render_markdown(comment.body)
+    session.add_all([user1, user2, post1, post2, comment1, comment2])
     session.commit()
 
-    # Need to get primary key from the database (SQLalchemy lets the db handle this)
-    stmt = select(User).where(User.name=='admin')
-    committed_user1 = session.scalars(stmt).first()
-    stmt = select(User).where(User.name=='beta_tester')
-    committed_user2 = session.scalars(stmt).first()
-    post1 = Post(author_id=committed_user1.id, title='Test Post', body='A full body of text to test')
-    post2 = Post(author_id=committed_user2.id, title='Automation is good', body='Hello fellow humans.')
-    session.add(post1)
-    session.add(post2)
-    session.commit()
+def seed_bulk(session, users, posts_per_user, comments_per_post, seed=0, batch_size=10000,
+              preview_chars=300):
+    '''
+    Adds synthetic load testing data: users, each with posts_per_user posts,
+    each with comments_per_post comments from random users. The same seed
+    always gives the same rows, ids included. Rows are bulk inserted
+    batch_size at a time, and all users share one password ('password')
+    hashed once. Returns (users, posts, comments) counts added.
+    '''
+    rng = random.Random(seed)
+    password = hash_password('password')
+    now = datetime(2024, 1, 1)
+    span = 365 * 24 * 3600 # Spread posts over the year before `now`
 
-    stmt = select(Post).where(Post.title == 'Test Post')
-    committed_post = session.scalars(stmt).first()
-    comment1 = Comment(parent_post_id=committed_post.id, author_id=committed_user1.id, body='Ooo, I do love more content.')
-    comment2 = Comment(parent_post_id=committed_post.id, author_id=committed_user2.id, body='Content or riot!')
-    session.add(comment1)
-    session.add(comment2)
-    session.commit()
+    # Time-ordered ids from each row's creation time, as the app makes them
+    def new_id(created):
+        return uuid7(created, rng)
+
+    user_ids = [new_id(now - timedelta(seconds=span)) for _ in range(users)]
+    _insert_batches(session, User, batch_size, (
+        {'id': user_id, 'name': f'user{i}', 'password': password}
+        for i, user_id in enumerate(user_ids)
+    ))
+
+    # Comments are generated alongside their post, so only the current
+    # batch is ever held in memory
+    comment_rows = []
+    def post_rows():
+        for author_id in user_ids:
+            for _ in range(posts_per_user):
+                created = last_activity = now - timedelta(seconds=rng.randrange(span))
+                post_id = new_id(created)
+                for c in range(comments_per_post):
+                    comment_created = created + timedelta(seconds=rng.randrange(1, 86400))
+                    comment_id = new_id(comment_created)
+                    last_activity = max(last_activity, comment_created)
+                    comment_body = f'Comment {c} on this post.'
+                    comment_rows.append({
+                        'id': comment_id,
+                        'path': comment_path(comment_id, created=comment_created),
+                        'parent_post_id': post_id,
+                        'author_id': rng.choice(user_ids),
+                        'created': comment_created,
+                        'body': comment_body,
+                        'body_html': render_markdown(comment_body),
+                    })
+                body = 'Synthetic post body. ' * rng.randrange(1, 20)
+                body_html, preview_html = render_post(body, preview_chars)
+                yield {
+                    'id': post_id,
+                    'author_id': author_id,
+                    'created': created,
+                    'modified': created,
+                    'comment_count': comments_per_post,
+                    'last_activity_at': last_activity,
+                    'title': f'Post {post_id.hex[:8]}',
+                    'body': body,
+                    'body_html': body_html,
+                    'preview_html': preview_html,
+                }
+
+    post_count = comment_count = 0
+    posts = post_rows()
+    while True:
+        batch = list(islice(posts, max(1, batch_size // (comments_per_post + 1))))
+        if not batch:
+            break
+        post_count += _insert_batches(session, Post, batch_size, batch)
+        comment_count += _insert_batches(session, Comment, batch_size, comment_rows)
+        comment_rows.clear()
+
+    return len(user_ids), post_count, comment_count
+
+def _insert_batches(session, model, batch_size, rows):
+    '''
+    Bulk inserts rows (dicts) batch_size at a time, committing each batch.
+    Goes through the Core table so no ORM objects are built.
+    '''
+    count = 0
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        session.execute(insert(model.__table__), batch)
+        session.commit()
+        count += len(batch)
+    return count
 
 @click.command('seed-db')
-def seed_db_command():
+@click.option('--users', default=0, help='Synthetic users to add.')
+@click.option('--posts-per-user', default=0, help='Synthetic posts per user.')
+@click.option('--comments-per-post', default=0, help='Synthetic comments per post.')
+@click.option('--seed', default=0, help='Random seed, the same seed gives the same data.')
+@click.option('--batch-size', default=10000, help='Rows per bulk insert.')
+@with_appcontext
+def seed_db_command(users, posts_per_user, comments_per_post, seed, batch_size):
     '''
     Define cmdline arg to init database per ORM model.
     '''
-    seed_db(db_session)
+    preview_chars = current_app.config['FEED_PREVIEW_CHARS']
+    seed_db(db_session, preview_chars)
     click.echo('Seeded the database with test posts.')
 
+    if users:
+        counts = seed_bulk(db_session, users, posts_per_user, comments_per_post,
+                           seed=seed, batch_size=batch_size, preview_chars=preview_chars)
+        click.echo('Added {} users, {} posts and {} comments.'.format(*counts))
+
 def init_seed_command(app):
-    app.cli.add_command(seed_db_command)
\ No newline at end of file
+    app.cli.add_command(seed_db_command)
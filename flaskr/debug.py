@@ -0,0 +1,152 @@
+import heapq
+import threading
+import time
+
+from flask import (
+    Blueprint, abort, before_render_template, current_app, g, has_request_context,
+    render_template, request, request_started, template_rendered
+)
+from sqlalchemy import event
+
+from flaskr.db_alchemy import db_session
+
+bp = Blueprint('debug', __name__)
+
+class RequestStats:
+    '''
+    Aggregates timings across requests: per endpoint totals and the slowest
+    statements seen. Shared by all threads of a worker, hence the lock.
+    '''
+    def __init__(self, slow_queries=20):
+        self.slow_queries = slow_queries
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+            self._slowest = [] # min-heap of (duration, seq, statement, endpoint)
+            self._seq = 0
+
+    def record(self, endpoint, timing):
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'total': 0.0, 'max': 0.0, 'sql': 0.0,
+                'queries': 0, 'template': 0.0,
+            })
+            stats['requests'] += 1
+            stats['total'] += timing['total']
+            stats['max'] = max(stats['max'], timing['total'])
+            stats['sql'] += timing['sql']
+            stats['queries'] += len(timing['queries'])
+            stats['template'] += timing['template']
+
+            for statement, duration in timing['queries']:
+                self._seq += 1
+                entry = (duration, self._seq, statement, endpoint)
+                if len(self._slowest) < self.slow_queries:
+                    heapq.heappush(self._slowest, entry)
+                elif duration > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, entry)
+
+    def snapshot(self):
+        '''
+        A copy of the per endpoint totals, safe to read while requests record
+        '''
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self.endpoints.items()}
+
+    def slowest(self):
+        with self._lock:
+            return sorted(self._slowest, reverse=True)
+
+def _timing():
+    '''
+    Timings of the current request, or None when it isn't instrumented
+    '''
+    if has_request_context():
+        return g.get('_debug_timing')
+    return None
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._debug_query_start = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timing = _timing()
+    if timing is not None:
+        duration = time.perf_counter() - context._debug_query_start
+        timing['sql'] += duration
+        timing['queries'].append((statement, duration))
+
+def start_request(sender, **extra):
+    g._debug_timing = {
+        'start': time.perf_counter(),
+        'sql': 0.0,
+        'queries': [],
+        'template': 0.0,
+        '_template_stack': [],
+    }
+
+def start_template(sender, template, context, **extra):
+    timing = _timing()
+    if timing is not None:
+        timing['_template_stack'].append(time.perf_counter())
+
+def end_template(sender, template, context, **extra):
+    timing = _timing()
+    if timing is not None and timing['_template_stack']:
+        started = timing['_template_stack'].pop()
+        # Only count the outermost render, nested ones (fragments) are inside it
+        if not timing['_template_stack']:
+            timing['template'] += time.perf_counter() - started
+
+def finish_request(response):
+    '''
+    Adds the Server-Timing header and folds the request into the aggregates
+    '''
+    timing = _timing()
+    if timing is None:
+        return response
+
+    timing['total'] = time.perf_counter() - timing['start']
+    view = max(timing['total'] - timing['sql'] - timing['template'], 0.0)
+    response.headers['Server-Timing'] = ', '.join([
+        f'db;dur={timing["sql"] * 1000:.2f};desc="{len(timing["queries"])} queries"',
+        f'tpl;dur={timing["template"] * 1000:.2f}',
+        f'view;dur={view * 1000:.2f}',
+        f'total;dur={timing["total"] * 1000:.2f}',
+    ])
+    current_app.extensions['debug_stats'].record(request.endpoint or '<no endpoint>', timing)
+    return response
+
+@bp.route('/debug')
+def debug():
+    '''
+    Aggregated per endpoint timings and the slowest statements since start up
+    '''
+    if not current_app.config['DEBUG_INSTRUMENTATION']:
+        abort(404)
+
+    stats = current_app.extensions['debug_stats']
+    endpoints = sorted(stats.snapshot().items(), key=lambda item: item[1]['total'], reverse=True)
+    return render_template('debug/debug.html', endpoints=endpoints, slowest=stats.slowest())
+
+def init_app(app):
+    '''
+    Hooks up the instrumentation when DEBUG_INSTRUMENTATION is set. Nothing is
+    attached otherwise, so it costs nothing when off.
+    '''
+    if not app.config['DEBUG_INSTRUMENTATION']:
+        return
+
+    app.extensions['debug_stats'] = RequestStats(app.config['DEBUG_SLOW_QUERIES'])
+
+    factory_kw = db_session.session_factory.kw
+    for engine in [factory_kw['bind'], *factory_kw.get('replicas', ())]:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    request_started.connect(start_request, app)
+    before_render_template.connect(start_template, app)
+    template_rendered.connect(end_template, app)
+    app.after_request(finish_request)
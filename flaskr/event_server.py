@@ -0,0 +1,226 @@
+'''
+Live comment streams served from one asyncio event loop. Each reader costs a
+coroutine, a socket and a small queue rather than a server thread, so a
+worker holds thousands of idle streams. The loop listens to the broker once
+and fans each message out to the streams of its channel.
+
+Pages open their EventSource on EVENTS_URL when it's set (the post.events
+view otherwise, a thread per stream). `flask serve --events-port` runs an
+EventServer in a thread of each worker, on a listening socket they share;
+gunicorn.conf.py does the same with EVENTS_BIND. `flask serve-events` runs
+one on its own next to any other server, which needs EVENTS_CLIENT for the
+web workers' comments to reach it.
+'''
+import asyncio
+import re
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from .db_alchemy import db_session
+from .data_model import Post
+from .events import comment_channel, format_event
+
+# Any prefix a proxy in front adds, then the post.events route
+STREAM_PATH = re.compile(r'(?:/.*)?/([^/]+)/events')
+
+HEADERS = (
+    'HTTP/1.1 200 OK\r\n'
+    'Content-Type: text/event-stream; charset=utf-8\r\n'
+    'Cache-Control: no-cache\r\n'
+    'X-Accel-Buffering: no\r\n'
+    # Comments are public, and pages are usually on another port or host
+    'Access-Control-Allow-Origin: *\r\n'
+    'Connection: close\r\n'
+    '\r\n'
+    'retry: 5000\n\n'
+)
+
+class _Stream:
+    '''
+    One reader's messages. Like events.Subscription, a reader that falls
+    more than `backlog` messages behind loses the oldest.
+    '''
+    __slots__ = ('messages', 'arrived')
+
+    def __init__(self, backlog):
+        self.messages = deque(maxlen=backlog)
+        self.arrived = asyncio.Event()
+
+    def push(self, message):
+        self.messages.append(message)
+        self.arrived.set()
+
+class EventServer:
+    '''
+    Serves GET <prefix>/<post id>/events as Server-Sent Events, like the
+    post.events view, to at most `max_clients` readers at once (503 with
+    Retry-After past that). All streams live on one event loop: run it with
+    serve(), or start() it on a thread of its own. Opening a stream checks
+    its post on one more thread, so the loop never waits on the database.
+    '''
+    def __init__(self, app, max_clients=10000):
+        self.app = app
+        self.broker = app.extensions['events']
+        self.keepalive = app.config['EVENTS_KEEPALIVE']
+        self.backlog = app.config['EVENTS_BACKLOG']
+        self.max_clients = max_clients
+        self._streams = {} # channel: set of _Streams, only touched on the loop
+        self._count = 0
+        self._handlers = set()
+        self._closing = False
+        self._loop = None
+        self._db = None
+        self._server = None
+        self._thread = None
+        self._serving = threading.Event()
+
+    def client_count(self):
+        return self._count
+
+    async def serve(self, sock=None, host='127.0.0.1', port=8001):
+        '''
+        Accepts on sock, or else on host and port, until stop()
+        '''
+        self._loop = asyncio.get_running_loop()
+        self._db = ThreadPoolExecutor(1, thread_name_prefix='event-server-db')
+        if sock is not None:
+            self._server = await asyncio.start_server(self._handle, sock=sock)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        self.broker.listen(self._published)
+        self._serving.set()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.broker.unlisten(self._published)
+            # Let the streams stop() woke finish, rather than cancelling them
+            if self._handlers:
+                await asyncio.wait(self._handlers, timeout=self.keepalive + 1)
+            self._db.shutdown(wait=False)
+
+    def start(self, sock):
+        '''
+        Serves on sock from a daemon thread of its own
+        '''
+        self._thread = threading.Thread(target=asyncio.run, args=(self.serve(sock),),
+                                        name='event-server', daemon=True)
+        self._thread.start()
+        self._serving.wait(5)
+
+    def stop(self):
+        '''
+        Stops accepting and ends the open streams
+        '''
+        if self._loop is not None and self._server is not None:
+            self._loop.call_soon_threadsafe(self._close)
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def _close(self):
+        self._closing = True
+        self._server.close()
+        for streams in self._streams.values():
+            for stream in streams:
+                stream.arrived.set()
+
+    def _published(self, channel, message):
+        # On the publishing thread, hand over to the loop
+        self._loop.call_soon_threadsafe(self._deliver, channel, message)
+
+    def _deliver(self, channel, message):
+        for stream in self._streams.get(channel, ()):
+            stream.push(message)
+
+    def _post_exists(self, post_id):
+        with self.app.app_context():
+            return db_session.scalar(select(Post.id).where(Post.id == post_id)) is not None
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive)
+            method, target, _ = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+            match = STREAM_PATH.fullmatch(target.split('?', 1)[0])
+            if method != 'GET' or match is None:
+                return await self._refuse(writer, '404 Not Found')
+            try:
+                post_id = uuid.UUID(match.group(1))
+            except ValueError:
+                return await self._refuse(writer, '404 Not Found')
+            if self._count >= self.max_clients:
+                return await self._refuse(writer, '503 Service Unavailable', 'Retry-After: 30\r\n')
+            # A db query, off the loop
+            if not await self._loop.run_in_executor(self._db, self._post_exists, post_id):
+                return await self._refuse(writer, '404 Not Found')
+            await self._stream(reader, writer, comment_channel(post_id))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ValueError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            self._handlers.discard(asyncio.current_task())
+
+    async def _refuse(self, writer, status, headers=''):
+        writer.write(f'HTTP/1.1 {status}\r\n{headers}Content-Length: 0\r\n'
+                     'Connection: close\r\n\r\n'.encode())
+        await writer.drain()
+
+    async def _stream(self, reader, writer, channel):
+        stream = _Stream(self.backlog)
+        self._streams.setdefault(channel, set()).add(stream)
+        self._count += 1
+        # Readers send nothing more, so this ends when they go away
+        gone = asyncio.ensure_future(reader.read())
+        try:
+            writer.write(HEADERS.encode())
+            await writer.drain()
+            while not gone.done() and not self._closing:
+                try:
+                    await asyncio.wait_for(stream.arrived.wait(), self.keepalive)
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                else:
+                    stream.arrived.clear()
+                    while stream.messages:
+                        writer.write(format_event(stream.messages.popleft()).encode())
+                await writer.drain()
+        finally:
+            gone.cancel()
+            self._count -= 1
+            streams = self._streams[channel]
+            streams.discard(stream)
+            if not streams:
+                del self._streams[channel]
+
+@click.command('serve-events')
+@click.option('--host', default='127.0.0.1', help='Interface to listen on.')
+@click.option('--port', default=8001, help='Port to listen on.')
+@with_appcontext
+def serve_events_command(host, port):
+    '''
+    Define cmdline arg to serve live comment streams from one event loop.
+    '''
+    app = current_app._get_current_object()
+    if app.config['EVENTS_CLIENT'] is None:
+        raise click.ClickException(
+            'EVENTS_CLIENT is not set, comments made in the web workers would never '
+            'reach this process. Use `flask serve --events-port` for one process.')
+    server = EventServer(app, app.config['EVENTS_SERVER_MAX_CLIENTS'])
+    click.echo(f'Serving live comments on http://{host}:{port}.')
+    try:
+        asyncio.run(server.serve(host=host, port=port))
+    except KeyboardInterrupt:
+        pass
+
+def init_app(app):
+    app.cli.add_command(serve_events_command)
@@ -0,0 +1,247 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+class TooManySubscribers(Exception):
+    '''
+    Raised by subscribe when the process already has its most subscribers
+    '''
+
+class Broker:
+    '''
+    Publish/subscribe of JSON-able messages on named channels. Subscriptions
+    are passive queues that a reader polls, which is what the post.events
+    view does, blocking a server thread for each open stream. Event loops
+    instead listen() once and fan messages out to their own clients, so
+    event_server.EventServer serves thousands of streams from one thread.
+    '''
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    def subscribe(self, channel):
+        '''
+        Returns a Subscription, close it when done. Raises
+        TooManySubscribers if the broker is full.
+        '''
+        raise NotImplementedError
+
+    def listen(self, callback):
+        '''
+        Calls callback(channel, message) for every message published from
+        now on, on whichever thread delivers it, so it must be quick
+        '''
+        raise NotImplementedError
+
+    def unlisten(self, callback):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def after_fork(self):
+        '''
+        Drops the parent's subscribers and threads in a forked child
+        '''
+        pass
+
+class Subscription:
+    '''
+    Messages for one subscriber. A subscriber that falls more than `backlog`
+    messages behind loses the oldest rather than growing without bound.
+    '''
+    __slots__ = ('broker', 'channel', 'messages', 'condition')
+
+    def __init__(self, broker, channel, condition, backlog):
+        self.broker = broker
+        self.channel = channel
+        self.condition = condition
+        self.messages = deque(maxlen=backlog)
+
+    def get(self, timeout=None):
+        '''
+        Waits up to timeout seconds for messages and returns them all, or an
+        empty list if none came
+        '''
+        with self.condition:
+            if not self.messages:
+                self.condition.wait(timeout)
+            messages = list(self.messages)
+            self.messages.clear()
+        return messages
+
+    def close(self):
+        self.broker._unsubscribe(self)
+
+class LocalBroker(Broker):
+    '''
+    Fans messages out to subscribers in this process. Each channel has one
+    condition shared by its subscribers, so publishing is one append per
+    subscriber and one notify_all, plus a call per listener. With
+    max_subscribers, no more than that many subscriptions are open at once.
+    '''
+    def __init__(self, backlog=100, max_subscribers=None):
+        self.backlog = backlog
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._channels = {} # channel: (condition, set of subscriptions)
+        self._subscribers = 0
+        self._listeners = ()
+
+    def publish(self, channel, message):
+        with self._lock:
+            entry = self._channels.get(channel)
+            listeners = self._listeners
+        for listener in listeners:
+            listener(channel, message)
+        if entry is None:
+            return
+        condition, subscriptions = entry
+        with condition:
+            for subscription in subscriptions:
+                subscription.messages.append(message)
+            condition.notify_all()
+
+    def subscribe(self, channel):
+        with self._lock:
+            if self.max_subscribers is not None and self._subscribers >= self.max_subscribers:
+                raise TooManySubscribers(channel)
+            self._subscribers += 1
+            condition, subscriptions = self._channels.setdefault(
+                channel, (threading.Condition(), set()))
+            subscription = Subscription(self, channel, condition, self.backlog)
+            with condition:
+                subscriptions.add(subscription)
+        return subscription
+
+    def listen(self, callback):
+        with self._lock:
+            self._listeners = (*self._listeners, callback)
+
+    def unlisten(self, callback):
+        with self._lock:
+            self._listeners = tuple(listener for listener in self._listeners if listener != callback)
+
+    def subscriber_count(self, channel=None):
+        with self._lock:
+            if channel is not None:
+                entry = self._channels.get(channel)
+                return len(entry[1]) if entry else 0
+            return self._subscribers
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._subscribers = 0
+        self._listeners = ()
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            entry = self._channels.get(subscription.channel)
+            if entry is None:
+                return
+            condition, subscriptions = entry
+            if subscription not in subscriptions:
+                return
+            self._subscribers -= 1
+            with condition:
+                subscriptions.discard(subscription)
+                # Wake it in case a stream is still waiting on it
+                condition.notify_all()
+            if not subscriptions:
+                del self._channels[subscription.channel]
+
+class RedisBroker(Broker):
+    '''
+    Shares messages between workers through redis pub/sub. Each process runs
+    one listener thread on a pattern subscription and hands what it hears to
+    a LocalBroker, so the number of subscribers doesn't change the number of
+    redis connections.
+    '''
+    def __init__(self, client, prefix='flaskr:events:', backlog=100, max_subscribers=None):
+        self.client = client
+        self.prefix = prefix
+        self.local = LocalBroker(backlog, max_subscribers)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, json.dumps(message))
+
+    def subscribe(self, channel):
+        self._start()
+        return self.local.subscribe(channel)
+
+    def listen(self, callback):
+        self._start()
+        self.local.listen(callback)
+
+    def unlisten(self, callback):
+        self.local.unlisten(callback)
+
+    def close(self):
+        self._stopped.set()
+
+    def after_fork(self):
+        # redis-py clients reconnect by themselves after a fork
+        self.local.after_fork()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name='events-listener', daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.prefix + '*')
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    channel = message['channel']
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    self.local.publish(channel[len(self.prefix):], json.loads(message['data']))
+            except Exception:
+                log.exception('Lost the redis events subscription, reconnecting')
+                time.sleep(1)
+
+def comment_channel(post_id):
+    return f'post:{post_id}:comments'
+
+def format_event(message):
+    '''
+    A published comment as a Server-Sent Events message
+    '''
+    return f"event: comment\nid: {message['id']}\ndata: {json.dumps(message)}\n\n"
+
+def publish_comment(broker, post_id, comment):
+    '''
+    Announces a committed comment (a read_models.CommentRow) to the post's
+    subscribers
+    '''
+    broker.publish(comment_channel(post_id), {
+        'id': str(comment.id),
+        'parent_id': str(comment.parent_id) if comment.parent_id else None,
+        'author_name': comment.author_name,
+        'body': comment.body,
+        'body_html': comment.body_html,
+        'created': comment.created.isoformat() if comment.created else None,
+    })
+
+def init_app(app):
+    client = app.config['EVENTS_CLIENT']
+    backlog = app.config['EVENTS_BACKLOG']
+    max_subscribers = app.config['EVENTS_MAX_SUBSCRIBERS']
+    app.extensions['events'] = RedisBroker(client, backlog=backlog, max_subscribers=max_subscribers) \
+                               if client is not None else LocalBroker(backlog, max_subscribers)
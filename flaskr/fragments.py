@@ -0,0 +1,78 @@
+import re
+import threading
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+from flaskr.cache import make_cache
+
+class FragmentCache:
+    '''
+    Caches rendered HTML fragments under name, key and version. Callers pass
+    a version that changes whenever the underlying rows change (Post.version),
+    so stale fragments are never looked up again and simply age out of the
+    backend. Fragments must not depend on the current user; leave a
+    user_slot() in them and fill it per request instead.
+    '''
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock() # for the counters, shared by request threads
+
+    def get_or_render(self, name, key, version, render):
+        cache_key = f'{name}:{key}:{version}'
+        html = self.backend.get(cache_key)
+        if html is None:
+            with self._lock:
+                self.misses += 1
+            html = str(render())
+            self.backend.set(cache_key, html)
+        else:
+            with self._lock:
+                self.hits += 1
+        return Markup(html)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+SLOT = re.compile(r'<!--user-slot:([^>]*)-->')
+
+def user_slot(name):
+    '''
+    Placeholder left in a cached fragment where per-user HTML goes
+    '''
+    return Markup(f'<!--user-slot:{name}-->')
+
+def fill_slots(html, fills):
+    '''
+    Replaces the user_slot()s in html with their HTML, in one pass. fills is
+    a dict by slot name or a function of the name; slots it has nothing for
+    are left empty.
+    '''
+    if not callable(fills):
+        fills = {str(name): value for name, value in fills.items()}.get
+    return Markup(SLOT.sub(lambda match: str(fills(match.group(1)) or ''), str(html)))
+
+def cached_fragment(template, key, version, **context):
+    '''
+    Jinja global: renders template with context through the fragment cache
+    '''
+    return current_app.extensions['fragment_cache'].get_or_render(
+        template, key, version, lambda: render_template(template, **context))
+
+def init_app(app):
+    app.extensions['fragment_cache'] = FragmentCache(
+        make_cache(app.config, 'fragment',
+                   maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                   ttl=app.config['FRAGMENT_CACHE_TTL']))
+    app.jinja_env.globals.update(cached_fragment=cached_fragment, user_slot=user_slot)
+    app.jinja_env.filters['fill_slots'] = fill_slots
@@ -0,0 +1,244 @@
+'''
+Markdown for post and comment bodies. Bodies are rendered when they're
+written and the HTML is stored next to the source (body_html, and a post's
+feed preview in preview_html), so pages only ever copy stored HTML out.
+
+The renderer handles a small subset: paragraphs, line breaks, # headings,
+> quotes, - and 1. lists, --- rules, ``` code blocks, `code`, **strong**,
+*emphasis* and [links](url). It's sanitizing by construction: all source
+text is escaped and the only tags in the output are the ones it writes, so
+raw HTML in a body comes out as text and links only get http(s), mailto
+and relative urls. Changing any of this means re-rendering what's stored,
+with `flask render-markdown`.
+'''
+import functools
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+from sqlalchemy import bindparam, select, update
+
+from .db_alchemy import db_session
+from .data_model import Post, Comment
+
+# Nested quotes deeper than this are rendered as text
+MAX_QUOTE_DEPTH = 8
+
+_FENCE = re.compile(r'^\s{0,3}```')
+_HEADING = re.compile(r'^\s{0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+_RULE = re.compile(r'^\s{0,3}([-*_])(\s*\1){2,}\s*$')
+_QUOTE = re.compile(r'^\s{0,3}>\s?')
+_BULLET = re.compile(r'^\s{0,3}[-*+]\s+')
+_NUMBERED = re.compile(r'^\s{0,3}\d{1,9}[.)]\s+')
+
+_CODE_SPAN = re.compile(r'`([^`\n]+)`')
+_LINK = re.compile(r'\[([^\[\]\n]+)\]\(\s*([^()\s]+)\s*\)')
+_STRONG = re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*')
+_EMPHASIS = re.compile(r'(?<![\w*])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![\w*])'
+                       r'|(?<![\w_])_(?=[^\s_])(.+?)(?<=[^\s_])_(?![\w_])')
+
+_SCHEMES = {'', 'http', 'https', 'mailto'}
+
+def render_markdown(source):
+    '''
+    Sanitized HTML for a Markdown body
+    '''
+    lines = source.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(_blocks(lines, 0))
+
+def render_preview(source, chars):
+    '''
+    HTML for the feed's preview of a body, its first chars characters
+    '''
+    return render_markdown(source[:chars])
+
+def render_post(body, preview_chars):
+    '''
+    (body_html, preview_html) for a post body
+    '''
+    return render_markdown(body), render_preview(body, preview_chars)
+
+def render_comment(body):
+    '''
+    (body_html,) for a comment body
+    '''
+    return (render_markdown(body),)
+
+def rendered_body(html, source):
+    '''
+    Template helper: the stored HTML of a body, or for rows from before it
+    was stored (until render-markdown fills them in) the source rendered now
+    '''
+    return Markup(html if html is not None else render_markdown(source or ''))
+
+def _is_block_start(line):
+    return bool(_FENCE.match(line) or _HEADING.match(line) or _RULE.match(line)
+                or _QUOTE.match(line) or _BULLET.match(line) or _NUMBERED.match(line))
+
+def _blocks(lines, depth):
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip():
+            i += 1
+        elif _FENCE.match(line):
+            end = i + 1
+            while end < len(lines) and not _FENCE.match(lines[end]):
+                end += 1
+            yield f'<pre><code>{escape(chr(10).join(lines[i + 1:end]))}</code></pre>'
+            i = end + 1
+        elif heading := _HEADING.match(line):
+            level = len(heading.group(1))
+            yield f'<h{level}>{_inline(heading.group(2))}</h{level}>'
+            i += 1
+        elif _RULE.match(line):
+            yield '<hr>'
+            i += 1
+        elif _QUOTE.match(line) and depth < MAX_QUOTE_DEPTH:
+            end = i
+            while end < len(lines) and _QUOTE.match(lines[end]):
+                end += 1
+            quoted = [_QUOTE.sub('', quoted_line, count=1) for quoted_line in lines[i:end]]
+            yield '<blockquote>\n' + '\n'.join(_blocks(quoted, depth + 1)) + '\n</blockquote>'
+            i = end
+        elif _BULLET.match(line) or _NUMBERED.match(line):
+            marker = _BULLET if _BULLET.match(line) else _NUMBERED
+            items = []
+            while i < len(lines) and lines[i].strip():
+                if marker.match(lines[i]):
+                    items.append([marker.sub('', lines[i], count=1)])
+                elif _is_block_start(lines[i]):
+                    break
+                else: # Continues the item above
+                    items[-1].append(lines[i].strip())
+                i += 1
+            tag = 'ul' if marker is _BULLET else 'ol'
+            yield f'<{tag}>\n' + '\n'.join(f'<li>{_lines(item)}</li>' for item in items) + f'\n</{tag}>'
+        else:
+            end = i + 1
+            while end < len(lines) and lines[end].strip() and not _is_block_start(lines[end]):
+                end += 1
+            yield f'<p>{_lines(lines[i:end])}</p>'
+            i = end
+
+def _lines(lines):
+    return '<br>\n'.join(_inline(line.strip()) for line in lines)
+
+def _inline(text):
+    # Code spans first, nothing inside them is formatting
+    parts = _CODE_SPAN.split(text)
+    return ''.join(f'<code>{escape(part)}</code>' if i % 2 else _links(part)
+                   for i, part in enumerate(parts))
+
+def _links(text):
+    html = []
+    position = 0
+    for link in _LINK.finditer(text):
+        html.append(_emphasis(text[position:link.start()]))
+        label = _emphasis(link.group(1))
+        url = link.group(2)
+        if _safe_url(url):
+            html.append(f'<a href="{escape(url)}" rel="nofollow noopener">{label}</a>')
+        else:
+            html.append(label)
+        position = link.end()
+    html.append(_emphasis(text[position:]))
+    return ''.join(html)
+
+def _emphasis(text):
+    html = str(escape(text))
+    html = _STRONG.sub(r'<strong>\1</strong>', html)
+    return _EMPHASIS.sub(lambda match: f'<em>{match.group(1) or match.group(2)}</em>', html)
+
+def _safe_url(url):
+    if any(ord(char) < 0x20 or ord(char) == 0x7f for char in url):
+        return False
+    try:
+        return urlsplit(url).scheme.lower() in _SCHEMES
+    except ValueError:
+        return False
+
+def rerender_bodies(session, preview_chars, workers=None, batch_size=1000):
+    '''
+    Renders every post and comment body again and stores the HTML that
+    changed, e.g. after a change to the renderer. Rows are read in id order
+    batch_size at a time and rendered by a pool of `workers` processes (one
+    per CPU by default) while the next batch is read. Posts whose HTML or
+    comments changed get a new version, dropping their cached renders.
+    Returns (posts, comments) updated.
+    '''
+    workers = workers or os.cpu_count() or 1
+    # A few chunks per worker and batch keeps them all busy to the end
+    chunksize = max(1, batch_size // (4 * workers))
+    with ProcessPoolExecutor(workers) as pool:
+        render = functools.partial(render_post, preview_chars=preview_chars)
+
+        posts = 0
+        for changed in _rerender(session, pool, chunksize, batch_size, render,
+                                 Post, ('body_html', 'preview_html')):
+            session.execute(update(Post).where(Post.id.in_([row.id for row, _ in changed]))
+                                        .values(version=Post.version + 1),
+                            execution_options={'synchronize_session': False})
+            posts += len(changed)
+
+        comments = 0
+        for changed in _rerender(session, pool, chunksize, batch_size, render_comment,
+                                 Comment, ('body_html',), Comment.parent_post_id):
+            post_ids = {row.parent_post_id for row, _ in changed}
+            session.execute(update(Post).where(Post.id.in_(post_ids)).values(version=Post.version + 1),
+                            execution_options={'synchronize_session': False})
+            comments += len(changed)
+
+    return posts, comments
+
+def _rerender(session, pool, chunksize, batch_size, render, model, columns, *extra):
+    '''
+    Yields the rows of each batch whose HTML changed, as (row, new values)
+    pairs, after writing the new values. The caller's
+    writes go in the same transaction, committed before the next batch.
+    '''
+    stored = [getattr(model, name) for name in columns]
+    stmt = update(model).where(model.id == bindparam('row_id'))\
+                        .values({name: bindparam(f'new_{name}') for name in columns})
+
+    def fetch(after):
+        query = select(model.id, model.body, *stored, *extra).order_by(model.id).limit(batch_size)
+        if after is not None:
+            query = query.where(model.id > after)
+        return session.execute(query).all()
+
+    rows = fetch(None)
+    while rows:
+        rendered = pool.map(render, [row.body for row in rows], chunksize=chunksize)
+        next_rows = fetch(rows[-1].id) if len(rows) == batch_size else []
+        changed = [(row, values) for row, values in zip(rows, rendered)
+                   if tuple(row[2:2 + len(columns)]) != values]
+        if changed:
+            session.connection().execute(stmt, [
+                {'row_id': row.id, **{f'new_{name}': value for name, value in zip(columns, values)}}
+                for row, values in changed
+            ])
+            yield changed
+        session.commit()
+        rows = next_rows
+
+@click.command('render-markdown')
+@click.option('--workers', type=int, default=None, help='Render processes, one per CPU by default.')
+@click.option('--batch-size', default=1000, help='Rows read and written at a time.')
+@with_appcontext
+def render_markdown_command(workers, batch_size):
+    '''
+    Define cmdline arg to re-render the stored HTML of every body.
+    '''
+    posts, comments = rerender_bodies(db_session, current_app.config['FEED_PREVIEW_CHARS'],
+                                      workers=workers, batch_size=batch_size)
+    click.echo(f'Re-rendered {posts} posts and {comments} comments.')
+
+def init_app(app):
+    app.jinja_env.globals['rendered_body'] = rendered_body
+    app.cli.add_command(render_markdown_command)
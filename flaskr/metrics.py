@@ -0,0 +1,233 @@
+import functools
+import hmac
+import itertools
+import threading
+import time
+
+from flask import (
+    Blueprint, Response, abort, current_app, g, got_request_exception, request,
+    request_finished, request_started
+)
+from sqlalchemy import event
+
+from flaskr.db_alchemy import db_session
+
+bp = Blueprint('metrics', __name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: (type, help)
+FAMILIES = {
+    'flaskr_http_request_duration_seconds': ('histogram', 'Request latency by endpoint.'),
+    'flaskr_http_requests_total': ('counter', 'Requests by endpoint and status code.'),
+    'flaskr_http_exceptions_total': ('counter', 'Unhandled exceptions by endpoint.'),
+    'flaskr_db_query_duration_seconds': ('histogram', 'SQL statement latency by statement type.'),
+    'flaskr_db_pool_checkout_wait_seconds': ('histogram', 'Time spent waiting for a pooled connection.'),
+    'flaskr_db_pool_checked_out': ('gauge', 'Connections currently checked out of the pool.'),
+    'flaskr_db_pool_size': ('gauge', 'Configured pool size.'),
+    'flaskr_db_pool_overflow': ('gauge', 'Connections open beyond the pool size.'),
+    'flaskr_cache_hits_total': ('counter', 'Cache hits by cache.'),
+    'flaskr_cache_misses_total': ('counter', 'Cache misses by cache.'),
+}
+
+STATEMENT_TYPES = {'select', 'insert', 'update', 'delete', 'pragma', 'create', 'drop', 'alter'}
+
+class Metrics:
+    '''
+    Counters and histograms kept in shards, one lock per shard. Each thread
+    sticks to one shard, so recording only takes an uncontended lock unless
+    more threads than shards are busy at once. Scrapes merge the shards.
+    Labels are a tuple of (name, value) pairs.
+    '''
+    def __init__(self, shards=16, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+        self._next_shard = itertools.count()
+        self._local = threading.local()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            self._local.shard = self._shards[next(self._next_shard) % len(self._shards)]
+            return self._local.shard
+
+    def inc(self, name, labels, amount=1):
+        lock, values = self._shard()
+        key = (name, labels)
+        with lock:
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        lock, values = self._shard()
+        key = (name, labels)
+        with lock:
+            hist = values.get(key)
+            if hist is None:
+                # one count per bucket, then +Inf, then sum
+                hist = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else:
+                hist[len(self.buckets)] += 1
+            hist[-1] += value
+
+    def collect(self):
+        '''
+        Merges the shards into {(name, labels): value or histogram list}
+        '''
+        merged = {}
+        for lock, values in self._shards:
+            with lock:
+                items = [(key, list(v) if isinstance(v, list) else v) for key, v in values.items()]
+            for key, value in items:
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value[:-1]) + [0.0])
+                    for i, v in enumerate(value):
+                        total[i] += v
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self, gauges=()):
+        '''
+        Prometheus text exposition of everything recorded plus the extra
+        (name, labels, value) gauges passed in
+        '''
+        samples = self.collect()
+        for name, labels, value in gauges:
+            samples[(name, labels)] = value
+
+        by_family = {}
+        for (name, labels), value in samples.items():
+            by_family.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(by_family):
+            kind, help_text = FAMILIES[name]
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_family[name]):
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {value[-1]}')
+                    lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+def _endpoint():
+    # Unmatched urls share one label so random paths can't blow up cardinality
+    return request.endpoint or 'unmatched'
+
+def start_request(sender, **extra):
+    g._metrics_start = time.perf_counter()
+
+def finish_request(sender, response, **extra):
+    started = g.pop('_metrics_start', None)
+    if started is None:
+        return
+    metrics = sender.extensions['metrics']
+    endpoint = _endpoint()
+    metrics.observe('flaskr_http_request_duration_seconds',
+                    (('endpoint', endpoint), ('method', request.method)),
+                    time.perf_counter() - started)
+    metrics.inc('flaskr_http_requests_total',
+                (('endpoint', endpoint), ('method', request.method), ('status', response.status_code)))
+
+def count_exception(sender, exception, **extra):
+    sender.extensions['metrics'].inc('flaskr_http_exceptions_total', (('endpoint', _endpoint()),))
+
+def instrument_engine(metrics, engine, role):
+    '''
+    Times statements by type and waits for pooled connections on an engine.
+    The wait is timed around Engine.raw_connection, which every checkout goes
+    through, as the pool has no event for the start of a checkout; wrapping
+    the engine rather than its pool keeps working after dispose().
+    '''
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else 'other'
+        metrics.observe('flaskr_db_query_duration_seconds',
+                        (('engine', role), ('statement', kind if kind in STATEMENT_TYPES else 'other')),
+                        time.perf_counter() - context._metrics_start)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    raw_connection = engine.raw_connection
+    @functools.wraps(raw_connection)
+    def timed_raw_connection(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return raw_connection(*args, **kwargs)
+        finally:
+            metrics.observe('flaskr_db_pool_checkout_wait_seconds', (('engine', role),),
+                            time.perf_counter() - started)
+    engine.raw_connection = timed_raw_connection
+
+def engine_gauges(engines):
+    for role, engine in engines:
+        pool = engine.pool
+        labels = (('engine', role),)
+        for name, method in (('flaskr_db_pool_checked_out', 'checkedout'),
+                             ('flaskr_db_pool_size', 'size'),
+                             ('flaskr_db_pool_overflow', 'overflow')):
+            # Not every pool class has these, SingletonThreadPool.size isn't a method
+            value = getattr(pool, method, None)
+            if callable(value):
+                yield name, labels, value()
+
+def cache_gauges(app):
+    for name, cache in (('user', app.extensions.get('user_cache')),
+                        ('fragment', app.extensions.get('fragment_cache')),
+                        ('post', app.extensions.get('post_cache'))):
+        if cache is not None:
+            yield 'flaskr_cache_hits_total', (('cache', name),), cache.hits
+            yield 'flaskr_cache_misses_total', (('cache', name),), cache.misses
+
+@bp.route('/metrics')
+def metrics():
+    '''
+    Prometheus scrape endpoint
+    '''
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    token = current_app.config['METRICS_TOKEN']
+    if token is not None and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                     f'Bearer {token}'):
+        abort(401)
+
+    gauges = [*engine_gauges(current_app.extensions['metrics_engines']),
+              *cache_gauges(current_app)]
+    return Response(current_app.extensions['metrics'].render(gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    metrics = app.extensions['metrics'] = Metrics()
+    factory_kw = db_session.session_factory.kw
+    engines = [('primary', factory_kw['bind'])]
+    engines += [(f'replica{i}', engine) for i, engine in enumerate(factory_kw.get('replicas', ()))]
+    app.extensions['metrics_engines'] = engines
+    for role, engine in engines:
+        instrument_engine(metrics, engine, role)
+
+    request_started.connect(start_request, app)
+    request_finished.connect(finish_request, app)
+    got_request_exception.connect(count_exception, app)
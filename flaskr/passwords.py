@@ -0,0 +1,91 @@
+import atexit
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.exceptions import abort
+from werkzeug.security import check_password_hash, generate_password_hash
+
+@functools.lru_cache(maxsize=None)
+def _full_method(method):
+    '''
+    Method string as werkzeug writes it into hashes, defaults filled in
+    (e.g. 'scrypt' -> 'scrypt:32768:8:1'), for comparing against stored hashes
+    '''
+    return generate_password_hash('', method=method, salt_length=1).split('$', 1)[0]
+
+class PasswordHasher:
+    '''
+    Hashes and checks passwords with the configured method on a bounded pool
+    of worker threads. hashlib releases the GIL while hashing, so at most
+    `workers` hashes burn CPU at once however many logins arrive, and requests
+    waiting longer than `timeout` seconds for a slot get a 503 rather than
+    tying up the server. close() stops the threads, and runs at exit for
+    every hasher still alive.
+    '''
+    def __init__(self, method, salt_length=16, workers=2, queue=16, timeout=10):
+        self.method = method
+        self.salt_length = salt_length
+        self.timeout = timeout
+        self.workers = workers
+        self.queue = queue
+        self._start_pool()
+
+    def _start_pool(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue)
+
+    def after_fork(self):
+        '''
+        A new pool for a forked child, the parent's threads don't carry over
+        '''
+        self._start_pool()
+
+    def close(self):
+        '''
+        Finishes the hashes in progress and stops the pool's threads
+        '''
+        self._executor.shutdown(wait=True)
+
+    def _run(self, fn, *args, **kwargs):
+        if not self._slots.acquire(timeout=self.timeout):
+            abort(503, 'Too many logins right now, please try again.')
+        try:
+            return self._executor.submit(fn, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password,
+                         method=self.method, salt_length=self.salt_length)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        '''
+        True if pwhash was made with other parameters than currently configured
+        '''
+        return pwhash.split('$', 1)[0] != _full_method(self.method)
+
+# Every app's hasher, held weakly so apps can go away before the process does
+_hashers = weakref.WeakSet()
+
+@atexit.register
+def _close_all():
+    for hasher in list(_hashers):
+        hasher.close()
+
+def hash_password(password):
+    return current_app.extensions['password_hasher'].hash(password)
+
+def init_app(app):
+    hasher = app.extensions['password_hasher'] = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        queue=app.config['PASSWORD_HASH_QUEUE'],
+        timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+    _hashers.add(hasher)
@@ -1,25 +1,217 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, Response, current_app, flash, g, redirect, render_template, request,
+    stream_template, url_for
 )
+import re
 import uuid
+import click
+from markupsafe import Markup
 from werkzeug.exceptions import abort
 from flaskr.auth import login_required
-from .db_alchemy import db_session
-from .data_model import User, Post, Comment
-from sqlalchemy import select
-from sqlalchemy.orm import joinedload
+from .blog import touch_post
+from .events import TooManySubscribers, comment_channel, format_event, publish_comment
+from .ids import uuid7
+from .markdown import render_markdown
+from .conditional import add_validators, make_etag, not_modified
+from .db_alchemy import db_session, read_only
+from .data_model import PATH_SEGMENT_WIDTH, User, Post, Comment, comment_path
+from .fragments import fill_slots
+from .post_cache import cached_post_detail
+from .read_models import (
+    CommentRow, comment_depth, comment_subtree, post_comments, stream_post_comments
+)
+from sqlalchemy import bindparam, delete as sql_delete, select, update
 
 bp = Blueprint("post", __name__)
 
 @bp.route('/<string:id>')
+@read_only
 def view(id):
     """
-    Show a specified post in detail
+    Show a specified post in detail. The article and the first page of
+    comments come from the fragment cache when this version of the post has
+    been rendered before, in which case the comments aren't loaded at all.
+    Conditional GETs are answered from the post's version alone. The post,
+    version included, comes from the post cache, so a commit made in
+    another process without a shared CACHE_CLIENT shows within
+    POST_CACHE_TTL.
+    """
+    post_id = uuid.UUID(id)
+    post_for_page = cached_post_detail(current_app.extensions['post_cache'], post_id)
+
+    if post_for_page is None:
+        abort(404, f"Post id {id} doesn't exist.")
+
+    # The user's own comments still on the write-behind queue
+    writer = current_app.extensions.get('comment_writer')
+    pending = writer.pending(post_id, g.user.id, post_for_page.version) if writer and g.user else []
+
+    etag = make_etag('post', post_id, post_for_page.version, *(comment.id for comment in pending))
+    # The modified time doesn't cover pending comments, so only the ETag is offered then
+    last_modified = None if pending else post_for_page.modified or post_for_page.created
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    fragments = current_app.extensions['fragment_cache']
+    article = fragments.get_or_render(
+        'post-article', post_for_page.id, post_for_page.version,
+        lambda: render_template('post/_post_article.html', post=post_for_page))
+    comments = fragments.get_or_render(
+        'post-comments', post_for_page.id, post_for_page.version,
+        lambda: render_comment_page(post_for_page.id))
+
+    if pending:
+        # Shown flat under the thread until written and rendered in place
+        # Without reply forms or edit links, neither works until they're written
+        pending = fill_slots(render_template('post/_comments.html',
+                                             comments=[row._replace(depth=0) for row in pending]), {})
+
+    response = render_template('post/post.html', post=post_for_page, article=article,
+                               comments=comments, pending=pending,
+                               user_actions=get_user_actions(post_for_page))
+    return add_validators(response, etag, last_modified)
+
+def render_comment_page(post_id, after=None):
+    """
+    HTML for a page of COMMENT_PAGE_SIZE comments, those after the path
+    `after` if given, ending in a "Load more" link when there are more
     """
-    stmt = select(Post).where(Post.id == uuid.UUID(id))
-    post_for_page = db_session.scalars(stmt).first()
+    page_size = current_app.config['COMMENT_PAGE_SIZE']
+    comments = post_comments(post_id, after=after, limit=page_size + 1)
+    more = None
+    if len(comments) > page_size:
+        comments = comments[:page_size]
+        # Comments without a path sort first, so carry on from the start
+        more = url_for('post.comment_page', id=post_id, after=comments[-1].path or '')
+    return render_template('post/_comments.html', comments=comments, post_id=post_id,
+                           more=more, continued=after is not None)
 
-    return render_template('post/post.html', post=post_for_page)
+# A comment path: whole segments of hex digits
+COMMENT_CURSOR = re.compile(f'(?:[0-9a-f]{{{PATH_SEGMENT_WIDTH}}})*')
+
+@bp.route('/<string:id>/comments')
+@read_only
+def comment_page(id):
+    """
+    The next page of a post's comments after ?after=<path of the last
+    comment shown>, as an HTML fragment for the post page's "Load more"
+    link. Cached and validated by the post's version like the post page.
+    """
+    post_id = uuid.UUID(id)
+    after = request.args.get('after')
+    if after is None or not COMMENT_CURSOR.fullmatch(after):
+        abort(400, "A valid after comment path is required.")
+
+    post = db_session.execute(select(Post.id, Post.version, Post.author_id)
+                              .where(Post.id == post_id)).first()
+    if post is None:
+        abort(404, f"Post id {id} doesn't exist.")
+
+    etag = make_etag('post-comments', post_id, post.version, after)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    html = current_app.extensions['fragment_cache'].get_or_render(
+        'post-comments', f'{post_id}:{after}', post.version,
+        lambda: render_comment_page(post_id, after))
+    return add_validators(fill_slots(html, get_user_actions(post)), etag)
+
+@bp.route('/<string:id>/comments/all')
+@read_only
+def all_comments(id):
+    """
+    Every comment of a post on one page, however many. Rows come off a
+    server-side cursor into a streamed template, so the page starts going
+    out straight away and only COMMENT_STREAM_BATCH rows are held at once.
+    """
+    stmt = select(Post.id, Post.title, Post.author_id).where(Post.id == uuid.UUID(id))
+    post = db_session.execute(stmt).first()
+    if post is None:
+        abort(404, f"Post id {id} doesn't exist.")
+
+    comments = stream_post_comments(post.id, current_app.config['COMMENT_STREAM_BATCH'])
+    # No cached fragment to fill in, user slots are filled as they're rendered
+    return stream_template('post/all_comments.html', post=post, comments=comments,
+                           user_slot=get_user_actions(post))
+
+REPLY_SLOT = 'reply:'
+
+def get_user_actions(post):
+    """
+    The current user's HTML for the user_slots in the cached fragments, as a
+    function of the slot name: Edit links or forms for whatever on the page
+    belongs to them, and a reply form under every comment. Anonymous readers get
+    neither.
+    """
+    if g.user is None:
+        return lambda name: ''
+
+    edit_link = Markup('<a class="action" href="{}">{}</a>')
+    delete_form = Markup('<form class="inline" action="{}" method="post">'
+                         '<input class="danger" type="submit" value="(Delete)" '
+                         'onclick="return confirm(\'Are you sure?\');"></form>')
+    actions = {}
+    if g.user.id == post.author_id:
+        actions[post.id] = edit_link.format(url_for('blog.update', id=post.id), 'Edit')
+
+    # edit_comment takes a POST, so comments get a form with their text to edit
+    edit_form = Markup('<details class="edit"><summary>(Edit)</summary>'
+                       '<form action="{}" method="post"><textarea name="text" required>{}</textarea>'
+                       '<input type="submit" value="Save"></form></details>')
+    stmt = select(Comment.id, Comment.body).where(Comment.parent_post_id == post.id,
+                                                  Comment.author_id == g.user.id)
+    for comment_id, body in db_session.execute(stmt):
+        actions[comment_id] = edit_form.format(url_for('post.edit_comment', id=comment_id), body)\
+                              + delete_form.format(url_for('post.delete_comment', id=comment_id))
+    actions = {str(name): html for name, html in actions.items()}
+
+    reply_form = Markup('<details class="reply"><summary>Reply</summary>'
+                        '<form action="{}" method="post"><textarea name="text" required></textarea>'
+                        '<input type="submit" value="Reply"></form></details>')
+    def fill(name):
+        name = str(name)
+        if name.startswith(REPLY_SLOT):
+            return reply_form.format(url_for('post.reply', id=name[len(REPLY_SLOT):]))
+        return actions.get(name, '')
+    return fill
+
+@bp.route('/<string:id>/events')
+@read_only
+def events(id):
+    """
+    Server-Sent Events stream of comments added to a post from now on. The
+    view returns straight after subscribing, so no db connection is held
+    while the stream is open; a comment every EVENTS_KEEPALIVE seconds keeps
+    proxies from closing it and notices clients that went away.
+    Each stream holds a server thread though, so past EVENTS_MAX_SUBSCRIBERS
+    they get a 503. This serves development and small sites; with EVENTS_URL
+    set pages stream from event_server instead, one thread for them all.
+    """
+    post_id = uuid.UUID(id)
+    if db_session.scalar(select(Post.id).where(Post.id == post_id)) is None:
+        abort(404, f"Post id {id} doesn't exist.")
+
+    try:
+        subscription = current_app.extensions['events'].subscribe(comment_channel(post_id))
+    except TooManySubscribers:
+        abort(503, 'Too many live comment streams right now, please try again.', retry_after=30)
+    keepalive = current_app.config['EVENTS_KEEPALIVE']
+
+    def stream():
+        yield 'retry: 5000\n\n'
+        while True:
+            messages = subscription.get(keepalive)
+            if not messages:
+                yield ': keepalive\n\n'
+            for message in messages:
+                yield format_event(message)
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(subscription.close)
+    return response
 
 @bp.route('/<string:post_id>/comment', methods=("POST",))
 @login_required
@@ -31,12 +223,89 @@ def add_comment(post_id):
     if comment_body == '':
         flash("Comment text is required")
     else:
-        new_comment = Comment(parent_post_id=uuid.UUID(post_id), author_id=g.user.id, body=comment_body)
-        db_session.add(new_comment)
-        db_session.commit()
+        parent_post_id = uuid.UUID(post_id)
+        if current_app.extensions.get('comment_writer') is not None:
+            # Checked here as the writer can't report back to the request
+            if db_session.scalar(select(Post.id).where(Post.id == parent_post_id)) is None:
+                abort(404, f"Post id {post_id} doesn't exist.")
+        save_comment(parent_post_id, comment_body)
 
     return redirect(url_for("post.view", id=post_id))
 
+@bp.route('/reply/<string:id>', methods=("POST",))
+@login_required
+def reply(id):
+    """
+    Reply to a comment. Returns 404 if it doesn't exist; replies nested
+    deeper than COMMENT_MAX_DEPTH are refused.
+    """
+    stmt = select(Comment.id, Comment.parent_post_id, Comment.path, comment_depth.label('depth'))\
+               .where(Comment.id == uuid.UUID(id))
+    parent = db_session.execute(stmt).first()
+
+    if parent is None:
+        abort(404, f"Comment id {id} doesn't exist.")
+
+    comment_body = request.form['text']
+    if comment_body == '':
+        flash("Comment text is required")
+    elif parent.path is None:
+        flash("This comment can't be replied to yet")
+    elif parent.depth + 1 > current_app.config['COMMENT_MAX_DEPTH']:
+        flash("This thread is too deep to reply to")
+    else:
+        save_comment(parent.parent_post_id, comment_body, parent)
+
+    return redirect(url_for("post.view", id=parent.parent_post_id))
+
+def save_comment(post_id, body, parent=None):
+    """
+    Stores a comment by the current user, or a reply when parent (a row with
+    id and path) is given: through the write-behind queue when it's on,
+    else in this request's transaction. Announces it once committed.
+    """
+    parent_id = parent.id if parent is not None else None
+    parent_path = parent.path if parent is not None else ''
+
+    writer = current_app.extensions.get('comment_writer')
+    if writer is not None:
+        writer.submit(post_id, g.user.id, g.user.name, body, parent_id, parent_path)
+        # The comment lands on the primary, keep this user reading from it
+        db_session().info['wrote'] = db_session().info['pinned'] = True
+        return
+
+    comment_id = uuid7()
+    path = comment_path(comment_id, parent_path)
+    body_html = render_markdown(body)
+    new_comment = Comment(id=comment_id, parent_post_id=post_id, author_id=g.user.id,
+                          body=body, body_html=body_html, parent_id=parent_id, path=path)
+    db_session.add(new_comment)
+    touch_post(post_id, comment_delta=1)
+    db_session.commit()
+    publish_comment(current_app.extensions['events'], post_id,
+                    CommentRow(comment_id, body, body_html, new_comment.created, g.user.id, g.user.name,
+                               parent_id, len(path) // PATH_SEGMENT_WIDTH - 1, path))
+
+@bp.route('/comment/<string:id>')
+@read_only
+def thread(id):
+    """
+    A comment and its replies on their own page, e.g. to follow a long
+    thread or link to part of it
+    """
+    comments = comment_subtree(uuid.UUID(id))
+    if not comments:
+        abort(404, f"Comment id {id} doesn't exist.")
+
+    root_depth = comments[0].depth
+    comments = [comment._replace(depth=comment.depth - root_depth) for comment in comments]
+    post = db_session.execute(select(Post.id, Post.author_id)
+                              .join(Comment, Comment.parent_post_id == Post.id)
+                              .where(Comment.id == comments[0].id)).first()
+    # Not cached, so the user slots are filled as they're rendered
+    return render_template('post/thread.html', comments=comments, post_id=post.id,
+                           user_slot=get_user_actions(post))
+
 @bp.route('/edit-comment/<string:id>', methods=("POST",))
 @login_required
 def edit_comment(id):
@@ -53,5 +322,70 @@ def edit_comment(id):
         abort(403)
 
     revised_comment.body = request.form['text']
-    db_session.commit
-    
+    revised_comment.body_html = render_markdown(revised_comment.body)
+    touch_post(revised_comment.parent_post_id)
+    db_session.commit()
+
+    return redirect(url_for("post.view", id=revised_comment.parent_post_id))
+
+@bp.route('/delete-comment/<string:id>', methods=("POST",))
+@login_required
+def delete_comment(id):
+    """
+    Delete a comment and its replies. Returns 404 if it doesn't exist and
+    403 if the requester didn't write it.
+    """
+    stmt = select(Comment).where(Comment.id == uuid.UUID(id))
+    comment = db_session.scalars(stmt).first()
+
+    if comment is None:
+        abort(404, f"Comment id {id} doesn't exist.")
+
+    if comment.author_id != g.user.id:
+        abort(403)
+
+    # Replies go with the comment, they're the rest of its path range
+    post_id = comment.parent_post_id
+    if comment.path is None:
+        stmt = sql_delete(Comment).where(Comment.id == comment.id)
+    else:
+        stmt = sql_delete(Comment).where(Comment.parent_post_id == post_id,
+                                         Comment.path >= comment.path,
+                                         Comment.path < comment.path + 'g')
+    deleted = db_session.execute(stmt, execution_options={'synchronize_session': False}).rowcount
+    db_session.expunge(comment)
+    touch_post(post_id, comment_delta=-deleted)
+    db_session.commit()
+
+    return redirect(url_for("post.view", id=post_id))
+
+def repair_comment_paths(session, batch_size=10000):
+    """
+    Gives comments from before replies existed their path. They're all top
+    level, so each path is just the comment's own segment. Returns how many
+    were fixed.
+    """
+    stmt = update(Comment).where(Comment.id == bindparam('comment_id')).values(path=bindparam('new_path'))
+    count = 0
+    while True:
+        rows = session.execute(select(Comment.id, Comment.created)
+                               .where(Comment.path.is_(None)).limit(batch_size)).all()
+        if not rows:
+            return count
+        session.connection().execute(stmt, [
+            {'comment_id': row.id, 'new_path': comment_path(row.id, created=row.created)}
+            for row in rows
+        ])
+        session.commit()
+        count += len(rows)
+
+@click.command('repair-comment-paths')
+def repair_comment_paths_command():
+    """
+    Define cmdline arg to fill in the paths of comments from before replies.
+    """
+    count = repair_comment_paths(db_session)
+    click.echo(f'Set the path of {count} comments.')
+
+def init_post_commands(app):
+    app.cli.add_command(repair_comment_paths_command)
@@ -0,0 +1,177 @@
+'''
+Second-level cache of posts by id, in front of blog.get_post and the post
+page. Entries are CachedPost tuples, every Post column plus the author's
+name, so one entry serves the page's version check and its article, and
+get_post's existence and author checks. Only reads are served from it:
+routes that change a post load it from the database.
+
+Commits drop the entries they change. Session events collect the posts a
+transaction touched: ORM flushes of Post objects, and UPDATE/DELETE
+statements on post, which name their posts with the 'post_ids' execution
+option (as touch_post does) or else clear the whole cache. The write-behind
+comment writer, which commits outside the session, invalidates directly.
+'''
+import threading
+import weakref
+from collections import namedtuple
+from concurrent.futures import Future
+from itertools import chain
+
+from sqlalchemy import event, inspect, select
+
+from .cache import make_cache
+from .db_alchemy import db_session
+from .data_model import Post, User
+from .read_models import PostDetail
+
+POST_COLUMNS = [attribute.key for attribute in inspect(Post).column_attrs]
+
+CachedPost = namedtuple('CachedPost', POST_COLUMNS + ['author_name'])
+
+# session.info key for the post ids to drop on commit; ALL drops everything
+PENDING = 'post_cache_pending'
+ALL = object()
+
+class PostCache:
+    '''
+    Read-through cache of CachedPosts over a cache.CacheBackend, which
+    brings the TTL and bounded LRU eviction (or sharing between workers).
+    Concurrent misses on one post collapse into one load: the first thread
+    queries and the others wait for its result. A load that overlaps an
+    invalidation isn't stored, so the row read just before a commit can't
+    replace the entry the commit dropped.
+    '''
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._loading = {} # key: Future of the load in progress
+        self._invalidations = 0
+
+    def get(self, post_id, load):
+        '''
+        The entry for post_id, calling load(post_id) on a miss. Missing
+        posts (load returns None) aren't cached.
+        '''
+        key = str(post_id)
+        value = self.backend.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        with self._lock:
+            future = self._loading.get(key)
+            if future is not None:
+                waiting = True
+            else:
+                waiting = False
+                future = self._loading[key] = Future()
+                generation = self._invalidations
+                self.misses += 1
+        if waiting:
+            return future.result()
+
+        try:
+            value = load(post_id)
+        except BaseException as error:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(error)
+            raise
+
+        with self._lock:
+            del self._loading[key]
+            if value is not None and generation == self._invalidations:
+                self.backend.set(key, value)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, post_id):
+        with self._lock:
+            self._invalidations += 1
+        self.backend.delete(str(post_id))
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += 1
+        self.backend.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+# Every app's cache, db_session being shared by them all
+_caches = weakref.WeakSet()
+
+def _load(post_id):
+    stmt = select(*(getattr(Post, key) for key in POST_COLUMNS), User.name)\
+               .join(User, Post.author_id == User.id)\
+               .where(Post.id == post_id)
+    # Always from the primary, a lagging replica's copy would outlive its lag
+    row = db_session.execute(stmt, bind_arguments={'bind': db_session.bind}).first()
+    return None if row is None else CachedPost._make(row)
+
+def cached_post(cache, post_id):
+    '''
+    The CachedPost for post_id, or None if there's no such post. Sessions
+    with uncommitted changes to posts, or pinned to the primary after a
+    write, read the database instead so they always see their own writes.
+    '''
+    session = db_session()
+    if session.info.get(PENDING) or session.info.get('pinned'):
+        return _load(post_id)
+    return cache.get(post_id, _load)
+
+def cached_post_detail(cache, post_id):
+    '''
+    The post page's PostDetail for post_id from the cache, or None
+    '''
+    post = cached_post(cache, post_id)
+    return None if post is None else PostDetail._make(getattr(post, field) for field in PostDetail._fields)
+
+@event.listens_for(db_session, 'after_flush')
+def _note_flushed_posts(session, flush_context):
+    changed = [obj.id for obj in chain(session.dirty, session.deleted) if isinstance(obj, Post)]
+    if changed:
+        session.info.setdefault(PENDING, set()).update(changed)
+
+@event.listens_for(db_session, 'do_orm_execute')
+def _note_post_statements(orm_execute_state):
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) \
+            and orm_execute_state.bind_mapper is inspect(Post):
+        post_ids = orm_execute_state.execution_options.get('post_ids')
+        pending = orm_execute_state.session.info.setdefault(PENDING, set())
+        if post_ids is not None:
+            pending.update(post_ids)
+        else:
+            pending.add(ALL)
+
+@event.listens_for(db_session, 'after_commit')
+def _invalidate_committed(session):
+    pending = session.info.pop(PENDING, None)
+    if not pending:
+        return
+    for cache in list(_caches):
+        if ALL in pending:
+            cache.clear()
+        else:
+            for post_id in pending:
+                cache.invalidate(post_id)
+
+@event.listens_for(db_session, 'after_transaction_end')
+def _forget_rolled_back(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(PENDING, None)
+
+def init_app(app):
+    cache = app.extensions['post_cache'] = PostCache(
+        make_cache(app.config, 'post',
+                   maxsize=app.config['POST_CACHE_SIZE'],
+                   ttl=app.config['POST_CACHE_TTL']))
+    _caches.add(cache)
@@ -0,0 +1,220 @@
+'''
+Serving from several worker processes forked from one preloaded app. The
+parent creates and warms the app once, then forks; workers share its memory
+copy-on-write rather than each importing, compiling templates and filling
+caches on their own.
+
+Nothing that holds a connection or a thread may cross the fork:
+
+- before_fork() in the parent closes its pooled database connections.
+- after_fork() in each worker drops the pools and sessions it inherited
+  without closing their connections, which are still the parent's, and
+  starts the password hashing pool, event listener and comment writer
+  afresh, then start_event_server() if live comments have a socket. Engines also refuse any inherited connection on checkout (see
+  db_alchemy.make_engine), so other forks are safe as well.
+
+Workers only share what lives outside them, so check_workers() refuses to
+start several without the shared event and cache backends.
+
+The parent must not be serving requests on other threads when it forks;
+the comment writer and events listener only start on first use, so warming
+up doesn't start them. gunicorn.conf.py runs these hooks under gunicorn
+with preload_app; `flask serve` runs them with werkzeug's server on a
+shared listening socket, for running several workers without gunicorn.
+'''
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from werkzeug.serving import make_server
+
+from .blog import feed_page
+from .db_alchemy import db_session
+from .data_model import Post
+from .event_server import EventServer
+from .fragments import cached_fragment
+from .post_cache import cached_post
+from .read_models import feed_posts
+
+# A worker dying sooner than this after its fork failed to start, rather than
+# being replaced the server stops
+BOOT_SECONDS = 1
+
+# What goes wrong between workers when each keeps its own
+SHARED_BACKENDS = {
+    'EVENTS_CLIENT': 'live comments only reach readers on the worker that took them',
+    'CACHE_CLIENT': 'cached users and pages are only dropped by the worker that changed them',
+}
+
+def _engines():
+    factory_kw = db_session.session_factory.kw
+    return [factory_kw['bind'], *factory_kw.get('replicas', ())]
+
+def check_workers(app, workers, threads=None):
+    '''
+    Raises click.ClickException if app can't be served by `workers`
+    processes of `threads` threads each (None for unbounded): with more than
+    one worker every SHARED_BACKENDS setting must be configured, unless
+    PREFORK_ALLOW_LOCAL_STATE says to go ahead with a warning, and each
+    worker needs threads to spare beyond its live comment streams.
+    '''
+    config = app.config
+    if workers > 1:
+        missing = [f'{name} is not set, {effect}' for name, effect in SHARED_BACKENDS.items()
+                   if config[name] is None]
+        if missing and config['PREFORK_ALLOW_LOCAL_STATE']:
+            for problem in missing:
+                app.logger.warning('Serving from %d workers but %s.', workers, problem)
+        elif missing:
+            raise click.ClickException(
+                f'Serving from {workers} workers but ' + '; '.join(missing) +
+                '. Set PREFORK_ALLOW_LOCAL_STATE to serve anyway.')
+    streams = config['EVENTS_MAX_SUBSCRIBERS']
+    if threads is not None and (streams is None or streams >= threads):
+        raise click.ClickException(
+            f'EVENTS_MAX_SUBSCRIBERS ({streams}) must be under the {threads} threads per worker, '
+            'or live comment streams can hold them all.')
+
+def warm_up(app):
+    '''
+    Does in the parent what each worker would otherwise do on its first
+    requests: compiles every template into the Jinja cache and loads the
+    newest page of the feed into the post and fragment caches. Returns the
+    number of templates and of posts warmed.
+    '''
+    env = app.jinja_env
+    templates = env.list_templates()
+    for name in templates:
+        env.get_template(name)
+
+    with app.test_request_context('/'):
+        page, _, _ = feed_page(select(Post.id), 'new', None, None, app.config['POSTS_PER_PAGE'])
+        post_ids = [row.id for row in page]
+        cache = app.extensions['post_cache']
+        for post_id in post_ids:
+            cached_post(cache, post_id)
+        for post in feed_posts(post_ids, app.config['FEED_PREVIEW_CHARS']):
+            cached_fragment('blog/_post_article.html', post.id, post.version, post=post)
+
+    return len(templates), len(post_ids)
+
+def before_fork():
+    '''
+    Closes the parent's pooled connections so no worker inherits open ones
+    '''
+    db_session.remove()
+    for engine in _engines():
+        engine.dispose()
+
+def after_fork(app):
+    '''
+    First thing in each worker, before it takes any requests
+    '''
+    # Closing these would end the parent's transactions and connections
+    db_session.registry.clear()
+    for engine in _engines():
+        engine.dispose(close=False)
+    for name in ('password_hasher', 'events', 'comment_writer'):
+        if name in app.extensions:
+            app.extensions[name].after_fork()
+
+def start_event_server(app, listener):
+    '''
+    In a worker, after after_fork(): serves live comment streams accepted on
+    listener, shared by all the workers, from an event loop thread
+    '''
+    server = EventServer(app, app.config['EVENTS_SERVER_MAX_CLIENTS'])
+    server.start(listener)
+    return server
+
+def _run_worker(app, listener, events_listener):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        after_fork(app)
+        if events_listener is not None:
+            start_event_server(app, events_listener)
+        host, port = listener.getsockname()[:2]
+        make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        # Never return into the parent's code (or its atexit handlers)
+        os._exit(1)
+
+def serve(app, host='127.0.0.1', port=8000, workers=2, echo=print, events_port=None):
+    '''
+    Serves app from `workers` forked processes accepting on one socket,
+    replacing any that die, until the parent gets SIGINT or SIGTERM.
+    Each worker runs werkzeug's threaded server, and with events_port an
+    event_server.EventServer for live comment streams, which pages then use
+    unless EVENTS_URL says otherwise.
+    '''
+    check_workers(app, workers)
+    listener = socket.create_server((host, port))
+    host, port = listener.getsockname()[:2]
+    events_listener = None
+    if events_port is not None:
+        events_listener = socket.create_server((host, events_port))
+        events_port = events_listener.getsockname()[1]
+        app.config['EVENTS_URL'] = app.config['EVENTS_URL'] or f'http://{host}:{events_port}'
+    templates, posts = warm_up(app)
+    echo(f'Warmed {templates} templates and {posts} posts.')
+    before_fork()
+
+    children = {} # pid: time forked
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(app, listener, events_listener)
+        children[pid] = time.monotonic()
+        echo(f'Booted worker {pid}.')
+
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for _ in range(workers):
+            spawn()
+        if events_listener is not None:
+            echo(f"Live comments on {app.config['EVENTS_URL']}.")
+        echo(f'Serving on http://{host}:{port} with {workers} workers.')
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid)
+            if time.monotonic() - started < BOOT_SECONDS:
+                raise click.ClickException(f'Worker {pid} failed to start.')
+            echo(f'Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, replacing it.')
+            spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            os.waitpid(pid, 0)
+        listener.close()
+        if events_listener is not None:
+            events_listener.close()
+
+@click.command('serve')
+@click.option('--host', default='127.0.0.1', help='Interface to listen on.')
+@click.option('--port', default=8000, help='Port to listen on, 0 picks a free one.')
+@click.option('--workers', default=2, help='Worker processes.')
+@click.option('--events-port', type=int, help='Port for live comment streams, 0 picks a free one.')
+@with_appcontext
+def serve_command(host, port, workers, events_port):
+    '''
+    Define cmdline arg to serve the app from several forked worker processes.
+    '''
+    serve(current_app._get_current_object(), host, port, workers, echo=click.echo,
+          events_port=events_port)
+
+def init_app(app):
+    app.cli.add_command(serve_command)
@@ -0,0 +1,109 @@
+'''
+Read models for the hot pages. Each is a named tuple filled from a select of
+just the columns the page shows, so rendering never loads whole Post/User
+entities (bodies it won't print, password hashes) or pays for identity map
+bookkeeping.
+'''
+from collections import namedtuple
+
+from sqlalchemy import case, func, select
+
+from .db_alchemy import db_session
+from .data_model import PATH_SEGMENT_WIDTH, User, Post, Comment
+
+# A feed entry. preview_html is the rendered start of the body, preview its
+# source only for posts not rendered yet; truncated says there's more.
+FeedPost = namedtuple('FeedPost', [
+    'id', 'title', 'preview_html', 'preview', 'truncated', 'created', 'version',
+    'comment_count', 'author_id', 'author_name',
+])
+
+# The post page's article. body is the source, only selected for posts
+# whose body_html isn't stored yet; comments' likewise.
+PostDetail = namedtuple('PostDetail', [
+    'id', 'title', 'body', 'body_html', 'created', 'modified', 'version', 'author_id',
+    'author_name',
+])
+
+# depth is 0 for top level comments, 1 for their replies and so on
+CommentRow = namedtuple('CommentRow', [
+    'id', 'body', 'body_html', 'created', 'author_id', 'author_name', 'parent_id', 'depth',
+    'path',
+])
+
+# A comment's depth from its path length, 0 for comments without a path. The
+# coalesce goes inside: SQLite's floor division is a Python function that
+# fails on NULL.
+comment_depth = func.coalesce(func.length(Comment.path), PATH_SEGMENT_WIDTH) // PATH_SEGMENT_WIDTH - 1
+
+def _unless_rendered(source, html):
+    '''
+    source where html is null, else null, so the source text of rows
+    already rendered isn't read out as well
+    '''
+    return case((html.is_(None), source))
+
+def _select_comments():
+    return select(Comment.id, _unless_rendered(Comment.body, Comment.body_html),
+                  Comment.body_html, Comment.created, Comment.author_id, User.name,
+                  Comment.parent_id, comment_depth, Comment.path)\
+               .join(User, Comment.author_id == User.id)
+
+def feed_posts(post_ids, preview_chars):
+    '''
+    FeedPosts for post_ids in the order given. Only the stored preview, or
+    the first preview_chars of the body for posts without one, leave the
+    database.
+    '''
+    stmt = select(Post.id, Post.title, Post.preview_html,
+                  _unless_rendered(func.substr(Post.body, 1, preview_chars), Post.preview_html),
+                  func.length(Post.body) > preview_chars, Post.created, Post.version,
+                  Post.comment_count, Post.author_id, User.name)\
+               .join(User, Post.author_id == User.id)\
+               .where(Post.id.in_(post_ids))
+    by_id = {row.id: row for row in map(FeedPost._make, db_session.execute(stmt))}
+    return [by_id[post_id] for post_id in post_ids if post_id in by_id]
+
+def _select_post_comments(post_id, after=None):
+    stmt = _select_comments().where(Comment.parent_post_id == post_id)
+    if after is not None:
+        stmt = stmt.where(Comment.path > after)
+    return stmt.order_by(Comment.path, Comment.created, Comment.id)
+
+def post_comments(post_id, after=None, limit=None):
+    '''
+    CommentRows of a post in thread order (depth first, siblings oldest
+    first), one query however long or deep the thread. Pages of `limit`
+    rows are keyed on the path of the last comment shown, `after`: its
+    segments are each comment's (created, id), so this is a keyset on
+    (created, id) level by level, served by the (post, path) index. The
+    path is all the cursor needs, so deleting that comment doesn't lose
+    the rest of the thread. Comments without a path (before
+    repair-comment-paths) only come on the first page.
+    '''
+    stmt = _select_post_comments(post_id, after)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return [CommentRow._make(row) for row in db_session.execute(stmt)]
+
+def stream_post_comments(post_id, batch_size=500):
+    '''
+    All CommentRows of a post in thread order, read lazily off a server-side
+    cursor so only batch_size rows are in memory at a time. The query runs
+    now; the rows arrive as the result is iterated.
+    '''
+    result = db_session.execute(_select_post_comments(post_id).execution_options(yield_per=batch_size))
+    return map(CommentRow._make, result)
+
+def comment_subtree(comment_id):
+    '''
+    CommentRows of a comment and all its replies in thread order, or an
+    empty list if there's no such comment. One query: the subtree is the
+    range of paths from the root's up to the root's followed by 'g', past
+    any hex digit, which is a single range scan of the path index.
+    '''
+    root = select(Comment.parent_post_id, Comment.path).where(Comment.id == comment_id).subquery()
+    stmt = _select_comments().join(root, Comment.parent_post_id == root.c.parent_post_id)\
+                             .where(Comment.path >= root.c.path, Comment.path < root.c.path + 'g')\
+                             .order_by(Comment.path)
+    return [CommentRow._make(row) for row in db_session.execute(stmt)]
@@ -0,0 +1,143 @@
+from flask import (
+    Blueprint, current_app, render_template, request
+)
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, Float, String, event, text
+from werkzeug.exceptions import abort
+import click
+
+from .db_alchemy import Base, db_session, read_only
+from .ids import BinaryUUID
+
+bp = Blueprint('search', __name__)
+
+# FTS5 tables over post and comment as external content, so the text isn't
+# stored twice. They're keyed by the tables' implicit rowids and kept in step
+# by triggers, so every write path (ORM, bulk inserts, raw SQL) stays indexed.
+# VACUUM may renumber rowids of tables without an integer primary key; run
+# rebuild-search after one.
+SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+    "title, body, content='post', content_rowid='rowid')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS comment_fts USING fts5("
+    "body, content='comment', content_rowid='rowid')",
+
+    "CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_fts(rowid, title, body) VALUES (new.rowid, new.title, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, title, body) VALUES ('delete', old.rowid, old.title, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF title, body ON post BEGIN "
+    "INSERT INTO post_fts(post_fts, rowid, title, body) VALUES ('delete', old.rowid, old.title, old.body); "
+    "INSERT INTO post_fts(rowid, title, body) VALUES (new.rowid, new.title, new.body); END",
+
+    "CREATE TRIGGER IF NOT EXISTS comment_fts_insert AFTER INSERT ON comment BEGIN "
+    "INSERT INTO comment_fts(rowid, body) VALUES (new.rowid, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS comment_fts_delete AFTER DELETE ON comment BEGIN "
+    "INSERT INTO comment_fts(comment_fts, rowid, body) VALUES ('delete', old.rowid, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS comment_fts_update AFTER UPDATE OF body ON comment BEGIN "
+    "INSERT INTO comment_fts(comment_fts, rowid, body) VALUES ('delete', old.rowid, old.body); "
+    "INSERT INTO comment_fts(rowid, body) VALUES (new.rowid, new.body); END",
+]
+
+for statement in SEARCH_DDL:
+    event.listen(Base.metadata, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for table in ('post_fts', 'comment_fts'):
+    event.listen(Base.metadata, 'before_drop',
+                 DDL(f'DROP TABLE IF EXISTS {table}').execute_if(dialect='sqlite'))
+
+# Snippet markers, swapped for <mark> once the snippet text is escaped
+MARK_START, MARK_END = '\x02', '\x03'
+
+# Posts and comments ranked together. bm25() is lower for better matches.
+SEARCH_SQL = text(f'''
+    SELECT 'post' AS kind, post.id AS post_id, post.title AS title,
+           snippet(post_fts, 1, '{MARK_START}', '{MARK_END}', '…', 16) AS snippet,
+           bm25(post_fts, 2.0, 1.0) AS rank
+    FROM post_fts JOIN post ON post.rowid = post_fts.rowid
+    WHERE post_fts MATCH :query
+    UNION ALL
+    SELECT 'comment', post.id, post.title,
+           snippet(comment_fts, 0, '{MARK_START}', '{MARK_END}', '…', 16),
+           bm25(comment_fts)
+    FROM comment_fts JOIN comment ON comment.rowid = comment_fts.rowid
+                     JOIN post ON post.id = comment.parent_post_id
+    WHERE comment_fts MATCH :query
+    ORDER BY rank
+    LIMIT :limit OFFSET :offset
+''').columns(kind=String, post_id=BinaryUUID, title=String, snippet=String, rank=Float)
+
+def fts_query(terms):
+    '''
+    Turns free text into an FTS5 query matching all of its words. Each word is
+    quoted so user input can't inject FTS syntax; a trailing * is kept for
+    prefix search.
+    '''
+    parts = []
+    for word in terms.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            parts.append(f'"{word}"' + ('*' if prefix else ''))
+    return ' '.join(parts)
+
+def highlight(snippet):
+    '''
+    Escapes a snippet and marks up the matched terms
+    '''
+    return Markup(str(escape(snippet)).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+def search(terms, page=1, per_page=20):
+    '''
+    Ranked matches for terms across posts and comments. Returns one extra
+    row beyond per_page so callers can tell whether another page exists.
+    '''
+    if db_session.get_bind().dialect.name != 'sqlite':
+        abort(501, 'Search needs the SQLite FTS5 index.')
+
+    query = fts_query(terms)
+    if not query:
+        return []
+    return db_session.execute(SEARCH_SQL, {
+        'query': query, 'limit': per_page + 1, 'offset': (page - 1) * per_page,
+    }).all()
+
+@bp.route('/search')
+@read_only
+def results():
+    '''
+    Search page. ?q= holds the words to look for, ?page= the results page.
+    '''
+    terms = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(400, 'Page must be 1 or more.')
+    per_page = current_app.config['SEARCH_RESULTS_PER_PAGE']
+
+    rows = search(terms, page, per_page) if terms else []
+    return render_template('search/search.html', terms=terms, page=page,
+                           results=rows[:per_page], has_next=len(rows) > per_page,
+                           highlight=highlight)
+
+def rebuild_search_index(engine):
+    '''
+    Creates the search tables and triggers if missing (e.g. on a database made
+    before search existed) and re-indexes every post and comment in bulk
+    '''
+    with engine.begin() as conn:
+        for statement in SEARCH_DDL:
+            conn.exec_driver_sql(statement)
+        conn.exec_driver_sql("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+        conn.exec_driver_sql("INSERT INTO comment_fts(comment_fts) VALUES ('rebuild')")
+        conn.exec_driver_sql("INSERT INTO post_fts(post_fts) VALUES ('optimize')")
+        conn.exec_driver_sql("INSERT INTO comment_fts(comment_fts) VALUES ('optimize')")
+
+@click.command('rebuild-search')
+def rebuild_search_command():
+    '''
+    Define cmdline arg to rebuild the full text search index.
+    '''
+    rebuild_search_index(db_session.bind)
+    click.echo('Rebuilt the search index.')
+
+def init_search_command(app):
+    app.cli.add_command(rebuild_search_command)
@@ -1,4 +1,9 @@
 function toggleComment(commentId) {
     let content = document.getElementById("comment-" + commentId);
     content.classList.toggle("hidden");
-}
\ No newline at end of file
+    // Collapsing a comment folds away its replies too
+    let replies = document.getElementById("replies-" + commentId);
+    if (replies) {
+        replies.classList.toggle("hidden");
+    }
+}
@@ -0,0 +1,51 @@
+function followComments(container, button) {
+    let source = new EventSource(container.dataset.stream);
+    button.disabled = true;
+    button.textContent = "Following new comments";
+    source.addEventListener("error", function () {
+        // Refused (the server is at its limit of streams) rather than dropped
+        if (source.readyState === EventSource.CLOSED) {
+            button.disabled = false;
+            button.textContent = "Follow new comments";
+        }
+    });
+    source.addEventListener("comment", function (event) {
+        let comment = JSON.parse(event.data);
+        if (document.getElementById("comment-" + comment.id)) {
+            return;
+        }
+        let article = document.createElement("article");
+        article.className = "comment";
+        let header = document.createElement("div");
+        header.className = "comment-header";
+        header.onclick = function () { toggleComment(comment.id); };
+        let author = document.createElement("div");
+        author.className = "comment_author";
+        author.textContent = comment.author_name;
+        header.appendChild(author);
+        let body = document.createElement("div");
+        body.className = "comment-content";
+        body.id = "comment-" + comment.id;
+        let text = document.createElement("div");
+        text.className = "comment-body";
+        // Sanitized when the comment was written
+        text.innerHTML = comment.body_html;
+        body.appendChild(text);
+        article.appendChild(header);
+        article.appendChild(document.createElement("br"));
+        article.appendChild(body);
+        // Replies go under their parent when it's on the page
+        let parent = comment.parent_id && document.getElementById("replies-" + comment.parent_id);
+        if (parent) {
+            parent.appendChild(article);
+        } else {
+            container.appendChild(document.createElement("hr"));
+            container.appendChild(article);
+        }
+    });
+}
+
+// Streams hold a server thread each, so only readers who ask get one
+document.querySelector("#live-comments .follow").addEventListener("click", function (event) {
+    followComments(document.getElementById("live-comments"), event.target);
+});
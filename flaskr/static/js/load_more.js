@@ -0,0 +1,11 @@
+// "Load more comments" links fetch the next page in place of themselves
+document.addEventListener("click", function (event) {
+    let link = event.target.closest(".load-more a[data-more]");
+    if (!link) {
+        return;
+    }
+    event.preventDefault();
+    fetch(link.dataset.more)
+        .then(function (response) { return response.text(); })
+        .then(function (html) { link.parentElement.outerHTML = html; });
+});
@@ -0,0 +1,252 @@
+import atexit
+import functools
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone
+
+from sqlalchemy import func, insert, select, update
+from werkzeug.exceptions import abort
+
+from .db_alchemy import db_session
+from .data_model import PATH_SEGMENT_WIDTH, Post, Comment, comment_path
+from .events import publish_comment
+from .ids import uuid7
+from .markdown import render_markdown
+from .read_models import CommentRow
+
+log = logging.getLogger(__name__)
+
+# 'queued' acknowledges a comment once it's on the queue, so it's lost if the
+# process dies before the batch commits. 'committed' waits for the commit,
+# which still batches concurrent comments into one transaction.
+DURABILITY = ('queued', 'committed')
+
+class _Pending:
+    '''
+    A comment on its way to the database. committed_version is the post's
+    version once the comment's batch has committed: renders of that version
+    or later include the comment.
+    '''
+    __slots__ = ('row', 'post_id', 'path', 'future', 'committed_version', 'committed_at')
+
+    def __init__(self, row, post_id, path):
+        self.row = row
+        self.post_id = post_id
+        self.path = path
+        self.future = Future()
+        self.committed_version = None
+        self.committed_at = None
+
+class CommentWriter:
+    '''
+    Write-behind for comments. Requests put comments on a bounded queue and
+    a background thread writes them in batches, one transaction per batch,
+    so a burst of comments takes SQLite's write lock a few times rather than
+    once per comment.
+
+    Backpressure: when the queue stays full for `timeout` seconds, or with
+    'committed' durability the commit takes longer than that, submit answers
+    503. Comments not yet rendered from the database are kept per post so
+    their authors see them straight away. That only holds within this
+    process: served from several workers, an author's next request may go to
+    one that hasn't heard of the comment, and only sees it once it commits
+    ('committed' durability has it in the database before submit returns).
+    close() writes out whatever is queued and runs at exit.
+    '''
+    def __init__(self, engine, maxsize=1000, batch_size=100, linger=0.01,
+                 durability='queued', timeout=2, keep=60, on_commit=None):
+        if durability not in DURABILITY:
+            raise ValueError(f'durability must be one of {DURABILITY}, not {durability!r}')
+        self.engine = engine
+        self.batch_size = batch_size
+        self.linger = linger
+        self.durability = durability
+        self.timeout = timeout
+        self.keep = keep
+        self.on_commit = on_commit # called with (post id, CommentRow) once written
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._pending = {} # post id: {comment id: _Pending}
+        self._thread = None
+
+    def submit(self, post_id, author_id, author_name, body, parent_id=None, parent_path=''):
+        '''
+        Queues a comment, or a reply to parent_id, and returns its
+        CommentRow. Waits for the commit when durability is 'committed'.
+        '''
+        now = datetime.now(timezone.utc)
+        comment_id = uuid7()
+        path = comment_path(comment_id, parent_path, now)
+        # Rendered here in the request rather than holding up the writer thread
+        row = CommentRow(comment_id, body, render_markdown(body), now.replace(tzinfo=None, microsecond=0),
+                         author_id, author_name, parent_id, len(path) // PATH_SEGMENT_WIDTH - 1, path)
+        entry = _Pending(row, post_id, path)
+        self._start()
+        with self._lock:
+            self._pending.setdefault(post_id, {})[entry.row.id] = entry
+
+        try:
+            self._queue.put(entry, timeout=self.timeout)
+        except queue.Full:
+            self._forget([entry])
+            abort(503, 'Too many comments right now, please try again.')
+
+        if self.durability == 'committed':
+            try:
+                entry.future.result(self.timeout)
+            except FutureTimeoutError:
+                # Still queued, it'll be written and shown to its author meanwhile
+                abort(503, 'Your comment is taking a while to save, it should appear shortly.')
+        return entry.row
+
+    def pending(self, post_id, author_id, version):
+        '''
+        author_id's comments on post_id that a render of the post at version
+        doesn't include yet
+        '''
+        with self._lock:
+            entries = list(self._pending.get(post_id, {}).values())
+        return [entry.row for entry in entries
+                if entry.row.author_id == author_id
+                and (entry.committed_version is None or version < entry.committed_version)]
+
+    def flush(self):
+        '''
+        Blocks until everything queued so far is written
+        '''
+        self._queue.join()
+
+    def close(self, timeout=None):
+        '''
+        Writes out the queue and stops the writer thread
+        '''
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def after_fork(self):
+        '''
+        Starts afresh in a forked child. The parent's writer thread doesn't
+        carry over and what it has queued is the parent's to write.
+        '''
+        self._queue = queue.Queue(self._queue.maxsize)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='comment-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            entry = self._queue.get()
+            batch = []
+            # Linger briefly so a burst shares one transaction
+            deadline = time.monotonic() + self.linger
+            while True:
+                if entry is None:
+                    stopping = True
+                    self._queue.task_done()
+                else:
+                    batch.append(entry)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+            self._prune()
+
+    def _write(self, batch):
+        try:
+            versions = self._commit(batch)
+        except Exception as error:
+            if len(batch) > 1:
+                # Retry one by one so a bad comment doesn't take the rest down
+                for entry in batch:
+                    self._write([entry])
+                return
+            log.exception('Dropped comment %s on post %s', batch[0].row.id, batch[0].post_id)
+            self._forget(batch)
+            batch[0].future.set_exception(error)
+            return
+
+        committed_at = time.monotonic()
+        for entry in batch:
+            entry.committed_version = versions.get(entry.post_id, 0)
+            entry.committed_at = committed_at
+            entry.future.set_result(entry.row)
+            if self.on_commit is not None:
+                try:
+                    self.on_commit(entry.post_id, entry.row)
+                except Exception:
+                    log.exception('on_commit failed for comment %s', entry.row.id)
+
+    def _commit(self, batch):
+        '''
+        Inserts a batch and bumps its posts like touch_post, in one
+        transaction. Returns the posts' new versions.
+        '''
+        per_post = Counter(entry.post_id for entry in batch)
+        with self.engine.begin() as conn:
+            conn.execute(insert(Comment), [
+                {'id': entry.row.id, 'parent_post_id': entry.post_id,
+                 'author_id': entry.row.author_id, 'body': entry.row.body,
+                 'body_html': entry.row.body_html,
+                 'parent_id': entry.row.parent_id, 'path': entry.path}
+                for entry in batch
+            ])
+            for post_id, count in per_post.items():
+                conn.execute(update(Post).where(Post.id == post_id).values(
+                    version=Post.version + 1, modified=func.now(),
+                    comment_count=Post.comment_count + count, last_activity_at=func.now()))
+            return dict(conn.execute(select(Post.id, Post.version).where(Post.id.in_(per_post))).all())
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.keep
+        with self._lock:
+            for post_id, entries in list(self._pending.items()):
+                for comment_id, entry in list(entries.items()):
+                    if entry.committed_at is not None and entry.committed_at < cutoff:
+                        del entries[comment_id]
+                if not entries:
+                    del self._pending[post_id]
+
+    def _forget(self, entries):
+        with self._lock:
+            for entry in entries:
+                self._pending.get(entry.post_id, {}).pop(entry.row.id, None)
+
+def _committed(post_cache, events, post_id, row):
+    # Commits here don't go through the session, so its events don't see them
+    post_cache.invalidate(post_id)
+    publish_comment(events, post_id, row)
+
+def init_app(app):
+    if not app.config['COMMENT_WRITE_BEHIND']:
+        return
+
+    writer = app.extensions['comment_writer'] = CommentWriter(
+        db_session.session_factory.kw['bind'],
+        maxsize=app.config['COMMENT_QUEUE_SIZE'],
+        batch_size=app.config['COMMENT_BATCH_SIZE'],
+        linger=app.config['COMMENT_BATCH_LINGER'],
+        durability=app.config['COMMENT_DURABILITY'],
+        timeout=app.config['COMMENT_QUEUE_TIMEOUT'],
+        on_commit=functools.partial(_committed, app.extensions['post_cache'], app.extensions['events']))
+    atexit.register(writer.close)
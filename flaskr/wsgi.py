@@ -0,0 +1,8 @@
+'''
+Entry point for WSGI servers, e.g. gunicorn -c gunicorn.conf.py (which
+serves flaskr.wsgi:app). Configured from instance/config.py and FLASK_*
+environment variables.
+'''
+from flaskr import create_app
+
+app = create_app()
@@ -0,0 +1,51 @@
+'''
+gunicorn settings for serving flaskr from several worker processes:
+
+    gunicorn -c gunicorn.conf.py
+
+The app is created once in the master (preload_app) and warmed there before
+any worker is forked, so workers start with compiled templates and warm
+caches and share that memory copy-on-write. The hooks below keep pooled
+connections and threads from crossing the fork, see flaskr/prefork.py.
+WEB_CONCURRENCY and GUNICORN_BIND override the defaults. Several workers
+need the shared EVENTS_CLIENT and CACHE_CLIENT, see prefork.check_workers.
+With EVENTS_BIND (e.g. 127.0.0.1:8001) each worker also serves live comment
+streams from an event loop thread; point FLASK_EVENTS_URL at it.
+'''
+import os
+import socket
+
+from flaskr import prefork
+
+wsgi_app = 'flaskr.wsgi:app'
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * (os.cpu_count() or 1) + 1))
+# Without EVENTS_BIND, each open live comment stream holds one of a worker's
+# threads until the reader leaves; EVENTS_MAX_SUBSCRIBERS (8 by default)
+# must stay under this so the rest are left for requests.
+worker_class = 'gthread'
+threads = 16
+preload_app = True
+events_bind = os.environ.get('EVENTS_BIND')
+# Made in the master, shared by the workers' event servers
+events_listener = None
+
+def when_ready(server):
+    # In the master with the app loaded, before the first worker is forked
+    global events_listener
+    from flaskr.wsgi import app
+    prefork.check_workers(app, server.cfg.workers, server.cfg.threads)
+    templates, posts = prefork.warm_up(app)
+    server.log.info('Warmed %d templates and %d posts', templates, posts)
+    if events_bind:
+        host, port = events_bind.rsplit(':', 1)
+        events_listener = socket.create_server((host, int(port)))
+
+def pre_fork(server, worker):
+    prefork.before_fork()
+
+def post_fork(server, worker):
+    from flaskr.wsgi import app
+    prefork.after_fork(app)
+    if events_listener is not None:
+        prefork.start_event_server(app, events_listener)
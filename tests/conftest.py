@@ -10,6 +10,9 @@ from sqlalchemy.orm import sessionmaker
 from flaskr.data_model import User, Post
 from flaskr.db_alchemy import Base, db_session, init_db
 
+# Cheap hashing so fixtures and logins don't dominate the test run
+TEST_HASH_METHOD = 'pbkdf2:sha256:1'
+
 with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
     _data_sql = f.read().decode('utf8')
 
@@ -26,6 +29,7 @@ def app():
         'SQLALCHEMY_URI': 'sqlite:///:memory:',  # In-memory SQLite for tests
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
         'DATABASE': db_path,
+        'PASSWORD_HASH_METHOD': TEST_HASH_METHOD,
     })
 
     # Create tables for tests
@@ -39,6 +43,7 @@ def app():
     # Drop all tables after tests
     with app.app_context():
         Base.metadata.drop_all(bind=db_session.bind)
+    app.extensions['password_hasher'].close()
 
 @pytest.fixture
 def test_session(app):
@@ -69,8 +74,8 @@ def fill_db(session):
     '''
     Creates dummy data to test app with
     '''
-    user1 = User(name='tester', password=generate_password_hash('test_password'))
-    user2 = User(name='other_tester', password=generate_password_hash('other_password'))
+    user1 = User(name='tester', password=generate_password_hash('test_password', method=TEST_HASH_METHOD))
+    user2 = User(name='other_tester', password=generate_password_hash('other_password', method=TEST_HASH_METHOD))
     session.add(user1)
     session.add(user2)
     session.commit()
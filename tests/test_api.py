@@ -0,0 +1,178 @@
+import uuid
+from sqlalchemy import event, select
+from flaskr.db_alchemy import db_session
+from flaskr.data_model import Post, Comment
+from flaskr.events import comment_channel
+
+
+def _post_id(title='Test Post'):
+    return db_session.scalars(select(Post.id).where(Post.title == title)).first()
+
+def test_feed(client, app):
+    app.config['POSTS_PER_PAGE'] = 1
+    response = client.get('/api/v1/posts')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert len(data['posts']) == 1
+    assert data['newer'] is None
+    assert set(data['posts'][0]) >= {'id', 'title', 'body', 'author_name', 'comment_count'}
+
+    data = client.get('/api/v1/posts?before=' + data['older']).get_json()
+    assert len(data['posts']) == 1
+    assert data['older'] is None
+
+    response = client.get('/api/v1/posts?sort=bogus')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+def test_serialization_skips_password(client, app):
+    """
+    API reads select only the exposed columns, never the user's password
+    """
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db_session.bind, 'before_cursor_execute', record)
+    try:
+        client.get('/api/v1/posts')
+        client.get('/api/v1/posts/' + str(_post_id()))
+    finally:
+        event.remove(db_session.bind, 'before_cursor_execute', record)
+    assert statements
+    assert not any('password' in statement for statement in statements)
+
+def test_view(client, auth):
+    post_id = _post_id()
+    auth.login()
+    client.post('/' + str(post_id) + '/comment', data={'text': 'A comment'})
+
+    data = client.get('/api/v1/posts/' + str(post_id)).get_json()
+    assert data['title'] == 'Test Post'
+    assert data['author_name'] == 'tester'
+    assert [c['body'] for c in data['comments']] == ['A comment']
+
+    assert client.get('/api/v1/posts/' + str(uuid.uuid4())).status_code == 404
+    assert client.get('/api/v1/posts/not-a-uuid').status_code == 404
+
+def test_write_requires_login(client):
+    assert client.post('/api/v1/posts', json={'title': 'x'}).status_code == 401
+    assert client.delete('/api/v1/posts/' + str(_post_id())).status_code == 401
+
+def test_create_update_delete(client, auth):
+    auth.login()
+    assert client.post('/api/v1/posts', json={'body': 'no title'}).status_code == 400
+
+    response = client.post('/api/v1/posts', json={'title': 'From the API', 'body': 'Hi'})
+    assert response.status_code == 201
+    post = response.get_json()
+    assert response.headers['Location'] == '/api/v1/posts/' + post['id']
+
+    response = client.patch('/api/v1/posts/' + post['id'], json={'body': 'Edited'})
+    assert response.get_json()['body'] == 'Edited'
+    assert response.get_json()['version'] == 2
+
+    client.post('/api/v1/posts/' + post['id'] + '/comments', json={'body': 'Goes with it'})
+    assert client.delete('/api/v1/posts/' + post['id']).status_code == 204
+    assert client.get('/api/v1/posts/' + post['id']).status_code == 404
+    assert db_session.scalar(select(Comment).where(Comment.body == 'Goes with it')) is None
+
+    other = str(_post_id('Other User Test Post'))
+    assert client.patch('/api/v1/posts/' + other, json={'title': 'Mine now'}).status_code == 403
+    assert client.delete('/api/v1/posts/' + other).status_code == 403
+
+def test_posts_batch(client):
+    first, second, missing = _post_id(), _post_id('Other User Test Post'), uuid.uuid4()
+    response = client.get(f'/api/v1/posts/batch?id={second}&id={missing}&id={first}')
+    data = response.get_json()
+    assert [post['id'] for post in data['posts']] == [str(second), str(first)]
+    assert data['missing'] == [str(missing)]
+    assert client.get('/api/v1/posts/batch?id=nope').status_code == 400
+
+def test_comments_batch(client, auth, app):
+    first, second = _post_id(), _post_id('Other User Test Post')
+    auth.login()
+    response = client.post('/api/v1/comments/batch', json={'comments': [
+        {'post_id': str(first), 'body': 'one'},
+        {'post_id': str(first), 'body': 'two'},
+        {'post_id': str(second), 'body': 'three'},
+    ]})
+    assert response.status_code == 201
+    assert len(response.get_json()['comments']) == 3
+    db_session.expire_all()
+    assert db_session.get(Post, first).comment_count == 2
+    assert db_session.get(Post, second).comment_count == 1
+
+    # One bad entry writes nothing
+    response = client.post('/api/v1/comments/batch', json={'comments': [
+        {'post_id': str(first), 'body': 'four'},
+        {'post_id': str(uuid.uuid4()), 'body': 'five'},
+    ]})
+    assert response.status_code == 400
+    assert db_session.scalar(select(Comment).where(Comment.body == 'four')) is None
+
+    app.config['API_BATCH_LIMIT'] = 1
+    response = client.post('/api/v1/comments/batch', json={'comments': [
+        {'post_id': str(first), 'body': 'a'}, {'post_id': str(first), 'body': 'b'},
+    ]})
+    assert response.status_code == 400
+
+def test_comments_announced(client, auth, app):
+    """
+    Comments made through the API reach live streams like any other
+    """
+    first, second = _post_id(), _post_id('Other User Test Post')
+    broker = app.extensions['events']
+    streams = {post_id: broker.subscribe(comment_channel(post_id)) for post_id in (first, second)}
+    auth.login()
+
+    client.post(f'/api/v1/posts/{first}/comments', json={'body': 'single'})
+    client.post('/api/v1/comments/batch', json={'comments': [
+        {'post_id': str(first), 'body': 'one'},
+        {'post_id': str(second), 'body': 'two'},
+    ]})
+    assert [m['body'] for m in streams[first].get(0)] == ['single', 'one']
+    assert [m['body'] for m in streams[second].get(0)] == ['two']
+    assert streams[second].get(0) == []
+    for stream in streams.values():
+        stream.close()
+
+def test_replies(client, auth):
+    first, second = _post_id(), _post_id('Other User Test Post')
+    auth.login()
+    parent = client.post(f'/api/v1/posts/{first}/comments', json={'body': 'Parent'}).get_json()
+    assert parent['depth'] == 0
+
+    reply = client.post(f'/api/v1/posts/{first}/comments',
+                        json={'body': 'Reply', 'parent_id': parent['id']}).get_json()
+    assert reply['parent_id'] == parent['id']
+    assert reply['depth'] == 1
+
+    # The parent has to be on the same post
+    response = client.post('/api/v1/comments/batch', json={'comments': [
+        {'post_id': str(second), 'body': 'Wrong post', 'parent_id': parent['id']},
+    ]})
+    assert response.status_code == 400
+
+    data = client.get(f'/api/v1/posts/{first}').get_json()
+    assert [c['body'] for c in data['comments']] == ['Parent', 'Reply']
+    assert data['next'] is None
+
+def test_view_comment_pages(client, auth, app):
+    """
+    Comments come a page at a time, each page's next cursor leading to the
+    following one
+    """
+    app.config['COMMENT_PAGE_SIZE'] = 2
+    post_id = _post_id()
+    auth.login()
+    for body in ('c1', 'c2', 'c3'):
+        client.post(f'/api/v1/posts/{post_id}/comments', json={'body': body})
+
+    first = client.get(f'/api/v1/posts/{post_id}').get_json()
+    assert [c['body'] for c in first['comments']] == ['c1', 'c2']
+    assert 'path' not in first['comments'][0]
+    second = client.get(f'/api/v1/posts/{post_id}', query_string={'after': first['next']}).get_json()
+    assert [c['body'] for c in second['comments']] == ['c3']
+    assert second['next'] is None
+    assert client.get(f'/api/v1/posts/{post_id}?after=nope').status_code == 400
@@ -1,8 +1,17 @@
+import gc
+import weakref
+
 import pytest
 from flask import g, session
 from flaskr.db_alchemy import db_session
 from flaskr.data_model import User, Post
+from flaskr.cache import LRUCache
+from flaskr import passwords
+from flaskr.passwords import PasswordHasher
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash
 from sqlalchemy import event, select
+from conftest import TEST_HASH_METHOD
 
 
 def test_register(client, app):
@@ -66,4 +75,114 @@ def test_login_validate_input(auth, username, password, message):
     Test that incorrect logins get the appropiate error
     """
     response = auth.login(username, password)
-    assert message in response.data
\ No newline at end of file
+    assert message in response.data
+
+
+def test_user_cache(client, auth, app):
+    """
+    Logged in requests get the user from the cache, and changing the user
+    invalidates it
+    """
+    auth.login()
+    client.get('/')
+    user_cache = app.extensions['user_cache']
+
+    with client:
+        client.get('/hello')
+        user_id = session['user_id']
+        assert user_cache.get(str(user_id)) == (user_id, 'tester')
+
+        statements = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db_session.bind, 'before_cursor_execute', count_statement)
+        try:
+            client.get('/hello')
+        finally:
+            event.remove(db_session.bind, 'before_cursor_execute', count_statement)
+        assert statements == []
+        assert g.user.name == 'tester'
+
+    with app.app_context():
+        user = db_session.get(User, user_id)
+        user.name = 'renamed'
+        db_session.flush()
+        # Not until it's committed
+        assert user_cache.get(str(user_id)) == (user_id, 'tester')
+        db_session.commit()
+    assert user_cache.get(str(user_id)) is None
+
+    with client:
+        client.get('/hello')
+        assert g.user.name == 'renamed'
+
+def test_static_skips_user_load(client, auth):
+    auth.login()
+    with client:
+        client.get('/static/style.css')
+        assert g.user is None
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a') # a is now most recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    cache.set('d', 4, ttl=-1)
+    assert cache.get('d') is None
+
+
+def test_login_rehashes_old_hashes(client, auth, app):
+    """
+    Logging in upgrades a hash made with other settings to the configured ones
+    """
+    with app.app_context():
+        user = db_session.scalars(select(User).where(User.name == 'tester')).first()
+        user.password = generate_password_hash('test_password', method='pbkdf2:sha256:2')
+        db_session.commit()
+
+    response = auth.login()
+    assert response.headers["Location"] == "/"
+
+    with app.app_context():
+        user = db_session.scalars(select(User).where(User.name == 'tester')).first()
+        assert user.password.startswith(app.config['PASSWORD_HASH_METHOD'] + '$')
+    assert auth.login().headers["Location"] == "/"
+
+def test_password_hasher():
+    hasher = PasswordHasher('pbkdf2:sha256:1', workers=1, queue=0, timeout=0)
+    pwhash = hasher.hash('secret')
+    assert hasher.check(pwhash, 'secret')
+    assert not hasher.check(pwhash, 'wrong')
+    assert not hasher.needs_rehash(pwhash)
+    assert hasher.needs_rehash(generate_password_hash('secret', method='pbkdf2:sha256:2'))
+    assert PasswordHasher('scrypt').needs_rehash(pwhash)
+
+    # With every slot taken the next caller is turned away instead of queueing
+    hasher._slots.acquire()
+    with pytest.raises(ServiceUnavailable):
+        hasher.hash('secret')
+    hasher._slots.release()
+
+    hasher.close()
+    assert not any(thread.is_alive() for thread in hasher._executor._threads)
+
+def test_hashers_closed_at_exit(app):
+    """
+    One exit hook closes the hashers of the apps still around, and doesn't
+    keep the others alive
+    """
+    hasher = app.extensions['password_hasher']
+    assert hasher in passwords._hashers
+    hasher.hash('secret')
+    passwords._close_all()
+    assert not any(thread.is_alive() for thread in hasher._executor._threads)
+
+    gone = PasswordHasher(TEST_HASH_METHOD)
+    passwords._hashers.add(gone)
+    gone = weakref.ref(gone)
+    gc.collect()
+    assert gone() is None
@@ -0,0 +1,26 @@
+from benchmarks.http_bench import ENDPOINTS, compare, run_benchmark, summarize
+
+
+def test_benchmark_smoke():
+    """
+    Tiny benchmark run: every endpoint is exercised in both modes without errors
+    """
+    report = run_benchmark(users=3, posts_per_user=2, comments_per_post=2,
+                           requests=4, concurrency=2, hash_method='pbkdf2:sha256:1')
+
+    for mode in ('test_client', 'server'):
+        results = report['results'][mode]
+        assert set(results) == {name for name, *_ in ENDPOINTS}
+        for stats in results.values():
+            assert stats['requests'] == 4
+            assert stats['errors'] == 0
+            assert stats['p50_ms'] <= stats['p95_ms'] <= stats['p99_ms']
+
+    slower = {'results': {'server': {name: dict(stats, p95_ms=stats['p95_ms'] * 2)
+                                     for name, stats in report['results']['server'].items()}}}
+    assert compare(report, slower, 0.5) == [('server', name) for name, *_ in ENDPOINTS]
+
+def test_summarize_few_samples():
+    stats = summarize([0.002], elapsed=1.0, errors=0)
+    assert stats['p50_ms'] == stats['p99_ms'] == stats['mean_ms'] == 2.0
+    assert summarize([], elapsed=0, errors=1)['p95_ms'] == 0.0
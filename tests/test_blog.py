@@ -1,8 +1,9 @@
-import pytest, uuid
+import pytest, re, uuid
+from datetime import datetime
 from flask import g, session, url_for
-from sqlalchemy import select, update, func
+from sqlalchemy import event, select, update, func
 from flaskr.db_alchemy import db_session
-from flaskr.data_model import User, Post
+from flaskr.data_model import User, Post, Comment
 
 
 def test_index(client, auth):
@@ -105,6 +106,8 @@ def test_update(client, auth, app):
     # db = get_db()
     # post = db.execute('SELECT * FROM post WHERE id = 1').fetchone()
     assert post.title == 'updated'
+    assert post.version == 2
+    assert b'updated' in client.get('/').data
 
 @pytest.mark.parametrize('path_func', (
     '/create',
@@ -156,3 +159,124 @@ def test_delete_requires_login(client, auth):
         response = client.post(url_for_delete)
 
     assert response.status_code == 403
+
+def test_index_pagination(client, app):
+    """
+    Tests that the keyset cursor walks the feed one page at a time in both
+    directions without repeating or skipping posts
+    """
+    app.config['POSTS_PER_PAGE'] = 1
+    stmt = select(Post).order_by(Post.created.desc(), Post.id.desc())
+    newest, oldest = db_session.scalars(stmt).all()
+
+    response = client.get('/')
+    assert newest.body.encode() in response.data
+    assert oldest.body.encode() not in response.data
+    assert ('?before=' + str(newest.id)).encode() in response.data
+    assert b'?after=' not in response.data
+
+    response = client.get('/?before=' + str(newest.id))
+    assert oldest.body.encode() in response.data
+    assert newest.body.encode() not in response.data
+    assert ('?after=' + str(oldest.id)).encode() in response.data
+    assert b'?before=' not in response.data
+
+    response = client.get('/?after=' + str(oldest.id))
+    assert newest.body.encode() in response.data
+    assert oldest.body.encode() not in response.data
+    assert b'?after=' not in response.data
+
+def test_index_bad_cursor(client):
+    assert client.get('/?before=not-a-uuid').status_code == 400
+
+def test_index_deleted_cursor(client):
+    """
+    A cursor naming a post that's gone shows the first page
+    """
+    for arg in ('before', 'after'):
+        response = client.get(f'/?{arg}={uuid.uuid4()}')
+        assert response.status_code == 200
+        assert b'Test Post' in response.data
+
+
+def test_index_conditional_get(client, auth):
+    """
+    The feed answers 304 until a post on the page changes or is deleted
+    """
+    etag = client.get('/').headers['ETag']
+    assert client.get('/', headers={'If-None-Match': etag}).status_code == 304
+
+    with client:
+        auth.login()
+        etag = client.get('/').headers['ETag']
+        assert client.get('/', headers={'If-None-Match': etag}).status_code == 304
+        post_id = db_session.scalars(select(Post.id).where(Post.author_id == session['user_id'])).first()
+        client.post('/' + str(post_id) + '/update', data={'title': 'changed', 'body': ''})
+        assert client.get('/', headers={'If-None-Match': etag}).status_code == 200
+
+        etag = client.get('/').headers['ETag']
+        client.post('/' + str(post_id) + '/delete')
+        assert client.get('/', headers={'If-None-Match': etag}).status_code == 200
+
+def test_index_sort_active(client, app):
+    """
+    ?sort=active orders the feed by latest activity and keeps the sort in the
+    pager links
+    """
+    app.config['POSTS_PER_PAGE'] = 1
+    stmt = select(Post).order_by(Post.created.desc(), Post.id.desc())
+    newest, oldest = db_session.scalars(stmt).all()
+    newest_id, oldest_id = newest.id, oldest.id
+    newest_body, oldest_body = newest.body.encode(), oldest.body.encode()
+    db_session.execute(update(Post).where(Post.id == oldest_id)
+                                   .values(last_activity_at=datetime(2030, 1, 1)))
+    db_session.commit()
+
+    response = client.get('/?sort=active')
+    assert oldest_body in response.data
+    assert ('?before=' + str(oldest_id) + '&amp;sort=active').encode() in response.data
+
+    response = client.get('/?before=' + str(oldest_id) + '&sort=active')
+    assert newest_body in response.data
+    assert client.get('/?sort=bogus').status_code == 400
+
+def test_repair_counters(runner, app):
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    author_id = db_session.scalars(select(Post.author_id).where(Post.id == post_id)).first()
+    db_session.add_all([Comment(parent_post_id=post_id, author_id=author_id, body='Bulk loaded')
+                        for _ in range(3)])
+    db_session.commit()
+    assert db_session.get(Post, post_id).comment_count == 0
+
+    result = runner.invoke(args=['repair-counters'])
+    assert 'Repaired counters on 2 posts' in result.output
+    db_session.expire_all()
+    assert db_session.get(Post, post_id).comment_count == 3
+
+def test_index_preview(client, app):
+    """
+    The feed shows a truncated preview of long bodies, linking to the full
+    post, and never selects the full body or any password
+    """
+    app.config['FEED_PREVIEW_CHARS'] = 10
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db_session.bind, 'before_cursor_execute', record)
+    try:
+        response = client.get('/')
+    finally:
+        event.remove(db_session.bind, 'before_cursor_execute', record)
+
+    assert b'<p>A full bod</p>' in response.data
+    assert b'A full body of text' not in response.data
+    assert ('href="/' + str(post_id) + '">Read more').encode() in response.data
+    assert not any('password' in statement for statement in statements)
+    # The body only appears inside substr() and length()
+    assert not any(re.search(r'(?<!\()post\.body', statement) for statement in statements)
+
+    response = client.get('/' + str(post_id))
+    assert b'A full body of text to test' in response.data
@@ -1,11 +1,17 @@
+import shutil
 import sqlite3
+import uuid
 
 import pytest
 import warnings
-from sqlalchemy import select
-from flaskr.db_alchemy import db_session
-from flaskr.data_model import User
+from sqlalchemy import func, insert, inspect, select, text
+from flaskr import create_app
+from flaskr.db_alchemy import db_session, init_db, make_engine, migrate_ids, upgrade_db
+from flaskr.data_model import User, Post, Comment, comment_path
+from flaskr.ids import uuid7
+from flaskr.db_seed import seed_bulk, seed_db
 from sqlalchemy.exc import IntegrityError
+from conftest import TEST_HASH_METHOD, AuthActions, fill_db
 
 
 def test_db_session_lifecycle(app):
@@ -57,4 +63,193 @@ def test_unique_username_constraint(app):
 
     with pytest.raises(IntegrityError):
         db_session.add(user2)
-        db_session.commit()
\ No newline at end of file
+        db_session.commit()
+
+def test_upgrade_db_keeps_data(app):
+    """
+    Dropped indexes come back on upgrade and existing rows survive
+    """
+    with db_session.bind.begin() as conn:
+        conn.execute(text('DROP INDEX ix_post_created_id'))
+    post_count = db_session.scalar(select(func.count(Post.id)))
+
+    changes = upgrade_db(db_session.bind)
+
+    assert changes == ['created index ix_post_created_id']
+    index_names = {i['name'] for i in inspect(db_session.bind).get_indexes('post')}
+    assert 'ix_post_created_id' in index_names
+    assert db_session.scalar(select(func.count(Post.id))) == post_count
+    assert upgrade_db(db_session.bind) == []
+
+def test_upgrade_db_command(runner, monkeypatch):
+    monkeypatch.setattr('flaskr.db_alchemy.upgrade_db', lambda engine: ['created table x'])
+    result = runner.invoke(args=['upgrade-db'])
+    assert 'created table x' in result.output
+    assert 'Upgraded' in result.output
+
+def test_uuid7():
+    """
+    Ids are version 7 and increase in the order they're made
+    """
+    ids = [uuid7() for _ in range(5000)]
+    assert all(i.version == 7 for i in ids)
+    assert ids == sorted(ids)
+    assert [i.bytes for i in ids] == sorted(i.bytes for i in ids)
+
+def test_ids_stored_binary(app, client, auth):
+    auth.login()
+    post_id = db_session.scalar(select(Post.id).where(Post.title == 'Test Post'))
+    client.post(f'/{post_id}/comment', data={'text': 'Binary'})
+
+    for table, column in [('user', 'id'), ('post', 'id'), ('post', 'author_id'),
+                          ('comment', 'id'), ('comment', 'parent_post_id')]:
+        rows = db_session.execute(
+            text(f'SELECT DISTINCT typeof("{column}"), length("{column}") FROM "{table}"')).all()
+        assert rows == [('blob', 16)]
+
+def test_migrate_ids(app, client):
+    """
+    Text ids written before BinaryUUID are converted in place, so the same
+    urls keep working, in both their dashed and hex forms
+    """
+    user_id, post_id, comment_id = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    with db_session.bind.begin() as conn:
+        conn.execute(text("INSERT INTO user (id, name, password) VALUES (:id, 'old', 'x')"),
+                     {'id': user_id.hex})
+        conn.execute(text("INSERT INTO post (id, author_id, title, body, created) "
+                          "VALUES (:id, :author, 'Old post', 'Old body', '2020-01-01 00:00:00')"),
+                     {'id': post_id.hex, 'author': user_id.hex})
+        conn.execute(text("INSERT INTO comment (id, parent_post_id, author_id, body, path, created) "
+                          "VALUES (:id, :post, :author, 'Old comment', :path, '2020-01-01 00:00:00')"),
+                     {'id': comment_id.hex, 'post': post_id.hex, 'author': user_id.hex,
+                      'path': comment_path(comment_id)})
+
+    assert migrate_ids(db_session.bind) == {'user': 1, 'post': 1, 'comment': 1}
+    assert migrate_ids(db_session.bind) == {}
+
+    for url_id in (str(post_id), post_id.hex):
+        response = client.get('/' + url_id)
+        assert b'Old post' in response.data
+        assert b'Old comment' in response.data
+    assert b'Old comment' in client.get('/comment/' + comment_id.hex).data
+    assert db_session.scalar(select(Post.author_id).where(Post.id == post_id)) == user_id
+
+def test_migrate_ids_command(runner, monkeypatch):
+    monkeypatch.setattr('flaskr.db_alchemy.migrate_ids', lambda engine: {'post': 3})
+    result = runner.invoke(args=['migrate-ids'])
+    assert 'post: 3 rows' in result.output
+    assert 'Converted 3 rows' in result.output
+
+def test_sqlite_pragmas(tmp_path):
+    """
+    File backed SQLite connections come up in WAL mode with the configured pragmas
+    """
+    engine = make_engine({
+        'SQLALCHEMY_URI': 'sqlite:///' + str(tmp_path / 'pragmas.sqlite'),
+        'SQLITE_PRAGMAS': {'journal_mode': 'WAL', 'busy_timeout': 1234, 'synchronous': 'NORMAL'},
+    })
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.exec_driver_sql('PRAGMA busy_timeout').scalar() == 1234
+        assert conn.exec_driver_sql('PRAGMA synchronous').scalar() == 1 # NORMAL
+    engine.dispose()
+
+def test_pool_options_passed_through(tmp_path):
+    engine = make_engine({
+        'SQLALCHEMY_URI': 'sqlite:///' + str(tmp_path / 'pool.sqlite'),
+        'SQLALCHEMY_POOL_SIZE': 3,
+        'SQLALCHEMY_POOL_PRE_PING': True,
+    })
+    assert engine.pool.size() == 3
+    assert engine.pool._pre_ping
+    engine.dispose()
+
+@pytest.fixture
+def replica_app(tmp_path):
+    '''
+    App on two SQLite files standing in for a primary and its read replica.
+    The replica starts as a copy of the primary plus one post only it has.
+    '''
+    primary = tmp_path / 'primary.sqlite'
+    replica = tmp_path / 'replica.sqlite'
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_URI': 'sqlite:///' + str(primary),
+        'SQLALCHEMY_REPLICA_URIS': ['sqlite:///' + str(replica)],
+        'PASSWORD_HASH_METHOD': TEST_HASH_METHOD,
+    })
+    init_db(db_session.bind)
+    fill_db(db_session)
+    db_session.remove()
+    db_session.bind.dispose() # checkpoints the WAL into the main file
+    shutil.copy(primary, replica)
+
+    with db_session().replica.begin() as conn:
+        author_id = conn.execute(select(User.id)).scalars().first()
+        conn.execute(insert(Post).values(id=uuid.uuid4(), author_id=author_id,
+                                         title='Replica only', body='From the replica'))
+
+    yield app
+
+    app.extensions['password_hasher'].close()
+    db_session.remove()
+
+def test_replica_routing(replica_app):
+    """
+    Read-only views read the replica, writes go to the primary, and the writer
+    is pinned to the primary for the following request
+    """
+    client = replica_app.test_client()
+    AuthActions(client).login()
+
+    response = client.get('/')
+    assert b'Replica only' in response.data
+
+    client.post('/create', data={'title': 'Fresh post', 'body': 'Written to primary'})
+    primary_titles = db_session.scalars(select(Post.title)).all()
+    assert 'Fresh post' in primary_titles
+    assert 'Replica only' not in primary_titles
+    db_session.remove()
+
+    # Pinned right after the write: sees its own post, not the replica's copy
+    with client.session_transaction() as sess:
+        pinned_until = sess['db_primary_until']
+    response = client.get('/')
+    assert b'Fresh post' in response.data
+    assert b'Replica only' not in response.data
+    # Reading while pinned doesn't extend the pin
+    with client.session_transaction() as sess:
+        assert sess['db_primary_until'] == pinned_until
+
+    with client.session_transaction() as sess:
+        sess['db_primary_until'] = 0
+    response = client.get('/')
+    assert b'Replica only' in response.data
+    assert b'Fresh post' not in response.data
+
+def test_seed_bulk(app):
+    """
+    Bulk seeding adds the requested rows and is repeatable from its seed
+    """
+    with app.app_context():
+        seed_db(db_session)
+        counts = seed_bulk(db_session, users=5, posts_per_user=3, comments_per_post=4,
+                           seed=42, batch_size=7)
+        assert counts == (5, 15, 60)
+        assert db_session.scalar(select(func.count(User.id))) == 7
+        assert db_session.scalar(select(func.count(Post.id))) == 17
+        assert db_session.scalar(select(func.count(Comment.id))) == 62
+        first_ids = set(db_session.scalars(select(Post.id)))
+
+        seed_db(db_session)
+        seed_bulk(db_session, users=5, posts_per_user=3, comments_per_post=4, seed=42)
+        assert set(db_session.scalars(select(Post.id))) - first_ids == {
+            db_session.scalar(select(Post.id).where(Post.title == 'Test Post')),
+            db_session.scalar(select(Post.id).where(Post.title == 'Automation is good')),
+        }
+
+def test_seed_db_command(runner):
+    result = runner.invoke(args=['seed-db', '--users', '3', '--posts-per-user', '2',
+                                 '--comments-per-post', '1'])
+    assert 'Seeded' in result.output
+    assert 'Added 3 users, 6 posts and 6 comments.' in result.output
@@ -0,0 +1,61 @@
+import pytest
+from flaskr import create_app
+from flaskr.db_alchemy import Base, db_session, init_db
+from conftest import TEST_HASH_METHOD, fill_db
+
+
+@pytest.fixture
+def debug_app():
+    '''
+    App with the debug instrumentation switched on
+    '''
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_URI': 'sqlite:///:memory:',
+        'PASSWORD_HASH_METHOD': TEST_HASH_METHOD,
+        'DEBUG_INSTRUMENTATION': True,
+    })
+    with app.app_context():
+        init_db(db_session.bind)
+    fill_db(db_session)
+
+    yield app
+
+    with app.app_context():
+        Base.metadata.drop_all(bind=db_session.bind)
+    app.extensions['password_hasher'].close()
+
+def test_server_timing(debug_app):
+    """
+    Instrumented responses carry a Server-Timing header with the query count
+    """
+    response = debug_app.test_client().get('/')
+    timing = response.headers['Server-Timing']
+    for metric in ('db;dur=', 'tpl;dur=', 'view;dur=', 'total;dur='):
+        assert metric in timing
+    assert '2 queries' in timing
+
+def test_debug_page(debug_app):
+    """
+    /debug lists the endpoints served and the statements they ran
+    """
+    client = debug_app.test_client()
+    client.get('/')
+    client.get('/hello')
+    response = client.get('/debug')
+    assert response.status_code == 200
+    assert b'blog.index' in response.data
+    assert b'hello' in response.data
+    assert b'FROM post' in response.data
+    stats = debug_app.extensions['debug_stats']
+    snapshot = stats.snapshot()
+    assert snapshot['blog.index']['queries'] == 2
+    # A copy, later requests don't change it
+    client.get('/')
+    assert snapshot['blog.index']['requests'] == 1
+    assert stats.snapshot()['blog.index']['requests'] == 2
+
+def test_debug_off_by_default(client):
+    response = client.get('/')
+    assert 'Server-Timing' not in response.headers
+    assert client.get('/debug').status_code == 404
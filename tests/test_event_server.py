@@ -0,0 +1,154 @@
+import json
+import socket
+import threading
+import time
+import uuid
+
+import pytest
+from sqlalchemy import select
+
+from flaskr import create_app
+from flaskr.db_alchemy import db_session, init_db
+from flaskr.data_model import Post
+from flaskr.event_server import EventServer
+from conftest import AuthActions, TEST_HASH_METHOD, fill_db
+
+
+@pytest.fixture
+def events_app(tmp_path):
+    '''
+    App on a database file, as the event server checks posts from a thread
+    of its own, which an in-memory database doesn't reach
+    '''
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_URI': 'sqlite:///' + str(tmp_path / 'flaskr.sqlite'),
+        'PASSWORD_HASH_METHOD': TEST_HASH_METHOD,
+        'EVENTS_KEEPALIVE': 0.05,
+    })
+    init_db(db_session.bind)
+    fill_db(db_session)
+    db_session.remove()
+
+    yield app
+
+    app.extensions['password_hasher'].close()
+    db_session.remove()
+
+@pytest.fixture
+def event_server(events_app):
+    listener = socket.create_server(('127.0.0.1', 0))
+    server = EventServer(events_app, max_clients=300)
+    server.start(listener)
+    server.port = listener.getsockname()[1]
+
+    yield server
+
+    server.stop()
+    listener.close()
+
+def _open(server, path):
+    """
+    A reader of path on the server, as a file of the response's lines
+    """
+    sock = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+    sock.sendall(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    return sock.makefile('rb')
+
+def _head(reader):
+    lines = []
+    for line in reader:
+        if line == b'\r\n':
+            break
+        lines.append(line.decode().strip())
+    return lines
+
+def _next_comment(reader):
+    """
+    The next comment event's data, past any keepalives
+    """
+    for line in reader:
+        if line.startswith(b'data: '):
+            return json.loads(line[len(b'data: '):])
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def _post_id(title='Test Post'):
+    post_id = db_session.scalars(select(Post.id).where(Post.title == title)).first()
+    db_session.remove()
+    return post_id
+
+def test_many_streams_one_thread(events_app, event_server):
+    """
+    Hundreds of open streams share the server's one thread, and every one
+    gets a new comment
+    """
+    post_id = _post_id()
+    readers = [_open(event_server, f'/{post_id}/events')]
+    _head(readers[0])
+    threads = threading.active_count()
+    readers += [_open(event_server, f'/{post_id}/events') for _ in range(199)]
+    for reader in readers[1:]:
+        head = _head(reader)
+        assert head[0] == 'HTTP/1.1 200 OK'
+        assert 'Content-Type: text/event-stream; charset=utf-8' in head
+        assert reader.readline() == b'retry: 5000\n'
+    _wait_for(lambda: event_server.client_count() == 200)
+    assert threading.active_count() == threads
+
+    writer = events_app.test_client()
+    AuthActions(writer).login()
+    writer.post(f'/{post_id}/comment', data={'text': 'Live!'})
+    for reader in readers:
+        comment = _next_comment(reader)
+        assert comment['body'] == 'Live!'
+        assert comment['author_name'] == 'tester'
+
+    # Readers that leave are noticed
+    for reader in readers:
+        reader.close()
+    _wait_for(lambda: event_server.client_count() == 0)
+
+def test_streams_per_post(events_app, event_server):
+    first, second = _post_id(), _post_id('Other User Test Post')
+    reader = _open(event_server, f'/prefix/{second}/events')
+    _head(reader)
+    _wait_for(lambda: event_server.client_count() == 1)
+
+    writer = events_app.test_client()
+    AuthActions(writer).login()
+    writer.post(f'/{first}/comment', data={'text': 'Elsewhere'})
+    writer.post(f'/{second}/comment', data={'text': 'Here'})
+    assert _next_comment(reader)['body'] == 'Here'
+    reader.close()
+
+def test_refused(event_server):
+    assert _head(_open(event_server, f'/{uuid.uuid4()}/events'))[0] == 'HTTP/1.1 404 Not Found'
+    assert _head(_open(event_server, '/nope/events'))[0] == 'HTTP/1.1 404 Not Found'
+    assert _head(_open(event_server, '/hello'))[0] == 'HTTP/1.1 404 Not Found'
+
+    event_server.max_clients = 1
+    post_id = _post_id()
+    reader = _open(event_server, f'/{post_id}/events')
+    _head(reader)
+    _wait_for(lambda: event_server.client_count() == 1)
+    full = _head(_open(event_server, f'/{post_id}/events'))
+    assert full[0] == 'HTTP/1.1 503 Service Unavailable'
+    assert 'Retry-After: 30' in full
+    reader.close()
+
+def test_page_uses_events_url(events_app):
+    url = '/' + str(_post_id())
+    client = events_app.test_client()
+    assert f'data-stream="{url}/events"' in client.get(url).get_data(as_text=True)
+    events_app.config['EVENTS_URL'] = 'http://live.example'
+    assert f'data-stream="http://live.example{url}/events"' in client.get(url).get_data(as_text=True)
+
+def test_serve_events_needs_shared_broker(events_app):
+    result = events_app.test_cli_runner().invoke(args=['serve-events', '--port', '0'])
+    assert result.exit_code == 1
+    assert 'EVENTS_CLIENT is not set' in result.output
@@ -0,0 +1,115 @@
+import json
+import threading
+import uuid
+
+import pytest
+from sqlalchemy import select
+from flaskr.db_alchemy import db_session
+from flaskr.data_model import Post
+from flaskr.events import LocalBroker, TooManySubscribers
+
+
+def test_local_broker_fan_out():
+    broker = LocalBroker(backlog=2)
+    first = broker.subscribe('a')
+    second = broker.subscribe('a')
+    other = broker.subscribe('b')
+    assert broker.subscriber_count() == 3
+
+    broker.publish('a', 1)
+    assert first.get(0) == [1]
+    assert second.get(0) == [1]
+    assert other.get(0) == []
+
+    # A subscriber that falls behind keeps only the newest messages
+    for n in range(2, 5):
+        broker.publish('a', n)
+    assert first.get(0) == [3, 4]
+
+    for subscription in (first, second, other):
+        subscription.close()
+    assert broker.subscriber_count() == 0
+    broker.publish('a', 5) # no subscribers, nothing to do
+
+def test_local_broker_wakes_waiting_subscriber():
+    broker = LocalBroker()
+    subscription = broker.subscribe('a')
+    received = []
+    waiter = threading.Thread(target=lambda: received.extend(subscription.get(5)))
+    waiter.start()
+    broker.publish('a', 'hello')
+    waiter.join(5)
+    assert received == ['hello']
+
+def test_many_idle_subscribers():
+    """
+    Idle subscribers are plain objects, no thread each
+    """
+    broker = LocalBroker()
+    threads = threading.active_count()
+    subscriptions = [broker.subscribe('post') for _ in range(5000)]
+    assert threading.active_count() == threads
+    broker.publish('post', 'x')
+    assert all(s.get(0) == ['x'] for s in subscriptions)
+
+def test_comment_stream(client, app):
+    app.config['EVENTS_KEEPALIVE'] = 0.05
+    post_id = db_session.scalars(select(Post.id)).first()
+    url = '/' + str(post_id)
+
+    response = client.get(url + '/events', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    stream = (chunk.decode() for chunk in response.response)
+    assert next(stream).startswith('retry:')
+    assert next(stream) == ': keepalive\n\n'
+
+    writer = app.test_client()
+    writer.post('/auth/login', data={'username': 'tester', 'password': 'test_password'})
+    writer.post(url + '/comment', data={'text': 'Live!'})
+    event = next(stream)
+    while event.startswith(':'):
+        event = next(stream)
+    assert event.startswith('event: comment\n')
+    data = json.loads(event.split('data: ', 1)[1])
+    assert data['body'] == 'Live!'
+    assert data['author_name'] == 'tester'
+
+    response.close()
+    assert app.extensions['events'].subscriber_count() == 0
+
+def test_comment_stream_missing_post(client):
+    assert client.get('/' + str(uuid.uuid4()) + '/events').status_code == 404
+
+def test_local_broker_max_subscribers():
+    broker = LocalBroker(max_subscribers=2)
+    first = broker.subscribe('a')
+    second = broker.subscribe('b')
+    with pytest.raises(TooManySubscribers):
+        broker.subscribe('a')
+    first.close()
+    first.close() # closing twice frees one slot only
+    third = broker.subscribe('a')
+    with pytest.raises(TooManySubscribers):
+        broker.subscribe('c')
+    for subscription in (second, third):
+        subscription.close()
+    assert broker.subscriber_count() == 0
+
+def test_comment_stream_full(client, app):
+    app.extensions['events'].max_subscribers = 1
+    url = '/' + str(db_session.scalars(select(Post.id)).first())
+
+    page = client.get(url)
+    # Only opened on request
+    assert b'Follow new comments' in page.data
+
+    response = client.get(url + '/events', buffered=False)
+    assert response.status_code == 200
+    refused = client.get(url + '/events')
+    assert refused.status_code == 503
+    assert refused.headers['Retry-After'] == '30'
+
+    response.close()
+    response = client.get(url + '/events', buffered=False)
+    assert response.status_code == 200
+    response.close()
@@ -0,0 +1,68 @@
+from sqlalchemy import select, update
+from flaskr.db_alchemy import db_session
+from flaskr.data_model import Post, Comment
+from flaskr.markdown import render_markdown
+
+
+def test_render_markdown():
+    html = render_markdown('# Title\n\nSome **bold** and *em*, `a < b`\nnext line\n\n'
+                           '- one\n- [two](https://example.com/?a=1&b=2)\n\n> quoted\n\n'
+                           '```\n<tag>\n```')
+    assert html == ('<h1>Title</h1>\n'
+                    '<p>Some <strong>bold</strong> and <em>em</em>, <code>a &lt; b</code><br>\nnext line</p>\n'
+                    '<ul>\n<li>one</li>\n'
+                    '<li><a href="https://example.com/?a=1&amp;b=2" rel="nofollow noopener">two</a></li>\n</ul>\n'
+                    '<blockquote>\n<p>quoted</p>\n</blockquote>\n'
+                    '<pre><code>&lt;tag&gt;</code></pre>')
+
+def test_render_markdown_sanitizes():
+    html = render_markdown('<script>alert(1)</script> <img src=x onerror="alert(1)">\n\n'
+                           '[a](javascript:alert%281%29) [b](JavaScript:void) [c](/relative)')
+    assert '<script' not in html and '<img' not in html
+    assert html.endswith('<p>a b <a href="/relative" rel="nofollow noopener">c</a></p>')
+    # Deeply nested quotes stop nesting rather than recursing
+    assert render_markdown('>' * 5000 + ' deep').count('<blockquote>') == 8
+
+def test_bodies_rendered_on_write(client, auth, app):
+    """
+    Posts and comments store their HTML when written and pages show it
+    """
+    app.config['FEED_PREVIEW_CHARS'] = 12
+    auth.login()
+    client.post('/create', data={'title': 'Formatted', 'body': 'Some **bold** text and more'})
+    post = db_session.scalars(select(Post).where(Post.title == 'Formatted')).first()
+    assert post.body_html == '<p>Some <strong>bold</strong> text and more</p>'
+    assert post.preview_html == '<p>Some **bold*</p>'
+    assert b'Read more' in client.get('/').data
+
+    client.post(f'/{post.id}/comment', data={'text': '_nice_ <b>'})
+    assert db_session.scalar(select(Comment.body_html)) == '<p><em>nice</em> &lt;b&gt;</p>'
+    response = client.get(f'/{post.id}')
+    assert b'<strong>bold</strong>' in response.data
+    assert b'<em>nice</em> &lt;b&gt;' in response.data
+
+    client.post(f'/{post.id}/update', data={'title': 'Formatted', 'body': '*changed*'})
+    db_session.expire_all()
+    assert db_session.get(Post, post.id).body_html == '<p><em>changed</em></p>'
+
+def test_render_markdown_command(client, auth, runner):
+    """
+    The bulk re-render fills in rows without HTML and fixes stale HTML,
+    bumping the affected posts' versions
+    """
+    auth.login()
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    client.post(f'/{post_id}/comment', data={'text': '**hi**'})
+    db_session.execute(update(Comment).values(body_html='stale'))
+    db_session.commit()
+    version = db_session.get(Post, post_id).version
+
+    result = runner.invoke(args=['render-markdown', '--workers', '2', '--batch-size', '1'])
+    assert 'Re-rendered 2 posts and 1 comments.' in result.output
+    db_session.expire_all()
+    assert db_session.scalar(select(Comment.body_html)) == '<p><strong>hi</strong></p>'
+    assert db_session.get(Post, post_id).body_html == '<p>A full body of text to test</p>'
+    assert db_session.get(Post, post_id).version == version + 2
+
+    result = runner.invoke(args=['render-markdown', '--workers', '2'])
+    assert 'Re-rendered 0 posts and 0 comments.' in result.output
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+from flaskr import create_app
+from flaskr.db_alchemy import Base, db_session, init_db, make_engine
+from flaskr.metrics import Metrics, engine_gauges
+from conftest import AuthActions, TEST_HASH_METHOD, fill_db
+
+
+@pytest.fixture
+def metrics_app():
+    '''
+    App with metrics switched on
+    '''
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_URI': 'sqlite:///:memory:',
+        'PASSWORD_HASH_METHOD': TEST_HASH_METHOD,
+        'METRICS_ENABLED': True,
+    })
+    with app.app_context():
+        init_db(db_session.bind)
+    fill_db(db_session)
+
+    yield app
+
+    with app.app_context():
+        Base.metadata.drop_all(bind=db_session.bind)
+    app.extensions['password_hasher'].close()
+
+def test_metrics_endpoint(metrics_app):
+    """
+    Requests, statements, pool and cache activity all show up in the scrape
+    """
+    client = metrics_app.test_client()
+    auth = AuthActions(client)
+    auth.login()
+    client.get('/')
+    client.get('/')
+    client.get('/no/such/page')
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+
+    assert '# TYPE flaskr_http_request_duration_seconds histogram' in text
+    assert 'flaskr_http_requests_total{endpoint="blog.index",method="GET",status="200"} 2' in text
+    assert 'flaskr_http_requests_total{endpoint="unmatched",method="GET",status="404"} 1' in text
+    assert 'flaskr_http_request_duration_seconds_count{endpoint="blog.index",method="GET"} 2' in text
+    assert 'flaskr_http_request_duration_seconds_bucket{endpoint="blog.index",method="GET",le="+Inf"} 2' in text
+    assert 'flaskr_db_query_duration_seconds_count{engine="primary",statement="select"}' in text
+    assert 'flaskr_db_pool_checkout_wait_seconds_count{engine="primary"}' in text
+    assert 'flaskr_cache_hits_total{cache="user"} 3' in text # /, /no/such/page, /metrics
+    assert 'flaskr_cache_misses_total{cache="fragment"}' in text
+
+def test_metrics_disabled(client):
+    # Off by default
+    assert client.get('/metrics').status_code == 404
+
+def test_metrics_token(metrics_app):
+    metrics_app.config['METRICS_TOKEN'] = 'scraper'
+    client = metrics_app.test_client()
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scraper'}).status_code == 200
+
+def test_metrics_threads():
+    """
+    Counts stay exact when many threads record at once across shards
+    """
+    metrics = Metrics(shards=4, buckets=(0.5, 1.0))
+
+    def record():
+        for _ in range(1000):
+            metrics.inc('flaskr_http_requests_total', (('status', 200),))
+            metrics.observe('flaskr_db_query_duration_seconds', (), 0.75)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    samples = metrics.collect()
+    assert samples[('flaskr_http_requests_total', (('status', 200),))] == 8000
+    assert samples[('flaskr_db_query_duration_seconds', ())] == [0, 8000, 0, 6000.0]
+    text = metrics.render()
+    assert 'flaskr_db_query_duration_seconds_bucket{le="0.5"} 0' in text
+    assert 'flaskr_db_query_duration_seconds_bucket{le="1.0"} 8000' in text
+    assert 'flaskr_db_query_duration_seconds_count 8000' in text
+
+
+def test_pool_gauges(tmp_path):
+    engine = make_engine({'SQLALCHEMY_URI': 'sqlite:///' + str(tmp_path / 'pool.sqlite'),
+                          'SQLALCHEMY_POOL_SIZE': 3})
+    with engine.connect():
+        gauges = {name: value for name, labels, value in engine_gauges([('primary', engine)])}
+    assert gauges == {'flaskr_db_pool_checked_out': 1, 'flaskr_db_pool_size': 3,
+                      'flaskr_db_pool_overflow': -2}
+    engine.dispose()
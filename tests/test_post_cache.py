@@ -0,0 +1,139 @@
+import threading
+import time
+
+from sqlalchemy import event, select, update
+from flaskr.cache import LRUCache
+from flaskr.db_alchemy import db_session
+from flaskr.data_model import Post
+from flaskr.post_cache import PostCache
+
+
+def _post_id(title='Test Post'):
+    post_id = db_session.scalars(select(Post.id).where(Post.title == title)).first()
+    # Fresh session for the requests, fill_db's writes pinned this one
+    db_session.remove()
+    return post_id
+
+def _statements(client, url):
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db_session.bind, 'before_cursor_execute', record)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(db_session.bind, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return statements
+
+def test_view_from_cache(client, app):
+    """
+    Once cached, the post page needs no queries at all for anonymous readers
+    """
+    url = '/' + str(_post_id())
+    assert _statements(client, url) != []
+    assert _statements(client, url) == []
+    assert app.extensions['post_cache'].hits == 1
+
+def test_get_post_from_cache(client, auth, app):
+    """
+    The edit form and get_post's checks come from the cache, changes load
+    the post from the database, even when the entry is stale
+    """
+    post_id = _post_id()
+    url = '/' + str(post_id)
+    client.get(url)
+    auth.login()
+    db_session.remove()
+    # Just the logged in user's
+    assert len(_statements(client, url + '/update')) == 1
+
+    other = _post_id('Other User Test Post')
+    client.get('/' + str(other))
+    db_session.remove()
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db_session.bind, 'before_cursor_execute', record)
+    try:
+        assert client.post('/' + str(other) + '/delete').status_code == 403
+    finally:
+        event.remove(db_session.bind, 'before_cursor_execute', record)
+    assert not any('FROM post' in statement for statement in statements)
+
+    # A commit the cache never heard of, as from another worker without a
+    # shared CACHE_CLIENT, shows once its entry expires
+    with db_session.bind.begin() as conn:
+        conn.execute(update(Post).where(Post.id == post_id)
+                     .values(title='Elsewhere', body_html=None, version=Post.version + 1))
+    assert b'Elsewhere' not in client.get(url).data
+    app.extensions['post_cache'].backend.delete(str(post_id))
+    assert b'Elsewhere' in client.get(url).data
+
+    # Writes load the post afresh, whatever the entry says
+    with db_session.bind.begin() as conn:
+        conn.execute(update(Post).where(Post.id == post_id).values(title='Elsewhere again'))
+    assert client.post(url + '/update', data={'title': 'Mine', 'body': 'Mine'}).status_code == 302
+    assert b'Mine' in client.get(url).data
+
+def test_commits_invalidate(client, auth, app):
+    """
+    Committed changes to a post or its comments drop its entry, rolled back
+    ones don't
+    """
+    post_id = _post_id()
+    url = '/' + str(post_id)
+    cache = app.extensions['post_cache']
+    auth.login()
+    client.get(url)
+
+    client.post(url + '/comment', data={'text': 'Fresh comment'})
+    assert cache.backend.get(str(post_id)) is None
+    assert b'Fresh comment' in client.get(url).data
+
+    client.post(url + '/update', data={'title': 'Retitled', 'body': 'New body'})
+    assert b'Retitled' in client.get(url).data
+    assert b'New body' in client.get(url + '/update').data
+
+    db_session.execute(update(Post).where(Post.id == post_id).values(title='Never committed'),
+                       execution_options={'post_ids': [post_id]})
+    db_session.rollback()
+    assert cache.backend.get(str(post_id)).title == 'Retitled'
+
+    # Bulk statements that don't say which posts they change clear everything
+    db_session.execute(update(Post).values(version=Post.version + 1))
+    db_session.commit()
+    assert len(cache.backend) == 0
+
+    client.post(url + '/delete')
+    assert client.get(url).status_code == 404
+
+def test_concurrent_misses_load_once():
+    cache = PostCache(LRUCache(maxsize=10, ttl=60))
+    loads = []
+    def load(post_id):
+        loads.append(post_id)
+        time.sleep(0.05)
+        return ('post', post_id)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(1, load))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == [1]
+    assert results == [('post', 1)] * 8
+    assert cache.get(1, load) == ('post', 1)
+    assert loads == [1]
+
+def test_load_overlapping_invalidation_not_stored():
+    cache = PostCache(LRUCache(maxsize=10, ttl=60))
+    def load(post_id):
+        cache.invalidate(post_id) # a commit lands while the row is read
+        return 'stale'
+
+    assert cache.get(1, load) == 'stale'
+    assert cache.backend.get('1') is None
+    assert cache.get(1, lambda post_id: None) is None
+    assert cache.backend.get('1') is None
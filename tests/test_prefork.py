@@ -0,0 +1,179 @@
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+
+import click
+import pytest
+from sqlalchemy import func, select
+
+from flaskr import create_app
+from flaskr.db_alchemy import db_session, init_db
+from flaskr.data_model import Post, Comment
+from flaskr.prefork import after_fork, check_workers
+from conftest import TEST_HASH_METHOD, fill_db
+
+
+@pytest.fixture
+def file_app(tmp_path):
+    '''
+    App on a database file, which forked processes can open for themselves
+    '''
+    uri = 'sqlite:///' + str(tmp_path / 'flaskr.sqlite')
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_URI': uri,
+        'PASSWORD_HASH_METHOD': TEST_HASH_METHOD,
+    })
+    init_db(db_session.bind)
+    fill_db(db_session)
+    db_session.remove()
+
+    yield app
+
+    app.extensions['password_hasher'].close()
+    db_session.bind.dispose()
+    db_session.remove()
+
+def _in_child(work):
+    '''
+    Runs work() in a forked child and returns what it returned (JSON-able)
+    '''
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_end)
+            os.write(write_end, json.dumps(work()).encode())
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        result = pipe.read()
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
+def test_forked_children_open_own_connections(file_app):
+    engine = db_session.bind
+    with engine.connect() as conn:
+        parent_connection = conn.connection.driver_connection
+    # Back in the pool, where a child would find it
+    assert engine.pool.checkedin() == 1
+
+    def query(prepare=lambda: None):
+        def work():
+            prepare()
+            with engine.connect() as conn:
+                count = conn.scalar(select(func.count(Post.id)))
+                return [conn.connection.driver_connection is parent_connection, count]
+        return work
+
+    # Without the hook the pool refuses the inherited connection anyway
+    assert _in_child(query()) == [False, 2]
+    assert _in_child(query(lambda: after_fork(file_app))) == [False, 2]
+
+    # and the parent's is still open and usable
+    with engine.connect() as conn:
+        assert conn.connection.driver_connection is parent_connection
+        assert conn.scalar(select(func.count(Post.id))) == 2
+
+def _request(address, method, path, data=None, cookie=None):
+    conn = http.client.HTTPConnection(address.hostname, address.port, timeout=10)
+    headers = {'Connection': 'close'}
+    body = None
+    if data is not None:
+        body = urlencode(data)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    if cookie:
+        headers['Cookie'] = cookie
+    try:
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        response.read()
+        return response
+    finally:
+        conn.close()
+
+def test_serve_workers(file_app):
+    """
+    `flask serve` preloads the app and serves it from several worker
+    processes, which all write to the database at once
+    """
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    db_session.remove()
+    env = dict(os.environ,
+               FLASK_SQLALCHEMY_URI=file_app.config['SQLALCHEMY_URI'],
+               FLASK_PASSWORD_HASH_METHOD=TEST_HASH_METHOD,
+               FLASK_PREFORK_ALLOW_LOCAL_STATE='true')
+    server = subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'flaskr', 'serve',
+                               '--port', '0', '--workers', '3', '--events-port', '0'],
+                              cwd=Path(__file__).parent.parent, env=env,
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        lines = []
+        while not lines or not lines[-1].startswith('Serving on'):
+            line = server.stdout.readline()
+            assert line, f'Server exited: {lines}'
+            lines.append(line.strip())
+        templates = len(file_app.jinja_env.list_templates())
+        assert lines[0] == f'Warmed {templates} templates and 2 posts.'
+        workers = [int(line.split()[-1].rstrip('.')) for line in lines if line.startswith('Booted')]
+        assert len(set(workers)) == 3
+        address = urlsplit(lines[-1].split()[2])
+
+        # Live comments from the workers' event servers
+        events = urlsplit(lines[-2].split()[3].rstrip('.'))
+        with socket.create_connection((events.hostname, events.port), timeout=10) as stream:
+            stream.sendall(f'GET /{post_id}/events HTTP/1.1\r\n\r\n'.encode())
+            assert stream.recv(1024).startswith(b'HTTP/1.1 200 OK\r\n')
+
+        login = _request(address, 'POST', '/auth/login',
+                         {'username': 'tester', 'password': 'test_password'})
+        cookie = login.getheader('Set-Cookie').split(';')[0]
+
+        def comment(i):
+            return _request(address, 'POST', f'/{post_id}/comment', {'text': f'Comment {i}'}, cookie).status
+        def read(i):
+            return _request(address, 'GET', '/' if i % 2 else f'/{post_id}').status
+        with ThreadPoolExecutor(8) as pool:
+            assert set(pool.map(comment, range(24))) == {302}
+            assert set(pool.map(read, range(24))) == {200}
+
+        assert db_session.scalar(select(func.count(Comment.id))) == 24
+        assert db_session.get(Post, post_id).comment_count == 24
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(10) == 0
+        server.stdout.close()
+
+    # Workers stop with the server
+    for pid in workers:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+
+def test_check_workers(app, caplog):
+    check_workers(app, 1)
+    with pytest.raises(click.ClickException, match='EVENTS_CLIENT.*CACHE_CLIENT'):
+        check_workers(app, 2)
+
+    app.config['PREFORK_ALLOW_LOCAL_STATE'] = True
+    check_workers(app, 2)
+    assert [record.levelname for record in caplog.records] == ['WARNING'] * 2
+
+    app.config['PREFORK_ALLOW_LOCAL_STATE'] = False
+    app.config['EVENTS_CLIENT'] = app.config['CACHE_CLIENT'] = object()
+    check_workers(app, 2, threads=16)
+    # Streams could take every thread
+    with pytest.raises(click.ClickException, match='EVENTS_MAX_SUBSCRIBERS'):
+        check_workers(app, 2, threads=8)
+
+def test_serve_refuses_local_state(file_app):
+    result = file_app.test_cli_runner().invoke(args=['serve', '--port', '0', '--workers', '2'])
+    assert result.exit_code == 1
+    assert 'Set PREFORK_ALLOW_LOCAL_STATE' in result.output
@@ -0,0 +1,78 @@
+import pytest
+from sqlalchemy import select
+from flaskr.db_alchemy import db_session, upgrade_db
+from flaskr.data_model import Post
+from flaskr.search import fts_query
+
+
+def test_search_posts(client):
+    """
+    Matches in post bodies come back with the term highlighted
+    """
+    response = client.get('/search?q=body')
+    assert response.status_code == 200
+    assert b'Test Post' in response.data
+    assert b'A full <mark>body</mark> of text to test' in response.data
+    assert b'Other User Test Post' not in response.data
+
+def test_search_comments_and_updates(client, auth, app):
+    """
+    New comments and edited posts are indexed as they are written
+    """
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    auth.login()
+    client.post(f'/{post_id}/comment', data={'text': 'A <b>zebra</b> appears'})
+    response = client.get('/search?q=zebra')
+    assert b'in a comment' in response.data
+    assert b'&lt;b&gt;<mark>zebra</mark>&lt;/b&gt;' in response.data
+
+    client.post(f'/{post_id}/update', data={'title': 'Renamed', 'body': 'giraffes only'})
+    assert b'Renamed' in client.get('/search?q=giraffes').data
+    assert b'No results' in client.get('/search?q=full').data
+
+def test_search_paging(client, app):
+    app.config['SEARCH_RESULTS_PER_PAGE'] = 1
+    response = client.get('/search?q=test*')
+    assert b'page=2' in response.data
+    response = client.get('/search?q=test*&page=2')
+    assert b'page=1' in response.data
+    assert b'page=3' not in response.data
+
+@pytest.mark.parametrize(('terms', 'query'), (
+    ('full body', '"full" "body"'),
+    ('tes*', '"tes"*'),
+    ('"body OR', '"""body" "OR"'),
+    ('*', ''),
+))
+def test_fts_query(terms, query):
+    assert fts_query(terms) == query
+
+def test_rebuild_search_command(runner, client):
+    with db_session.bind.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO post_fts(post_fts) VALUES ('delete-all')")
+    assert b'No results' in client.get('/search?q=body').data
+
+    result = runner.invoke(args=['rebuild-search'])
+    assert 'Rebuilt' in result.output
+    assert b'<mark>body</mark>' in client.get('/search?q=body').data
+
+def test_upgrade_db_creates_search(client, auth):
+    """
+    A database from before search gets the index, filled, on upgrade, and
+    keeps it up to date from then on
+    """
+    with db_session.bind.begin() as conn:
+        for trigger in ('post_fts_insert', 'post_fts_delete', 'post_fts_update',
+                        'comment_fts_insert', 'comment_fts_delete', 'comment_fts_update'):
+            conn.exec_driver_sql(f'DROP TRIGGER {trigger}')
+        conn.exec_driver_sql('DROP TABLE post_fts')
+        conn.exec_driver_sql('DROP TABLE comment_fts')
+
+    assert upgrade_db(db_session.bind) == ['created and filled the search index']
+    assert upgrade_db(db_session.bind) == []
+    assert b'<mark>body</mark>' in client.get('/search?q=body').data
+
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    auth.login()
+    client.post(f'/{post_id}/comment', data={'text': 'An okapi'})
+    assert b'<mark>okapi</mark>' in client.get('/search?q=okapi').data
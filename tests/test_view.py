@@ -1,8 +1,9 @@
-import pytest
+import re
+import pytest, uuid
 from flask import g, session
-from sqlalchemy import select, update, func
+from sqlalchemy import event, insert, select, update, func
 from flaskr.db_alchemy import db_session
-from flaskr.data_model import User, Post
+from flaskr.data_model import User, Post, Comment
 
 
 def test_view(client, auth):
@@ -28,3 +29,322 @@ def test_commenting_requires_text(client, auth):
 
         response = client.post(url_for_comment, data={'text': ''}, follow_redirects=True)
         assert b'Comment text is required' in response.data
+
+def test_view_query_count(client, app):
+    """
+    Checks that the post page runs a fixed number of queries however many
+    comments (and comment authors) the post has, guarding against N+1 loads
+    """
+    post = db_session.scalars(select(Post).where(Post.title == 'Test Post')).first()
+    post_id = post.id
+    users = db_session.scalars(select(User)).all()
+
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def queries_for_view():
+        # Cold render, so the comments are actually loaded
+        app.extensions['fragment_cache'].clear()
+        statements.clear()
+        event.listen(db_session.bind, 'before_cursor_execute', count_statement)
+        try:
+            response = client.get('/' + str(post_id))
+        finally:
+            event.remove(db_session.bind, 'before_cursor_execute', count_statement)
+        assert response.status_code == 200
+        return len(statements)
+
+    db_session.add(Comment(parent_post_id=post_id, author_id=users[0].id, body='first'))
+    db_session.commit()
+    baseline = queries_for_view()
+
+    for i in range(10):
+        author = User(name=f'commenter{i}', password='x')
+        db_session.add(author)
+        db_session.flush()
+        db_session.add(Comment(parent_post_id=post_id, author_id=author.id, body=f'comment {i}'))
+    db_session.commit()
+
+    assert queries_for_view() == baseline
+    assert baseline <= 3 # version check, post and author, comments and authors
+
+def test_view_missing_post(client):
+    assert client.get('/' + str(uuid.uuid4())).status_code == 404
+
+
+def test_fragment_cache(client, auth, app):
+    """
+    Post pages are served from the fragment cache until a comment bumps the
+    post version, and cached fragments never carry another user's Edit link
+    """
+    fragments = app.extensions['fragment_cache']
+    fragments.clear()
+    post = db_session.scalars(select(Post).where(Post.title == 'Test Post')).first()
+    url = '/' + str(post.id)
+    edit_url = ('href="/' + str(post.id) + '/update"').encode()
+
+    assert edit_url not in client.get(url).data
+    misses = fragments.misses
+    client.get(url)
+    assert fragments.misses == misses
+    assert fragments.hits >= 2
+
+    auth.login() # the author
+    response = client.get(url)
+    assert edit_url in response.data
+    assert fragments.misses == misses
+
+    client.post(url + '/comment', data={'text': 'Fresh comment'})
+    response = client.get(url)
+    assert b'Fresh comment' in response.data
+    assert fragments.misses > misses
+
+    auth.login('other_tester', 'other_password')
+    response = client.get(url)
+    assert edit_url not in response.data
+    assert b'(Edit)' not in response.data
+
+def test_edit_comment(client, auth):
+    auth.login()
+    url = '/' + str(db_session.scalars(select(Post)).first().id)
+    client.post(url + '/comment', data={'text': 'Before'})
+    comment_id = db_session.scalars(select(Comment.id).where(Comment.body == 'Before')).first()
+
+    response = client.post('/edit-comment/' + str(comment_id), data={'text': 'After'})
+    assert response.headers["Location"] == url
+    response = client.get(url)
+    assert b'After' in response.data
+    assert b'Before' not in response.data
+
+
+def test_view_conditional_get(client, auth):
+    """
+    Post pages answer 304 while the post is unchanged, and a new comment or a
+    different user invalidates the client's copy
+    """
+    url = '/' + str(db_session.scalars(select(Post)).first().id)
+    response = client.get(url)
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(url, headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    auth.login()
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 200
+    # The anonymous copy's date doesn't validate a logged in page either
+    response = client.get(url, headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+    assert 'Last-Modified' not in response.headers
+    etag = response.headers['ETag']
+    client.post(url + '/comment', data={'text': 'Changes things'})
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Changes things' in response.data
+
+def test_comment_counters(client, auth):
+    """
+    Adding and deleting comments keeps the post's comment_count and
+    last_activity_at in step
+    """
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    url = '/' + str(post_id)
+    auth.login()
+    client.post(url + '/comment', data={'text': 'One'})
+    client.post(url + '/comment', data={'text': 'Two'})
+    db_session.expire_all()
+    post = db_session.get(Post, post_id)
+    assert post.comment_count == 2
+    assert post.last_activity_at >= post.created
+    assert b'2 comments' in client.get('/').data
+
+    comment_id = db_session.scalars(select(Comment.id).where(Comment.body == 'One')).first()
+    response = client.post('/delete-comment/' + str(comment_id))
+    assert response.headers["Location"] == url
+    db_session.expire_all()
+    post = db_session.get(Post, post_id)
+    assert post.comment_count == 1
+    assert db_session.scalar(select(func.count(Comment.id))
+                             .where(Comment.parent_post_id == post_id)) == 1
+
+def test_delete_comment_checks(client, auth):
+    post_id = db_session.scalars(select(Post.id)).first()
+    auth.login()
+    client.post('/' + str(post_id) + '/comment', data={'text': 'Mine'})
+    comment_id = db_session.scalars(select(Comment.id).where(Comment.body == 'Mine')).first()
+
+    assert client.post('/delete-comment/' + str(uuid.uuid4())).status_code == 404
+    auth.logout()
+    auth.login('other_tester', 'other_password')
+    assert client.post('/delete-comment/' + str(comment_id)).status_code == 403
+
+def _comment_id(body):
+    return db_session.scalars(select(Comment.id).where(Comment.body == body)).first()
+
+def test_replies(client, auth, app):
+    """
+    Replies nest under their parent, the thread loads in one ordered query
+    and deleting a comment takes its replies with it
+    """
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    url = '/' + str(post_id)
+    auth.login()
+    client.post(url + '/comment', data={'text': 'First'})
+    client.post(url + '/comment', data={'text': 'Second'})
+    client.post('/reply/' + str(_comment_id('First')), data={'text': 'Reply to first'})
+    response = client.post('/reply/' + str(_comment_id('Reply to first')), data={'text': 'Deeper'})
+    assert response.headers['Location'] == url
+
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db_session.bind, 'before_cursor_execute', record)
+    try:
+        data = client.get(url).data.decode()
+    finally:
+        event.remove(db_session.bind, 'before_cursor_execute', record)
+    assert sum('FROM comment' in s and 'ORDER BY comment.path' in s for s in statements) == 1
+
+    # Depth first, siblings oldest first, replies inside their parent's .replies
+    positions = [data.index(body) for body in ('>First<', 'Reply to first', 'Deeper', '>Second<')]
+    assert positions == sorted(positions)
+    first_replies = data.index('id="replies-' + str(_comment_id('First')))
+    assert first_replies < data.index('Reply to first')
+
+    # Reply forms are filled in per user, not part of the cached thread
+    assert data.count('class="reply"') == 4
+    assert 'action="/reply/' + str(_comment_id('Deeper')) + '"' in data
+    auth.logout()
+    assert 'class="reply"' not in client.get(url).get_data(as_text=True)
+    auth.login()
+
+    db_session.expire_all()
+    assert db_session.get(Post, post_id).comment_count == 4
+
+    client.post('/delete-comment/' + str(_comment_id('First')))
+    db_session.expire_all()
+    bodies = db_session.scalars(select(Comment.body).where(Comment.parent_post_id == post_id)).all()
+    assert bodies == ['Second']
+    assert db_session.get(Post, post_id).comment_count == 1
+
+def test_reply_checks(client, auth, app):
+    post_id = db_session.scalars(select(Post.id)).first()
+    auth.login()
+    assert client.post('/reply/' + str(uuid.uuid4()), data={'text': 'x'}).status_code == 404
+
+    app.config['COMMENT_MAX_DEPTH'] = 1
+    client.post('/' + str(post_id) + '/comment', data={'text': 'Top'})
+    client.post('/reply/' + str(_comment_id('Top')), data={'text': 'Level one'})
+    response = client.post('/reply/' + str(_comment_id('Level one')), data={'text': 'Level two'},
+                           follow_redirects=True)
+    assert b'too deep' in response.data
+    assert _comment_id('Level two') is None
+
+def test_thread_view(client, auth):
+    post_id = db_session.scalars(select(Post.id)).first()
+    auth.login()
+    client.post('/' + str(post_id) + '/comment', data={'text': 'Root'})
+    client.post('/' + str(post_id) + '/comment', data={'text': 'Sibling'})
+    client.post('/reply/' + str(_comment_id('Root')), data={'text': 'Child'})
+
+    response = client.get('/comment/' + str(_comment_id('Root')))
+    assert b'Root' in response.data
+    assert b'Child' in response.data
+    assert b'Sibling' not in response.data
+    # The author's edit links, one per comment of theirs in the thread
+    assert response.data.count(b'(Edit)') == 2
+    assert client.get('/comment/' + str(uuid.uuid4())).status_code == 404
+
+def test_comment_pages(client, auth, app):
+    """
+    The post page shows the first COMMENT_PAGE_SIZE comments and a link to
+    the next page, which carries on the thread where the last one stopped
+    """
+    app.config['COMMENT_PAGE_SIZE'] = 2
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    url = '/' + str(post_id)
+    auth.login()
+    client.post(url + '/comment', data={'text': 'c1'})
+    client.post('/reply/' + str(_comment_id('c1')), data={'text': 'c1-r1'})
+    client.post('/reply/' + str(_comment_id('c1')), data={'text': 'c1-r2'})
+    client.post(url + '/comment', data={'text': 'c2'})
+    client.post(url + '/comment', data={'text': 'c3'})
+
+    data = client.get(url).data.decode()
+    assert 'c1-r1' in data and 'c1-r2' not in data
+    pages = [data]
+    while match := re.search(r'data-more="([^"]+)"', pages[-1]):
+        response = client.get(match.group(1).replace('&amp;', '&'))
+        assert response.status_code == 200
+        pages.append(response.data.decode())
+    assert len(pages) == 3
+    assert 'c1-r2' in pages[1] and 'c2' in pages[1]
+    assert 'c3' in pages[2] and 'data-more' not in pages[2]
+    # c1-r2 is still nested a level down, c3 gets the separator before it
+    assert pages[1].index('class="replies"') < pages[1].index('c1-r2')
+    assert pages[2].index('<hr>') < pages[2].index('c3')
+    # The user's own comments get their edit forms, posting to edit_comment
+    assert '(Edit)' in pages[2]
+    assert f'action="/edit-comment/{_comment_id("c3")}"' in pages[2]
+
+    c2_path = db_session.scalar(select(Comment.path).where(Comment.body == 'c2'))
+    page_url = url + '/comments?after=' + c2_path
+    etag = client.get(page_url).headers['ETag']
+    assert client.get(page_url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get(url + '/comments').status_code == 400
+    assert client.get(url + '/comments?after=nope').status_code == 400
+    assert client.get('/' + str(uuid.uuid4()) + '/comments?after=' + c2_path).status_code == 404
+
+    # The cursor doesn't need its comment, the thread carries on without it
+    client.post('/delete-comment/' + str(_comment_id('c2')))
+    assert 'c3' in client.get(page_url).get_data(as_text=True)
+
+def test_all_comments_streamed(client, auth, app):
+    """
+    The full thread view streams every comment, in thread order
+    """
+    app.config['COMMENT_PAGE_SIZE'] = 1
+    app.config['COMMENT_STREAM_BATCH'] = 2
+    post_id = db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+    url = '/' + str(post_id)
+    auth.login()
+    for body in ('s1', 's2', 's3'):
+        client.post(url + '/comment', data={'text': body})
+    client.post('/reply/' + str(_comment_id('s1')), data={'text': 's1-r1'})
+
+    response = client.get(url + '/comments/all')
+    assert response.is_streamed
+    data = response.get_data(as_text=True)
+    positions = [data.index(body) for body in ('>s1<', 's1-r1', '>s2<', '>s3<')]
+    assert positions == sorted(positions)
+    assert data.count('<div') == data.count('</div>')
+    assert '(Edit)' in data
+    assert client.get('/' + str(uuid.uuid4()) + '/comments/all').status_code == 404
+
+def test_view_comment_without_path(client):
+    """
+    Comments from before replies, without a path, show as top level comments
+    """
+    post = db_session.scalars(select(Post)).first()
+    db_session.execute(insert(Comment), [
+        {'id': uuid.uuid4(), 'parent_post_id': post.id, 'author_id': post.author_id, 'body': 'Old'},
+    ])
+    db_session.commit()
+
+    response = client.get('/' + str(post.id))
+    assert response.status_code == 200
+    assert b'Old' in response.data
+    assert client.get('/' + str(post.id) + '/comments/all').status_code == 200
+
+def test_repair_comment_paths(runner):
+    post = db_session.scalars(select(Post)).first()
+    db_session.execute(insert(Comment), [
+        {'id': uuid.uuid4(), 'parent_post_id': post.id, 'author_id': post.author_id, 'body': 'Old'},
+    ])
+    db_session.commit()
+    assert db_session.scalar(select(Comment.path).where(Comment.body == 'Old')) is None
+
+    result = runner.invoke(args=['repair-comment-paths'])
+    assert 'Set the path of 1 comments' in result.output
+    assert db_session.scalar(select(Comment.path).where(Comment.body == 'Old')) is not None
@@ -0,0 +1,158 @@
+import threading
+import uuid
+
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+from sqlalchemy import event, select
+
+from flaskr import create_app
+from flaskr.db_alchemy import db_session, init_db
+from flaskr.data_model import Post, Comment
+from flaskr.events import comment_channel
+from flaskr.write_behind import CommentWriter
+from conftest import AuthActions, TEST_HASH_METHOD, fill_db
+
+
+@pytest.fixture
+def writer_app(tmp_path):
+    '''
+    App with comment write-behind on. The writer thread needs its own
+    connection to the same database, so this uses a file rather than :memory:.
+    '''
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_URI': 'sqlite:///' + str(tmp_path / 'flaskr.sqlite'),
+        'PASSWORD_HASH_METHOD': TEST_HASH_METHOD,
+        'COMMENT_WRITE_BEHIND': True,
+        'COMMENT_BATCH_LINGER': 0.05,
+    })
+    init_db(db_session.bind)
+    fill_db(db_session)
+
+    yield app
+
+    app.extensions['comment_writer'].close()
+    app.extensions['password_hasher'].close()
+    db_session.remove()
+
+def _post_id():
+    return db_session.scalars(select(Post.id).where(Post.title == 'Test Post')).first()
+
+def test_comments_written_in_batches(writer_app):
+    writer = writer_app.extensions['comment_writer']
+    post_id = _post_id()
+    author_id = db_session.scalars(select(Post.author_id)).first()
+    engine = db_session.bind
+
+    subscription = writer_app.extensions['events'].subscribe(comment_channel(post_id))
+    commits = []
+    event.listen(engine, 'commit', lambda conn: commits.append(threading.current_thread().name))
+    # Submitted together, they share the writer's linger window
+    threads = [threading.Thread(target=writer.submit, args=(post_id, author_id, 'tester', f'c{i}'))
+               for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.flush()
+
+    db_session.expire_all()
+    post = db_session.get(Post, post_id)
+    assert post.comment_count == 10
+    assert post.version == 2
+    assert len(db_session.scalars(select(Comment).where(Comment.parent_post_id == post_id)).all()) == 10
+    assert commits.count('comment-writer') == 1
+    # Written comments are announced to the post's live streams
+    assert len(subscription.get(0)) == 10
+
+def test_read_your_writes(writer_app):
+    """
+    The author sees a queued comment straight away, other users once it's
+    written, and it's never shown twice
+    """
+    client = writer_app.test_client()
+    AuthActions(client).login()
+    url = '/' + str(_post_id())
+    writer = writer_app.extensions['comment_writer']
+
+    # Hold the writer back so the comment stays queued
+    release = threading.Event()
+    commit = writer._commit
+    writer._commit = lambda batch: release.wait() and commit(batch)
+
+    try:
+        client.post(url + '/comment', data={'text': 'Mine, queued'})
+        response = client.get(url)
+        assert response.data.count(b'Mine, queued') == 1
+
+        other = writer_app.test_client()
+        AuthActions(other).login('other_tester', 'other_password')
+        assert b'Mine, queued' not in other.get(url).data
+    finally:
+        release.set()
+    writer.flush()
+    assert other.get(url).data.count(b'Mine, queued') == 1
+    # Once written, the author's edit form holds the text as well
+    assert client.get(url).data.count(b'<p>Mine, queued</p>') == 1
+
+def test_pending_hidden_once_rendered():
+    writer = CommentWriter(engine=None)
+    post_id, author_id = uuid.uuid4(), uuid.uuid4()
+    writer._start = lambda: None # no thread, nothing gets written
+    writer.submit(post_id, author_id, 'tester', 'waiting')
+
+    assert [row.body for row in writer.pending(post_id, author_id, version=1)] == ['waiting']
+    assert writer.pending(post_id, uuid.uuid4(), version=1) == []
+
+    entry = writer._queue.get_nowait()
+    entry.committed_version = 2
+    assert writer.pending(post_id, author_id, version=1) != []
+    assert writer.pending(post_id, author_id, version=2) == []
+
+def test_backpressure(writer_app):
+    writer = CommentWriter(engine=None, maxsize=1, timeout=0.01)
+    writer._start = lambda: None
+    writer.submit(uuid.uuid4(), uuid.uuid4(), 'tester', 'fills the queue')
+    with writer_app.test_request_context():
+        with pytest.raises(ServiceUnavailable):
+            writer.submit(uuid.uuid4(), uuid.uuid4(), 'tester', 'one too many')
+
+def test_committed_timeout(writer_app):
+    writer = CommentWriter(engine=None, durability='committed', timeout=0.01)
+    writer._start = lambda: None # the commit never comes
+    post_id, author_id = uuid.uuid4(), uuid.uuid4()
+    with writer_app.test_request_context():
+        with pytest.raises(ServiceUnavailable):
+            writer.submit(post_id, author_id, 'tester', 'slow')
+    # Still on its way, and shown to its author
+    assert [row.body for row in writer.pending(post_id, author_id, version=1)] == ['slow']
+
+def test_committed_durability_and_close(writer_app):
+    writer = CommentWriter(db_session.bind, durability='committed')
+    post_id = _post_id()
+    author_id = db_session.scalars(select(Post.author_id)).first()
+
+    row = writer.submit(post_id, author_id, 'tester', 'durable')
+    # Already committed when submit returns
+    assert db_session.scalar(select(Comment.body).where(Comment.id == row.id)) == 'durable'
+    writer.close()
+    assert writer._thread is None
+
+    with pytest.raises(ValueError):
+        CommentWriter(None, durability='eventually')
+
+def test_bad_comment_does_not_sink_batch(writer_app, monkeypatch):
+    writer = CommentWriter(db_session.bind, linger=0.05)
+    post_id = _post_id()
+    author_id = db_session.scalars(select(Post.author_id)).first()
+
+    # The second comment gets the first one's id, which the insert rejects
+    comment_id = uuid.uuid4()
+    monkeypatch.setattr('flaskr.write_behind.uuid7', lambda: comment_id)
+    writer.submit(post_id, author_id, 'tester', 'fine')
+    writer.submit(post_id, author_id, 'tester', 'duplicate')
+    writer.flush()
+    writer.close()
+
+    bodies = db_session.scalars(select(Comment.body).where(Comment.parent_post_id == post_id)).all()
+    assert bodies == ['fine']